@@ -0,0 +1,115 @@
+"""
+Admission control for the webhook
+
+Before an update is even parsed, the webhook asks the controller whether
+the process can take more work. Memory (RSS), the update queue depth and
+the render backlog are compared against high watermarks; once one is
+crossed the webhook sheds load with a retryable error (Telegram
+delivers the update again later) until every reading is back under its
+low watermark. This keeps the process clear of pm2's memory restart, which
+would lose every in-memory session.
+
+The render backlog is measured in megapixels to decode (waiting and
+running page jobs, see RenderPool.backlog_pixels) rather than in jobs:
+every uploaded image queues its own page job, so a job count rises with
+ordinary album uploads, while decoded pixels track the work (and memory)
+actually ahead of the pool.
+"""
+
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    def __init__(self, rss_high_mb: float = 170, rss_low_mb: float = 140, queue_high: int = 150, queue_low: int = 100,
+                 render_mp_high: float = 400, render_mp_low: float = 200, sample_interval: float = 0.5, retry_after: int = 10):
+        # A high watermark of 0 disables that check
+        self.watermarks = {
+            'rss_mb': (rss_high_mb, rss_low_mb),
+            'queued_updates': (queue_high, queue_low),
+            'render_mp': (render_mp_high, render_mp_low),
+        }
+        self.sample_interval = sample_interval
+        self.retry_after = retry_after
+        self._process = None
+        self.shedding = False
+        self.reason = None
+        self.shed = 0  # Requests rejected while shedding
+        self.episodes = 0  # Times shedding started
+        self._rss_mb = 0.0
+        self._sampled_at = 0.0
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionController':
+        return cls(
+            rss_high_mb=float(os.getenv('ADMISSION_RSS_HIGH_MB', 170)),
+            rss_low_mb=float(os.getenv('ADMISSION_RSS_LOW_MB', 140)),
+            queue_high=int(os.getenv('ADMISSION_QUEUE_HIGH', 150)),
+            queue_low=int(os.getenv('ADMISSION_QUEUE_LOW', 100)),
+            render_mp_high=float(os.getenv('ADMISSION_RENDER_MP_HIGH', 400)),
+            render_mp_low=float(os.getenv('ADMISSION_RENDER_MP_LOW', 200)),
+            retry_after=int(os.getenv('ADMISSION_RETRY_AFTER', 10)),
+        )
+
+    @property
+    def process(self):
+        # psutil is imported on first use to keep it out of startup
+        if self._process is None:
+            import psutil
+            self._process = psutil.Process()
+        return self._process
+
+    def rss_mb(self) -> float:
+        """Resident memory of this process, sampled at most every sample_interval seconds"""
+        now = time.monotonic()
+        if now - self._sampled_at >= self.sample_interval:
+            self._rss_mb = self.process.memory_info().rss / 1024 / 1024
+            self._sampled_at = now
+        return self._rss_mb
+
+    def _below_low(self, name: str, value: float) -> bool:
+        high, low = self.watermarks[name]
+        return not high or value <= low
+
+    def update(self, queued_updates: int, render_pixels: int) -> bool:
+        """Compare current readings with the watermarks; returns whether load is being shed"""
+        readings = {
+            'rss_mb': self.rss_mb(),
+            'queued_updates': queued_updates,
+            'render_mp': render_pixels / 1_000_000,
+        }
+
+        if not self.shedding:
+            for name, value in readings.items():
+                high, _ = self.watermarks[name]
+                if high and value >= high:
+                    self.shedding = True
+                    self.reason = name
+                    self.episodes += 1
+                    logger.warning(f"Shedding webhook load: {name} at {value:.0f} (high watermark {high})")
+                    break
+        elif all(self._below_low(name, value) for name, value in readings.items()):
+            self.shedding = False
+            logger.info(f"Accepting webhook load again after {self.reason} dropped below its low watermark")
+            self.reason = None
+        return self.shedding
+
+    def admit(self, queued_updates: int, render_pixels: int) -> bool:
+        """Return False while the process is shedding load"""
+        if self.update(queued_updates, render_pixels):
+            self.shed += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'shedding': self.shedding,
+            'reason': self.reason,
+            'shed': self.shed,
+            'episodes': self.episodes,
+            'rss_mb': round(self._rss_mb, 1),
+            'watermarks': {name: {'high': high, 'low': low} for name, (high, low) in self.watermarks.items()},
+        }
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the image-to-PDF pipeline
+
+Generates a synthetic, reproducible corpus (large JPEGs, RGBA and palette
+PNGs, grayscale scans and, when pillow-heif can encode, HEIC photos) and
+renders sessions of 1, 10, 50 and 200 pages of each kind. Every scenario
+runs in a fresh process and reports wall time, CPU time, pages/sec, output
+bytes and peak RSS (not with --quick: the small images do not raise the
+peak above what starting the process takes); a second run under
+tracemalloc reports the peak of Python-level allocations (Pillow's own
+image buffers are not traced, they show up in peak RSS).
+
+The pipeline measured is the bot's incremental one: prepare_page() and
+IncrementalPDF, as run while images arrive and on "Generate PDF".
+
+Usage:
+    python benchmark.py run --output results.json
+    python benchmark.py run --quick --baseline baseline.json
+    python benchmark.py compare baseline.json results.json --threshold 0.15
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+from PIL import Image, ImageDraw
+
+from pdf_render import COMPRESSION_PROFILES, PAGE_PROFILES, IncrementalPDF, RenderOptions, \
+    prepare_page, register_heif
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak RSS is not reported there
+    resource = None
+
+# Bump when the generated images change so stale corpora are regenerated
+CORPUS_VERSION = 1
+
+# Distinct images per kind; sessions cycle through them
+VARIANTS = 4
+
+SEED = 20240601
+
+# kind -> (size, extension); --quick divides the sizes by QUICK_SCALE
+CORPUS_KINDS = {
+    'jpeg-large': ((4000, 3000), 'jpg'),
+    'png-rgba': ((2000, 1500), 'png'),
+    'png-palette': ((2000, 1500), 'png'),
+    'gray-scan': ((2480, 3508), 'jpg'),  # A4 at 300 dpi
+    'heic': ((3024, 4032), 'heic'),
+}
+QUICK_SCALE = 4
+
+SESSION_PAGES = (1, 10, 50, 200)
+QUICK_SESSION_PAGES = (1, 10)
+
+# Name of the measured pipeline in result keys
+PIPELINE = 'incremental'
+
+# Metrics where a higher value is a regression, with the absolute change
+# below which a difference is treated as noise
+COMPARED_METRICS = {
+    'wall_s': 0.02,
+    'cpu_s': 0.02,
+    'peak_rss_mb': 2.0,
+    'tracemalloc_peak_mb': 1.0,
+    'output_bytes': 0,
+}
+
+# Not measured by --quick runs
+RSS_METRICS = {'peak_rss_mb'}
+
+# pm2's max_memory_restart in ecosystem.config.js
+DEFAULT_RSS_LIMIT_MB = 200
+
+
+def _noise(rng: random.Random, size: tuple, tile: int = 256) -> Image.Image:
+    """Smooth deterministic noise (Image.effect_noise cannot be seeded)"""
+    return Image.frombytes('L', (tile, tile), rng.randbytes(tile * tile)).resize(size, Image.BILINEAR)
+
+
+def synthetic_photo(rng: random.Random, size: tuple) -> Image.Image:
+    """Photo-like RGB image: gradients, noise and random discs"""
+    img = Image.merge('RGB', (
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size),
+        _noise(rng, size),
+    ))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(width // 40 + 1, width // 6 + 2)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+    return img
+
+
+def _scan(rng: random.Random, size: tuple) -> Image.Image:
+    """White paper with lines of dark "words" and a little sensor noise"""
+    width, height = size
+    img = Image.new('L', size, 240)
+    draw = ImageDraw.Draw(img)
+    line_height = max(4, height // 60)
+    margin = width // 10
+    for top in range(margin, height - margin, line_height * 2):
+        x = margin
+        while x < width - margin:
+            word = rng.randrange(line_height, line_height * 6)
+            draw.rectangle((x, top, min(x + word, width - margin), top + line_height), fill=rng.randrange(10, 60))
+            x += word + line_height
+    return Image.blend(img, _noise(rng, size, tile=512), 0.05)
+
+
+def generate_image(kind: str, variant: int, path: str, scale: int = 1):
+    size, _ = CORPUS_KINDS[kind]
+    size = (size[0] // scale, size[1] // scale)
+    rng = random.Random(f"{SEED}:{kind}:{variant}")
+
+    if kind == 'jpeg-large':
+        synthetic_photo(rng, size).save(path, 'JPEG', quality=90)
+    elif kind == 'png-rgba':
+        img = synthetic_photo(rng, size)
+        alpha = Image.radial_gradient('L').resize(size).point(lambda v: 255 - v)
+        img.putalpha(alpha)
+        img.save(path, 'PNG')
+    elif kind == 'png-palette':
+        synthetic_photo(rng, size).quantize(colors=64).save(path, 'PNG')
+    elif kind == 'gray-scan':
+        _scan(rng, size).save(path, 'JPEG', quality=85)
+    elif kind == 'heic':
+        register_heif()
+        synthetic_photo(rng, size).save(path, 'HEIF', quality=80)
+    else:
+        raise ValueError(f"Unknown corpus kind: {kind}")
+
+
+def build_corpus(directory: str, kinds: list, quick: bool = False) -> dict:
+    """Generate missing corpus images and return kind -> list of paths"""
+    scale = QUICK_SCALE if quick else 1
+    directory = os.path.join(directory, f"v{CORPUS_VERSION}-{'quick' if quick else 'full'}")
+    os.makedirs(directory, exist_ok=True)
+
+    corpus = {}
+    for kind in kinds:
+        if kind == 'heic' and not register_heif():
+            print("⚠️  Skipping heic: pillow-heif is not available")
+            continue
+        _, extension = CORPUS_KINDS[kind]
+        paths = []
+        try:
+            for variant in range(VARIANTS):
+                path = os.path.join(directory, f"{kind}-{variant}.{extension}")
+                if not os.path.exists(path):
+                    generate_image(kind, variant, path + '.tmp', scale)
+                    os.replace(path + '.tmp', path)
+                paths.append(path)
+        except Exception as e:
+            print(f"⚠️  Skipping {kind}: cannot generate images ({e})")
+            continue
+        corpus[kind] = paths
+    return corpus
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_scenario(image_paths: list, output_dir: str, page_profile: str, compression_profile: str,
+                 trace: bool) -> dict:
+    """Render one session; runs in a fresh worker process"""
+    options = RenderOptions(page_profile, compression_profile)
+    pdf_path = os.path.join(output_dir, f"bench-{os.getpid()}.pdf")
+    baseline_rss = _peak_rss_mb()
+    if trace:
+        tracemalloc.start()
+
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    pdf = IncrementalPDF(pdf_path, options.signature)
+    for key, image_path in enumerate(image_paths):
+        pdf.append(key, prepare_page(image_path, options))
+    pages = pdf.finalize(list(range(len(image_paths))))
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    result = {'pages': pages, 'output_bytes': os.path.getsize(pdf_path)}
+    if trace:
+        result['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    else:
+        result.update({
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'baseline_rss_mb': baseline_rss,
+        })
+    os.remove(pdf_path)
+    return result
+
+
+def _in_fresh_process(*args) -> dict:
+    # One task per process so ru_maxrss only covers this scenario
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_scenario, *args).result()
+
+
+def run_benchmarks(args) -> dict:
+    kinds = args.kinds.split(',') if args.kinds else list(CORPUS_KINDS)
+    page_counts = [int(count) for count in args.pages.split(',')] if args.pages else \
+        list(QUICK_SESSION_PAGES if args.quick else SESSION_PAGES)
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), 'img2pdf_benchmark_corpus')
+
+    corpus = build_corpus(corpus_dir, kinds, args.quick)
+    output_dir = tempfile.mkdtemp(prefix='img2pdf_benchmark_')
+    results = {}
+    try:
+        for kind, paths in corpus.items():
+            for pages in page_counts:
+                image_paths = [paths[i % len(paths)] for i in range(pages)]
+                name = f"{kind}/{pages}p/{PIPELINE}/{args.page_profile}/{args.compression_profile}"
+                scenario_args = (image_paths, output_dir, args.page_profile, args.compression_profile)
+                runs = [_in_fresh_process(*scenario_args, False) for _ in range(args.repeat)]
+                wall = statistics.median(run['wall_s'] for run in runs)
+                result = {
+                    'kind': kind,
+                    'pipeline': PIPELINE,
+                    'pages': runs[0]['pages'],
+                    'wall_s': round(wall, 4),
+                    'cpu_s': round(statistics.median(run['cpu_s'] for run in runs), 4),
+                    'pages_per_sec': round(runs[0]['pages'] / wall, 2) if wall else None,
+                    'output_bytes': runs[0]['output_bytes'],
+                    'input_bytes': sum(os.path.getsize(path) for path in image_paths),
+                    'peak_rss_mb': None,
+                    'baseline_rss_mb': None,
+                    'tracemalloc_peak_mb': None,
+                }
+                if runs[0]['peak_rss_mb'] is not None and not args.quick:
+                    result['peak_rss_mb'] = round(max(run['peak_rss_mb'] for run in runs), 1)
+                    result['baseline_rss_mb'] = round(runs[0]['baseline_rss_mb'], 1)
+                if not args.no_tracemalloc:
+                    traced = _in_fresh_process(*scenario_args, True)
+                    result['tracemalloc_peak_mb'] = round(traced['tracemalloc_peak_mb'], 2)
+                results[name] = result
+                rss = f"peak RSS {result['peak_rss_mb']}MB, " if result['peak_rss_mb'] is not None else ''
+                print(
+                    f"{name}: {result['wall_s']:.3f}s wall, {result['cpu_s']:.3f}s CPU, "
+                    f"{result['pages_per_sec']} pages/s, {result['output_bytes'] / 1024:.0f}KB, "
+                    f"{rss}tracemalloc {result['tracemalloc_peak_mb']}MB"
+                )
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    import PIL
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'corpus_version': CORPUS_VERSION,
+            'quick': args.quick,
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'heif': register_heif(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float, rss_limit_mb: float = None) -> list:
+    """Return regression messages of `current` against `baseline`"""
+    regressions = []
+    if baseline['meta'].get('quick') != current['meta'].get('quick'):
+        print("⚠️  Baseline and results were run with different corpus sizes (--quick)")
+    # Quick runs (also ones saved before they left RSS out) have no meaningful peak RSS
+    quick = baseline['meta'].get('quick') or current['meta'].get('quick')
+    metrics = {metric: noise for metric, noise in COMPARED_METRICS.items() if not (quick and metric in RSS_METRICS)}
+
+    for name, result in current['results'].items():
+        if rss_limit_mb and not current['meta'].get('quick') and result.get('peak_rss_mb') and \
+                result['peak_rss_mb'] > rss_limit_mb:
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']}MB exceeds the {rss_limit_mb:.0f}MB limit")
+
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        for metric, noise in metrics.items():
+            old, new = before.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new - old > noise and new > old * (1 + threshold):
+                change = f"+{(new / old - 1) * 100:.0f}%" if old else "new"
+                regressions.append(f"{name}: {metric} {old} -> {new} ({change})")
+
+    missing = set(baseline['results']) - set(current['results'])
+    if missing:
+        print(f"⚠️  {len(missing)} baseline scenarios were not run")
+    return regressions
+
+
+def report(regressions: list) -> int:
+    if not regressions:
+        print("✅ No regressions")
+        return 0
+    print(f"❌ {len(regressions)} regressions:")
+    for regression in regressions:
+        print(f"  {regression}")
+    return 1
+
+
+def _load(path: str) -> dict:
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Image-to-PDF pipeline benchmark")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark and save the results")
+    run_parser.add_argument("--output", default="benchmark_results.json", help="Results file (JSON)")
+    run_parser.add_argument("--kinds", help=f"Comma-separated corpus kinds (default: {','.join(CORPUS_KINDS)})")
+    run_parser.add_argument("--pages", help="Comma-separated session sizes (default: 1,10,50,200)")
+    run_parser.add_argument("--page-profile", default='original', choices=list(PAGE_PROFILES))
+    run_parser.add_argument("--compression-profile", default='standard', choices=list(COMPRESSION_PROFILES))
+    run_parser.add_argument("--repeat", type=int, default=1, help="Timed runs per scenario (median is reported)")
+    run_parser.add_argument("--quick", action="store_true", help="Smaller images and sessions of 1 and 10 pages")
+    run_parser.add_argument("--no-tracemalloc", action="store_true", help="Skip the tracemalloc run")
+    run_parser.add_argument("--corpus-dir", help="Where generated images are kept between runs")
+    run_parser.add_argument("--baseline", help="Compare the results against this file")
+    run_parser.add_argument("--threshold", type=float, default=0.15, help="Relative increase flagged as regression")
+    run_parser.add_argument("--rss-limit", type=float, default=DEFAULT_RSS_LIMIT_MB, help="Peak RSS limit (MB)")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare saved results against a baseline")
+    compare_parser.add_argument("baseline", help="Baseline results file")
+    compare_parser.add_argument("results", help="Results file")
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="Relative increase flagged as regression")
+    compare_parser.add_argument("--rss-limit", type=float, default=DEFAULT_RSS_LIMIT_MB, help="Peak RSS limit (MB)")
+
+    args = parser.parse_args()
+
+    if args.action == "run":
+        results = run_benchmarks(args)
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+        print(f"✅ Results saved to {args.output}")
+        if args.baseline:
+            return report(compare(_load(args.baseline), results, args.threshold, args.rss_limit))
+        return 0
+
+    return report(compare(_load(args.baseline), _load(args.results), args.threshold, args.rss_limit))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+Content-addressed download cache
+
+Telegram gives every file a file_unique_id that stays the same across
+messages and bots, so images users send again (retries, resending after
+/clear) can be served from disk instead of calling get_file and
+downloading them again. Cached files are hardlinked into session
+directories; evicting an entry only removes the cache's own link, so
+sessions still using the file are unaffected. The cache is bounded by
+total bytes (least recently used entries go first) and by the time since
+an entry was last used.
+
+Several worker processes may share the directory. Each indexes the files
+it knows about, but limits are enforced on what is on disk: a hit
+refreshes the file's mtime and eviction scans the directory, so the size
+limit holds for all workers together. Downloads are staged in a
+per-process subdirectory, and only staging directories of processes that
+are gone are cleaned up.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# file_unique_id is base64url; anything else is not used as a file name
+_SAFE_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Downloads in progress are staged in <directory>/.staging-<pid>
+STAGING_PREFIX = '.staging-'
+
+
+class CacheEntry:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+
+def link_or_copy(source: str, destination: str):
+    """Hardlink source to destination, copying when linking is not possible"""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class DownloadCache:
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024, ttl: float = 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.staging_dir = os.path.join(directory, f"{STAGING_PREFIX}{os.getpid()}")
+        self.entries: Dict[str, CacheEntry] = {}  # Files this process stored or found at startup
+        self.pending: Dict[str, asyncio.Future] = {}  # Downloads in progress, shared by concurrent requests
+        self.total_bytes = 0  # Size of all cached files on disk as of the last scan
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @classmethod
+    def from_env(cls) -> Optional['DownloadCache']:
+        """Build the cache from DOWNLOAD_CACHE_* settings; None when disabled"""
+        max_mb = float(os.getenv('DOWNLOAD_CACHE_MAX_MB', 200))
+        if max_mb <= 0:
+            return None
+        directory = os.getenv('DOWNLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'img2pdf_download_cache'))
+        return cls(directory, int(max_mb * 1024 * 1024), float(os.getenv('DOWNLOAD_CACHE_TTL', 3600)))
+
+    def _load(self):
+        """Index files left by a previous run and clean up abandoned staging directories"""
+        for name in os.listdir(self.directory):
+            if not name.startswith(STAGING_PREFIX):
+                continue
+            pid = name[len(STAGING_PREFIX):]
+            if pid.isdigit() and int(pid) != os.getpid() and _process_exists(int(pid)):
+                # Another worker's downloads in progress
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        for _, key, path, size in self._scan():
+            self.entries[key] = CacheEntry(path, size)
+        self._evict()
+
+    def _scan(self) -> list:
+        """Return (mtime, key, path, size) of the cached files on disk, least recently used first"""
+        files = []
+        with os.scandir(self.directory) as entries:
+            for dir_entry in entries:
+                key, _ = os.path.splitext(dir_entry.name)
+                if not _SAFE_KEY.match(key) or not dir_entry.is_file():
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    # Evicted by another worker meanwhile
+                    continue
+                files.append((stat.st_mtime, key, dir_entry.path, stat.st_size))
+        files.sort()
+        return files
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _evict(self, keep: str = None):
+        """
+        Drop expired files and the least recently used ones beyond the size
+        limit, whichever worker stored them. `keep` (the entry just stored)
+        survives until the next eviction even when it alone exceeds the
+        limit.
+        """
+        now = time.time()
+        files = self._scan()
+        total = sum(size for _, _, _, size in files)
+        for mtime, key, path, size in files:
+            if key == keep:
+                continue
+            if total <= self.max_bytes and now - mtime < self.ttl:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+            entry = self.entries.get(key)
+            if entry is not None and entry.path == path:
+                del self.entries[key]
+        self.total_bytes = total
+
+    def _lookup(self, key: str) -> Optional[CacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            last_used = os.stat(entry.path).st_mtime
+        except OSError:
+            # Evicted by another worker
+            del self.entries[key]
+            return None
+        if time.time() - last_used >= self.ttl:
+            self._remove(key)
+            self.evictions += 1
+            return None
+        try:
+            # Mark the file as recently used for every worker's eviction
+            os.utime(entry.path)
+        except OSError:
+            pass
+        return entry
+
+    def cached(self, key: str) -> bool:
+        """Whether fetch() would be served without downloading"""
+        return bool(_SAFE_KEY.match(key)) and self._lookup(key) is not None
+
+    async def fetch(self, key: str, destination: str, download: Callable[[str], Awaitable[str]]) -> str:
+        """
+        Link the file cached under `key` to `destination` (a path without
+        extension; the cached file's extension is appended) and return the
+        linked path. On a miss download(path) is called with a path without
+        extension to save the file and return the full path it wrote;
+        concurrent requests for the same key share one download.
+        """
+        if not _SAFE_KEY.match(key):
+            raise ValueError(f"Invalid cache key: {key!r}")
+
+        while True:
+            path = await self._get(key, download)
+            _, ext = os.path.splitext(path)
+            try:
+                link_or_copy(path, destination + ext)
+                return destination + ext
+            except FileNotFoundError:
+                # Evicted while we waited for a shared download; fetch it again
+                if key in self.entries and self.entries[key].path == path:
+                    self._remove(key)
+
+    async def _get(self, key: str, download: Callable[[str], Awaitable[str]]) -> str:
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry.path
+
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        staging = os.path.join(self.staging_dir, f"{key}-{uuid.uuid4().hex[:8]}")
+        try:
+            os.makedirs(staging)
+            downloaded = await download(os.path.join(staging, key))
+            _, ext = os.path.splitext(downloaded)
+            path = os.path.join(self.directory, f"{key}{ext.lower()}")
+            if key in self.entries:
+                self._remove(key)
+            os.replace(downloaded, path)
+
+            size = os.path.getsize(path)
+            self.entries[key] = CacheEntry(path, size)
+            self.total_bytes += size
+            self._evict(keep=key)
+            future.set_result(path)
+            return path
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Stand-in Telegram Bot API server for load tests
+
+Implements the calls the bot makes (getMe, getFile, file downloads,
+sendMessage, editMessageText, answerCallbackQuery, sendDocument,
+setWebhook, deleteWebhook, getWebhookInfo) with configurable latency,
+bandwidth and flood limits. Point the bot at it with
+TELEGRAM_API_BASE_URL=http://127.0.0.1:8081. load_test.py runs it next to
+its load generator; it can also be started on its own:
+
+    python fake_bot_api.py --port 8081 --latency-ms 50 --chat-rate 1
+
+Files are synthetic: a file_id of the form "<format>-<width>x<height>-<n>"
+(format jpg, png or heic) is served as a generated image of that size.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import re
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from benchmark import synthetic_photo
+from pdf_render import register_heif
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_img2pdf_bot'}
+
+FILE_ID_PATTERN = re.compile(r'^(jpg|png|heic)-(\d+)x(\d+)-(\d+)$')
+FILE_FORMATS = {'jpg': ('JPEG', 'image/jpeg'), 'png': ('PNG', 'image/png'), 'heic': ('HEIF', 'image/heic')}
+
+# Distinct images per format and size; file_ids cycle through them
+VARIANTS = 8
+
+# Methods subject to the flood limits (Telegram limits messages per chat and per bot)
+FLOOD_LIMITED_METHODS = {'sendMessage', 'editMessageText', 'sendDocument'}
+
+# Parameters that are sent as plain strings and must not be JSON-decoded
+TEXT_PARAMETERS = {'text', 'caption', 'url', 'secret_token', 'file_id', 'callback_query_id', 'filename'}
+
+
+class TelegramError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """`rate` calls per second with bursts of up to `burst` calls"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0, or the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeChat:
+    """What the bot sent to one chat"""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.last_message_id = 0
+        self.messages: Dict[int, dict] = {}  # message_id -> latest version of the bot's message
+        self.texts: List[tuple] = []  # (monotonic time, text) of every message sent or edited
+        self.documents: List[tuple] = []  # (monotonic time, message) of every document received
+        self.changed = asyncio.Condition()
+
+    def next_message_id(self) -> int:
+        self.last_message_id += 1
+        return self.last_message_id
+
+    def find_message(self, predicate: Callable[[dict], bool]) -> Optional[dict]:
+        for message in reversed(list(self.messages.values())):
+            if predicate(message):
+                return message
+        return None
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, bandwidth_mbps: float = 0,
+                 chat_rate: float = 0, chat_burst: float = 3, global_rate: float = 0,
+                 flood_probability: float = 0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.bandwidth = bandwidth_mbps * 1000 * 1000 / 8  # Bytes per second, 0: unlimited
+        self.chat_rate = chat_rate  # Flood-limited calls per chat and second, 0: unlimited
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate else None
+        self.flood_probability = flood_probability  # Chance of a random 429 on a flood-limited call
+        self.random = random.Random(seed)
+        self.chats: Dict[int, FakeChat] = {}
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.files: Dict[tuple, bytes] = {}
+        self.webhook = {'url': '', 'secret_token': None, 'allowed_updates': None}
+        self.calls: Dict[str, int] = {}
+        self.flood_rejections = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+
+    def chat(self, chat_id: int) -> FakeChat:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = FakeChat(chat_id)
+        return chat
+
+    async def wait_for(self, chat_id: int, predicate: Callable[[FakeChat], object], timeout: float):
+        """Wait until predicate(chat) returns something truthy and return it"""
+        chat = self.chat(chat_id)
+        async with chat.changed:
+            return await asyncio.wait_for(chat.changed.wait_for(lambda: predicate(chat)), timeout)
+
+    async def _notify(self, chat: FakeChat):
+        async with chat.changed:
+            chat.changed.notify_all()
+
+    async def delay(self, size: int = 0):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if size and self.bandwidth:
+            delay += size / self.bandwidth
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _check_flood(self, chat_id):
+        if self.flood_probability and self.random.random() < self.flood_probability:
+            self.flood_rejections += 1
+            raise TelegramError(429, "Too Many Requests: retry after 1", retry_after=1)
+
+        waits = []
+        if self.global_bucket:
+            waits.append(self.global_bucket.take())
+        if self.chat_rate and chat_id is not None:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            waits.append(bucket.take())
+        wait = max(waits, default=0)
+        if wait:
+            self.flood_rejections += 1
+            retry_after = max(1, round(wait))
+            raise TelegramError(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+
+    def file_content(self, file_id: str) -> bytes:
+        match = FILE_ID_PATTERN.match(file_id)
+        if not match:
+            raise TelegramError(400, "Bad Request: invalid file_id")
+        file_format = match.group(1)
+        width, height, number = (int(group) for group in match.group(2, 3, 4))
+        key = (file_format, width, height, number % VARIANTS)
+        content = self.files.get(key)
+        if content is None:
+            rng = random.Random(f"{file_format}:{width}x{height}:{key[3]}")
+            buffer = io.BytesIO()
+            if file_format == 'heic':
+                register_heif()
+            synthetic_photo(rng, (width, height)).save(buffer, FILE_FORMATS[file_format][0])
+            content = self.files[key] = buffer.getvalue()
+        return content
+
+    def _message(self, chat: FakeChat, **fields) -> dict:
+        message = {
+            'message_id': chat.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat.chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            **fields,
+        }
+        chat.messages[message['message_id']] = message
+        return message
+
+    # Bot API methods, called with the decoded parameters
+
+    def getMe(self, params: dict, files: dict):
+        return BOT_USER
+
+    def getFile(self, params: dict, files: dict):
+        file_id = params.get('file_id', '')
+        content = self.file_content(file_id)
+        extension = file_id.split('-', 1)[0]
+        return {
+            'file_id': file_id,
+            'file_unique_id': f"u{file_id}",
+            'file_size': len(content),
+            'file_path': f"files/{file_id}.{extension}",
+        }
+
+    async def sendMessage(self, params: dict, files: dict):
+        chat = self.chat(params['chat_id'])
+        message = self._message(chat, text=params.get('text', ''))
+        if params.get('reply_markup'):
+            message['reply_markup'] = params['reply_markup']
+        chat.texts.append((time.monotonic(), message['text']))
+        await self._notify(chat)
+        return message
+
+    async def editMessageText(self, params: dict, files: dict):
+        chat = self.chat(params['chat_id'])
+        message = chat.messages.get(params.get('message_id'))
+        if message is None:
+            raise TelegramError(400, "Bad Request: message to edit not found")
+        text, reply_markup = params.get('text', ''), params.get('reply_markup')
+        if message['text'] == text and message.get('reply_markup') == reply_markup:
+            raise TelegramError(400, "Bad Request: message is not modified")
+        message.update(text=text, edit_date=int(time.time()))
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        else:
+            message.pop('reply_markup', None)
+        chat.texts.append((time.monotonic(), text))
+        await self._notify(chat)
+        return message
+
+    def answerCallbackQuery(self, params: dict, files: dict):
+        return True
+
+    async def sendDocument(self, params: dict, files: dict):
+        chat = self.chat(params['chat_id'])
+        upload = files.get('document')
+        if upload is not None:
+            file_name, content = upload
+            await self.delay(len(content))
+            self.bytes_uploaded += len(content)
+            document = {'file_id': f"doc-{len(chat.documents)}-{chat.chat_id}", 'file_unique_id':
+                        f"udoc-{len(chat.documents)}-{chat.chat_id}", 'file_name': file_name,
+                        'mime_type': 'application/pdf', 'file_size': len(content)}
+        elif params.get('document'):
+            # Resent by file_id
+            document = {'file_id': params['document'], 'file_unique_id': f"u{params['document']}"}
+        else:
+            raise TelegramError(400, "Bad Request: there is no document in the request")
+        message = self._message(chat, document=document, caption=params.get('caption', ''))
+        chat.documents.append((time.monotonic(), message))
+        await self._notify(chat)
+        return message
+
+    def setWebhook(self, params: dict, files: dict):
+        self.webhook = {
+            'url': params.get('url', ''),
+            'secret_token': params.get('secret_token'),
+            'allowed_updates': params.get('allowed_updates'),
+        }
+        return True
+
+    def deleteWebhook(self, params: dict, files: dict):
+        self.webhook = {'url': '', 'secret_token': None, 'allowed_updates': None}
+        return True
+
+    def getWebhookInfo(self, params: dict, files: dict):
+        info = {'url': self.webhook['url'], 'has_custom_certificate': False, 'pending_update_count': 0}
+        if self.webhook['allowed_updates'] is not None:
+            info['allowed_updates'] = self.webhook['allowed_updates']
+        return info
+
+    async def call(self, method: str, params: dict, files: dict):
+        handler = getattr(self, method, None)
+        if handler is None or method.startswith('_') or not method[0].islower():
+            raise TelegramError(404, "Not Found: method not found")
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await self.delay()
+        if method in FLOOD_LIMITED_METHODS:
+            self._check_flood(params.get('chat_id'))
+        result = handler(params, files)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'calls': dict(sorted(self.calls.items())),
+            'flood_rejections': self.flood_rejections,
+            'documents': sum(len(chat.documents) for chat in self.chats.values()),
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_uploaded': self.bytes_uploaded,
+            'webhook': self.webhook,
+        }
+
+
+def _decode_value(name: str, value: str):
+    if name in TEXT_PARAMETERS:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_parameters(body: bytes, content_type: str) -> tuple:
+    """(params, files) of a Bot API request; files maps names to (file name, content)"""
+    params, files = {}, {}
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            content = part.get_payload(decode=True)
+            if part.get_filename():
+                files[name] = (part.get_filename(), content)
+            else:
+                params[name] = _decode_value(name, content.decode('utf-8'))
+    elif content_type.startswith('application/json'):
+        params = json.loads(body or b'{}')
+    else:
+        params = {name: _decode_value(name, values[0]) for name, values in parse_qs(body.decode('utf-8')).items()}
+    return params, files
+
+
+def create_app(api: FakeBotAPI) -> FastAPI:
+    app = FastAPI(title="Fake Telegram Bot API")
+
+    def error(e: TelegramError) -> JSONResponse:
+        content = {'ok': False, 'error_code': e.code, 'description': e.description}
+        if e.retry_after is not None:
+            content['parameters'] = {'retry_after': e.retry_after}
+        return JSONResponse(content, status_code=e.code)
+
+    @app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def bot_method(token: str, method: str, request: Request):
+        params, files = parse_parameters(await request.body(), request.headers.get('content-type', ''))
+        params.update(request.query_params)
+        try:
+            return {'ok': True, 'result': await api.call(method, params, files)}
+        except TelegramError as e:
+            return error(e)
+
+    @app.get("/file/bot{token}/files/{file_name}")
+    async def download(token: str, file_name: str):
+        file_id, _, extension = file_name.rpartition('.')
+        try:
+            content = api.file_content(file_id)
+        except TelegramError as e:
+            return error(e)
+        await api.delay(len(content))
+        api.bytes_downloaded += len(content)
+        return Response(content, media_type=FILE_FORMATS[extension][1])
+
+    @app.get("/stats")
+    async def stats():
+        return api.stats()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every call and download")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency up to this value")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0, help="Download/upload bandwidth (0: unlimited)")
+    parser.add_argument("--chat-rate", type=float, default=0, help="Messages per chat and second (0: unlimited)")
+    parser.add_argument("--chat-burst", type=float, default=3, help="Burst allowed by --chat-rate")
+    parser.add_argument("--global-rate", type=float, default=0, help="Messages per second overall (0: unlimited)")
+    parser.add_argument("--flood-probability", type=float, default=0, help="Chance of a random 429 per message")
+    args = parser.parse_args()
+
+    import uvicorn
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.bandwidth_mbps, args.chat_rate, args.chat_burst,
+                     args.global_rate, args.flood_probability)
+    print(f"✅ Fake Bot API on http://{args.host}:{args.port} (TELEGRAM_API_BASE_URL=http://{args.host}:{args.port})")
+    uvicorn.run(create_app(api), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
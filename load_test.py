@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the webhook path
+
+Runs the fake Bot API server (fake_bot_api.py) and POSTs realistic updates
+to the bot's /webhook endpoint: bursts of single photos, albums, image
+documents and a "Generate PDF" tap at the end of every session. Sessions
+start at a controlled rate (Poisson arrivals) and the run reports p50/p90/
+p99 latencies, throughput and error rates.
+
+Start the bot against the fake API yourself:
+
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 BOT_TOKEN=123456:fake \\
+        uvicorn telegram_img2pdf_bot:app --port 8000
+    python load_test.py --bot-url http://127.0.0.1:8000 --sessions 100 --rate 5
+
+or let load_test.py start it (--spawn-bot). Like Telegram, webhook calls
+answered with 429 or 503 are retried after their Retry-After.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+
+from fake_bot_api import BOT_USER, FakeBotAPI, FakeChat, create_app
+
+# Simulated users get ids from here on (one user per session)
+BASE_USER_ID = 5000000
+
+SCENARIOS = ('single', 'burst', 'album', 'document')
+
+# Telegram allows at most 10 items per album
+MAX_ALBUM_SIZE = 10
+
+# Webhook calls answered with 429/503 are retried this many times
+MAX_WEBHOOK_ATTEMPTS = 5
+
+FAKE_TOKEN = '123456:fake-token-for-load-tests'
+
+
+def percentiles(values: List[float]) -> dict:
+    """p50/p90/p99/max in milliseconds (nearest rank)"""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+    return {'count': len(ordered), 'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99),
+            'max': round(ordered[-1] * 1000, 1)}
+
+
+def status_shows(pages: int):
+    """Matches the bot's status message once it counts `pages` images (see build_status_text)"""
+    needle = f"Currently have {pages} image"
+
+    def predicate(message: dict) -> bool:
+        markup = json.dumps(message.get('reply_markup') or {})
+        return needle in message.get('text', '') and 'generate_pdf' in markup
+
+    return predicate
+
+
+def pdf_sent(chat: FakeChat, since: float) -> Optional[float]:
+    """When the bot reported the PDF (every part of it) as sent after `since`"""
+    for sent, text in chat.texts:
+        if sent >= since and text.startswith('✅ PDF sent'):
+            return sent
+    return None
+
+
+def bot_error(chat: FakeChat, since: float) -> Optional[str]:
+    """First error reply the bot sent to the chat after `since`"""
+    for sent, text in chat.texts:
+        if sent >= since and text.startswith('❌'):
+            return text
+    return None
+
+
+class LoadTest:
+    def __init__(self, api: FakeBotAPI, bot_url: str, secret_token: str = None, image_size: tuple = (1280, 960),
+                 pages: tuple = (1, 10), mix: Dict[str, float] = None, gap: float = 0.05, think: float = 0.5,
+                 timeout: float = 120, seed: int = 0):
+        self.api = api
+        self.webhook_url = f"{bot_url.rstrip('/')}/webhook"
+        self.headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+        self.image_size = image_size
+        self.pages = pages  # Images per session (min, max)
+        self.mix = mix or {scenario: 1 for scenario in SCENARIOS}
+        self.gap = gap  # Seconds between the messages of a burst
+        self.think = think  # Seconds between the last status update and the Generate PDF tap
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        # Unique per run so the bot's download and result caches never answer for us
+        self.run_id = uuid.uuid4().hex[:8]
+        self.update_id = 0
+        self.file_number = 0
+        self.client: httpx.AsyncClient = None
+
+        self.webhook_latencies: List[float] = []
+        self.webhook_statuses: Dict[int, int] = {}
+        self.webhook_retries = 0
+        self.status_latencies: List[float] = []  # Last image posted -> status shows every image
+        self.document_latencies: List[float] = []  # Generate PDF posted -> (first) document received
+        self.pdf_latencies: List[float] = []  # Generate PDF posted -> bot reports every part sent
+        self.session_latencies: List[float] = []  # First image posted -> bot reports every part sent
+        self.outcomes: Dict[str, int] = {}
+        self.errors: List[str] = []
+        self.updates = 0
+        self.pages_sent = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Load {user_id}", 'language_code': 'en'}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self.update_id += 1
+        return {
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.api.chat(user_id).next_message_id(),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': f"Load {user_id}"},
+                'from': self._user(user_id),
+                **fields,
+            },
+        }
+
+    def _file(self, file_format: str) -> tuple:
+        self.file_number += 1
+        width, height = self.image_size
+        file_id = f"{file_format}-{width}x{height}-{self.file_number}"
+        # Roughly what Telegram reports; the fake API serves the real size
+        return file_id, f"{self.run_id}-{self.file_number}", width * height // 4
+
+    def photo_update(self, user_id: int, media_group_id: str = None) -> dict:
+        file_id, unique_id, size = self._file('jpg')
+        width, height = self.image_size
+        photo = [
+            {'file_id': f"jpg-90x68-{self.file_number}", 'file_unique_id': f"t{unique_id}",
+             'width': 90, 'height': 68, 'file_size': 1500},
+            {'file_id': file_id, 'file_unique_id': unique_id, 'width': width, 'height': height, 'file_size': size},
+        ]
+        fields = {'photo': photo}
+        if media_group_id:
+            fields['media_group_id'] = media_group_id
+        return self._message(user_id, **fields)
+
+    def document_update(self, user_id: int) -> dict:
+        file_format = self.random.choice(('jpg', 'png'))
+        file_id, unique_id, size = self._file(file_format)
+        return self._message(user_id, document={
+            'file_id': file_id, 'file_unique_id': unique_id, 'file_name': f"scan_{self.file_number}.{file_format}",
+            'mime_type': f"image/{'jpeg' if file_format == 'jpg' else file_format}", 'file_size': size,
+        })
+
+    def callback_update(self, user_id: int, message: dict, data: str = 'generate_pdf') -> dict:
+        self.update_id += 1
+        return {
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': f"{self.run_id}-{self.update_id}",
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': message['message_id'],
+                    'date': message['date'],
+                    'chat': message['chat'],
+                    'from': BOT_USER,
+                    'text': message['text'],
+                },
+            },
+        }
+
+    async def post(self, update: dict) -> bool:
+        """Deliver an update like Telegram does, retrying 429/503 answers; False if it was never accepted"""
+        self.updates += 1
+        for _ in range(MAX_WEBHOOK_ATTEMPTS):
+            started = time.monotonic()
+            try:
+                response = await self.client.post(self.webhook_url, json=update, headers=self.headers)
+            except httpx.HTTPError as e:
+                self.webhook_statuses[0] = self.webhook_statuses.get(0, 0) + 1
+                self.errors.append(f"webhook: {e!r}")
+                return False
+            self.webhook_latencies.append(time.monotonic() - started)
+            self.webhook_statuses[response.status_code] = self.webhook_statuses.get(response.status_code, 0) + 1
+            if response.status_code < 300:
+                return True
+            if response.status_code not in (429, 503):
+                self.errors.append(f"webhook: HTTP {response.status_code} {response.text[:200]}")
+                return False
+            self.webhook_retries += 1
+            await asyncio.sleep(min(float(response.headers.get('Retry-After', 1)), 10))
+        return False
+
+    def _outcome(self, outcome: str):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def run_session(self, index: int):
+        user_id = BASE_USER_ID + index
+        chat = self.api.chat(user_id)
+        scenario = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        pages = 1 if scenario == 'single' else self.random.randint(*self.pages)
+        if scenario == 'album':
+            pages = min(pages, MAX_ALBUM_SIZE)
+        loop_started = time.monotonic()
+
+        if scenario == 'album':
+            media_group_id = f"{self.run_id}{index}"
+            updates = [self.photo_update(user_id, media_group_id) for _ in range(pages)]
+            # Album items arrive as separate, nearly simultaneous webhook calls
+            accepted = await asyncio.gather(*(self.post(update) for update in updates))
+        else:
+            accepted = []
+            for number in range(pages):
+                if number:
+                    await asyncio.sleep(self.gap)
+                update = self.document_update(user_id) if scenario == 'document' else self.photo_update(user_id)
+                accepted.append(await self.post(update))
+        if not all(accepted):
+            return self._outcome('rejected')
+        self.pages_sent += pages
+        last_posted = time.monotonic()
+
+        def status_or_error(chat: FakeChat):
+            return chat.find_message(status_shows(pages)) or bot_error(chat, loop_started)
+
+        try:
+            status = await self.api.wait_for(user_id, status_or_error, self.timeout)
+        except asyncio.TimeoutError:
+            return self._outcome('timeout')
+        if isinstance(status, str):
+            self.errors.append(f"{scenario}: {status}")
+            return self._outcome('bot_error')
+        self.status_latencies.append(time.monotonic() - last_posted)
+
+        await asyncio.sleep(self.think)
+        generate_posted = time.monotonic()
+        if not await self.post(self.callback_update(user_id, status)):
+            return self._outcome('rejected')
+
+        def sent_or_error(chat: FakeChat):
+            return bot_error(chat, generate_posted) or pdf_sent(chat, generate_posted)
+
+        try:
+            finished = await self.api.wait_for(user_id, sent_or_error, self.timeout)
+        except asyncio.TimeoutError:
+            return self._outcome('timeout')
+        if isinstance(finished, str):
+            self.errors.append(f"{scenario}: {finished}")
+            return self._outcome('bot_error')
+        documents = [sent for sent, _ in chat.documents if sent >= generate_posted]
+        if not documents:
+            self.errors.append(f"{scenario}: PDF reported as sent without a document")
+            return self._outcome('bot_error')
+        self.document_latencies.append(documents[0] - generate_posted)
+        self.pdf_latencies.append(finished - generate_posted)
+        self.session_latencies.append(finished - loop_started)
+        self._outcome('ok')
+
+    async def run(self, sessions: int, rate: float) -> dict:
+        limits = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+        started = time.monotonic()
+        async with httpx.AsyncClient(timeout=30, limits=limits) as self.client:
+            tasks = []
+            for index in range(sessions):
+                if index:
+                    # Poisson arrivals at `rate` sessions per second
+                    await asyncio.sleep(self.random.expovariate(rate))
+                tasks.append(asyncio.create_task(self.run_session(index)))
+            await asyncio.gather(*tasks)
+        duration = time.monotonic() - started
+
+        failed = sessions - self.outcomes.get('ok', 0)
+        return {
+            'sessions': sessions,
+            'rate': rate,
+            'duration_s': round(duration, 2),
+            'outcomes': self.outcomes,
+            'error_rate': round(failed / sessions, 4) if sessions else 0,
+            'throughput': {
+                'pdfs_per_s': round(self.outcomes.get('ok', 0) / duration, 3),
+                'pages_per_s': round(self.pages_sent / duration, 3),
+                'updates_per_s': round(self.updates / duration, 3),
+            },
+            'webhook': {
+                'statuses': {str(status): count for status, count in sorted(self.webhook_statuses.items())},
+                'retries': self.webhook_retries,
+                'latency_ms': percentiles(self.webhook_latencies),
+            },
+            'latency_ms': {
+                'images_to_status': percentiles(self.status_latencies),
+                'generate_to_document': percentiles(self.document_latencies),
+                'generate_to_pdf': percentiles(self.pdf_latencies),
+                'session': percentiles(self.session_latencies),
+            },
+            'fake_api': self.api.stats(),
+            'errors': self.errors[:20],
+        }
+
+
+def print_report(report: dict):
+    outcomes = ', '.join(f"{outcome} {count}" for outcome, count in sorted(report['outcomes'].items()))
+    print(f"\nSessions: {report['sessions']} in {report['duration_s']}s ({outcomes}), "
+          f"error rate {report['error_rate'] * 100:.1f}%")
+    throughput = report['throughput']
+    print(f"Throughput: {throughput['pdfs_per_s']} PDFs/s, {throughput['pages_per_s']} pages/s, "
+          f"{throughput['updates_per_s']} updates/s")
+    webhook = report['webhook']
+    statuses = ', '.join(f"{status}: {count}" for status, count in webhook['statuses'].items())
+    print(f"Webhook responses: {statuses}, retries {webhook['retries']}")
+
+    print(f"\n{'Latency (ms)':<22}{'count':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    rows = [('webhook POST', webhook['latency_ms'])] + list(report['latency_ms'].items())
+    for name, stats in rows:
+        if stats['count']:
+            print(f"{name:<22}{stats['count']:>7}{stats['p50']:>10}{stats['p90']:>10}{stats['p99']:>10}"
+                  f"{stats['max']:>10}")
+        else:
+            print(f"{name:<22}{0:>7}")
+
+    api = report['fake_api']
+    print(f"\nFake API: {api['calls']}, flood 429s {api['flood_rejections']}, "
+          f"{api['bytes_downloaded'] / 1024 / 1024:.1f}MB downloaded, {api['bytes_uploaded'] / 1024 / 1024:.1f}MB uploaded")
+    for error in report['errors']:
+        print(f"❌ {error}")
+
+
+async def wait_until_ready(client: httpx.AsyncClient, bot_url: str, timeout: float,
+                           bot_process: subprocess.Popen = None):
+    deadline = time.monotonic() + timeout
+    while True:
+        if bot_process and bot_process.poll() is not None:
+            raise RuntimeError(f"Bot exited with status {bot_process.returncode} during startup")
+        try:
+            response = await client.get(f"{bot_url.rstrip('/')}/health")
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Bot at {bot_url} did not become ready within {timeout:.0f}s")
+        await asyncio.sleep(0.5)
+
+
+def spawn_bot(bot_url: str, api_base_url: str, secret_token: str) -> subprocess.Popen:
+    port = httpx.URL(bot_url).port or 8000
+    env = dict(os.environ, TELEGRAM_API_BASE_URL=api_base_url, WEBHOOK_URL=bot_url)
+    env.setdefault('BOT_TOKEN', FAKE_TOKEN)
+    if secret_token:
+        env['WEBHOOK_SECRET_TOKEN'] = secret_token
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'telegram_img2pdf_bot:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning'],
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(','):
+        scenario, _, weight = item.partition('=')
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {scenario!r} (choose from {', '.join(SCENARIOS)})")
+        mix[scenario] = float(weight or 1)
+    return mix
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.bandwidth_mbps, args.chat_rate, args.chat_burst,
+                     args.global_rate, args.flood_probability, args.seed)
+    server = uvicorn.Server(uvicorn.Config(create_app(api), host=args.api_host, port=args.api_port,
+                                           log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            raise RuntimeError(f"Fake Bot API could not start on port {args.api_port}")
+        await asyncio.sleep(0.05)
+    api_base_url = f"http://{args.api_host}:{args.api_port}"
+    print(f"✅ Fake Bot API listening on {api_base_url}")
+
+    secret_token = args.secret or os.getenv('WEBHOOK_SECRET_TOKEN')
+    bot_process = spawn_bot(args.bot_url, api_base_url, secret_token) if args.spawn_bot else None
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            await wait_until_ready(client, args.bot_url, args.ready_timeout, bot_process)
+        print(f"✅ Bot ready at {args.bot_url}, starting {args.sessions} sessions at {args.rate}/s")
+
+        width, height = (int(value) for value in args.image_size.split('x'))
+        pages = tuple(int(value) for value in args.pages.split('-')) if '-' in args.pages else (int(args.pages),) * 2
+        load_test = LoadTest(api, args.bot_url, secret_token, (width, height), pages, args.mix,
+                             args.gap_ms / 1000, args.think_ms / 1000, args.timeout, args.seed)
+        return await load_test.run(args.sessions, args.rate)
+    finally:
+        if bot_process:
+            bot_process.terminate()
+            # The fake API keeps answering while the bot finishes its last calls
+            await asyncio.to_thread(bot_process.wait, 30)
+        server.should_exit = True
+        await server_task
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Webhook load test against a fake Telegram Bot API")
+    parser.add_argument("--bot-url", default="http://127.0.0.1:8000", help="Base URL of the bot under test")
+    parser.add_argument("--spawn-bot", action="store_true", help="Start the bot (uvicorn) against the fake API")
+    parser.add_argument("--secret", help="Webhook secret token (or WEBHOOK_SECRET_TOKEN)")
+    parser.add_argument("--sessions", type=int, default=50, help="User sessions to run")
+    parser.add_argument("--rate", type=float, default=2, help="New sessions per second")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="Scenario weights, e.g. single=1,burst=4,album=3,document=2 (default: equal)")
+    parser.add_argument("--pages", default="2-10", help="Images per session, N or MIN-MAX")
+    parser.add_argument("--image-size", default="1280x960", help="Size of the generated images")
+    parser.add_argument("--gap-ms", type=float, default=50, help="Time between the messages of a burst")
+    parser.add_argument("--think-ms", type=float, default=500, help="Time before tapping Generate PDF")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for each bot reply")
+    parser.add_argument("--ready-timeout", type=float, default=60, help="Seconds to wait for the bot's /health")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report as JSON")
+
+    fake = parser.add_argument_group("fake Bot API")
+    fake.add_argument("--api-host", default="127.0.0.1")
+    fake.add_argument("--api-port", type=int, default=8081)
+    fake.add_argument("--latency-ms", type=float, default=0, help="Added to every call and download")
+    fake.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency up to this value")
+    fake.add_argument("--bandwidth-mbps", type=float, default=0, help="Download/upload bandwidth (0: unlimited)")
+    fake.add_argument("--chat-rate", type=float, default=0, help="Messages per chat and second (0: unlimited)")
+    fake.add_argument("--chat-burst", type=float, default=3, help="Burst allowed by --chat-rate")
+    fake.add_argument("--global-rate", type=float, default=0, help="Messages per second overall (0: unlimited)")
+    fake.add_argument("--flood-probability", type=float, default=0, help="Chance of a random 429 per message")
+
+    args = parser.parse_args()
+
+    try:
+        report = asyncio.run(run(args))
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+        print(f"✅ Report saved to {args.output}")
+    return 0 if not report['error_rate'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Media group (album) collection
+
+Telegram delivers an album as separate updates that share a
+media_group_id. The collector gathers them until no new item has arrived
+for a short window and then hands the whole album to a batch handler, so
+an album is downloaded, registered and acknowledged once instead of going
+through N independent handler runs.
+
+Albums are collected in the process that receives them. wait_for_user()
+cannot see albums being collected by other worker processes, which is why
+several workers sharing the SQLite session store should sit behind the
+sharding front process.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for further items of an album before processing it
+MEDIA_GROUP_WAIT = int(os.getenv('MEDIA_GROUP_WAIT_MS', 800)) / 1000
+
+
+class MediaGroupItem:
+    def __init__(self, update, context, file_id: str, extension: str = None, file_unique_id: str = None,
+                 file_size: int = None):
+        self.update = update
+        self.context = context
+        self.file_id = file_id
+        self.extension = extension  # None: derive from the file path Telegram reports
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+
+    @property
+    def message_id(self) -> int:
+        return self.update.message.message_id
+
+    @property
+    def update_id(self) -> int:
+        return self.update.update_id
+
+
+class MediaGroup:
+    def __init__(self):
+        self.items: List[MediaGroupItem] = []
+        self.timer: asyncio.TimerHandle = None
+        self.task: asyncio.Task = None
+        self.done = asyncio.Event()
+
+
+class MediaGroupCollector:
+    def __init__(self, process_batch: Callable[[int, List[MediaGroupItem]], Awaitable], wait: float = MEDIA_GROUP_WAIT):
+        self.process_batch = process_batch
+        self.wait = wait
+        self.collecting: Dict[Tuple[int, str], MediaGroup] = {}
+        # Keyed by group: items of an album arriving after it was closed form
+        # a second group with the same key that may be processed alongside
+        self.processing: Dict[MediaGroup, Tuple[int, str]] = {}
+
+    def add(self, user_id: int, media_group_id: str, item: MediaGroupItem):
+        """Add an album item; the album is processed once it has been quiet for `wait` seconds"""
+        key = (user_id, media_group_id)
+        group = self.collecting.get(key)
+        if group is None:
+            group = self.collecting[key] = MediaGroup()
+        group.items.append(item)
+
+        if group.timer:
+            group.timer.cancel()
+        group.timer = asyncio.get_running_loop().call_later(self.wait, self._close, key)
+
+    def _close(self, key: Tuple[int, str]):
+        group = self.collecting.pop(key)
+        group.timer.cancel()
+        self.processing[group] = key
+        group.task = asyncio.create_task(self._process(key, group))
+
+    async def _process(self, key: Tuple[int, str], group: MediaGroup):
+        user_id, media_group_id = key
+        logger.info(f"[User {user_id}] Processing album {media_group_id} with {len(group.items)} items")
+        try:
+            await self.process_batch(user_id, group.items)
+        except Exception as e:
+            logger.error(f"[User {user_id}] Error processing album {media_group_id}: {e}")
+        finally:
+            group.done.set()
+            del self.processing[group]
+
+    async def wait_for_user(self, user_id: int):
+        """Process the user's albums right away and wait until they are registered"""
+        for key in [key for key in self.collecting if key[0] == user_id]:
+            self._close(key)
+        groups = [group for group, key in self.processing.items() if key[0] == user_id]
+        for group in groups:
+            await group.done.wait()
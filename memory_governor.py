@@ -0,0 +1,172 @@
+"""
+Memory-pressure governor
+
+Samples the process RSS every few seconds and, while it is above the
+configured levels, takes increasingly disruptive actions in this order:
+
+1. trim: return free heap memory to the OS (glibc malloc_trim). Pillow's
+   freed buffers otherwise stay mapped and RSS creeps toward pm2's
+   max_memory_restart.
+2. evict: remove the least recently active sessions that have been idle
+   for a while, before their regular expiry.
+3. throttle: halve the render concurrency (restored one step at a time
+   once RSS is back below the trim level).
+4. collect: run a full garbage collection.
+
+Each step is taken only if RSS is still above its level after the previous
+one. Every action is logged and counted (see stats()).
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from render_pool import RenderPool
+from session_store import SessionStore
+
+logger = logging.getLogger(__name__)
+
+
+def _load_malloc_trim() -> Optional[Callable[[int], int]]:
+    """glibc's malloc_trim, or None on other C libraries"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        malloc_trim = libc.malloc_trim
+    except (OSError, AttributeError):
+        return None
+    malloc_trim.argtypes = [ctypes.c_size_t]
+    malloc_trim.restype = ctypes.c_int
+    return malloc_trim
+
+
+class MemoryGovernor:
+    ACTIONS = ('trim', 'evict', 'throttle', 'collect')
+
+    def __init__(self, sessions: SessionStore, render_pool: RenderPool, trim_mb: float = 120, evict_mb: float = 140,
+                 throttle_mb: float = 150, collect_mb: float = 160, interval: float = 5, evict_idle: float = 300,
+                 evict_batch: int = 50):
+        # A level of 0 disables that action
+        self.levels = {'trim': trim_mb, 'evict': evict_mb, 'throttle': throttle_mb, 'collect': collect_mb}
+        self.sessions = sessions
+        self.render_pool = render_pool
+        self.interval = interval
+        self.evict_idle = evict_idle  # Only sessions idle this many seconds are evicted early
+        self.evict_batch = evict_batch  # Sessions evicted per check
+        self._process = None
+        self.malloc_trim = _load_malloc_trim()
+        self.counts = {action: 0 for action in self.ACTIONS}
+        self.evicted_sessions = 0
+        self.rss_mb = 0.0
+        self.task: asyncio.Task = None
+
+    @classmethod
+    def from_env(cls, sessions: SessionStore, render_pool: RenderPool) -> 'MemoryGovernor':
+        return cls(
+            sessions,
+            render_pool,
+            trim_mb=float(os.getenv('MEMORY_TRIM_MB', 120)),
+            evict_mb=float(os.getenv('MEMORY_EVICT_MB', 140)),
+            throttle_mb=float(os.getenv('MEMORY_THROTTLE_MB', 150)),
+            collect_mb=float(os.getenv('MEMORY_COLLECT_MB', 160)),
+            interval=float(os.getenv('MEMORY_CHECK_INTERVAL', 5)),
+            evict_idle=float(os.getenv('MEMORY_EVICT_IDLE', 300)),
+            evict_batch=int(os.getenv('MEMORY_EVICT_BATCH', 50)),
+        )
+
+    @property
+    def process(self):
+        # psutil is imported on first use to keep it out of startup
+        if self._process is None:
+            import psutil
+            self._process = psutil.Process()
+        return self._process
+
+    def sample(self) -> float:
+        self.rss_mb = self.process.memory_info().rss / 1024 / 1024
+        return self.rss_mb
+
+    def _above(self, action: str, rss_mb: float) -> bool:
+        level = self.levels[action]
+        return bool(level) and rss_mb >= level
+
+    def trim(self) -> bool:
+        if self.malloc_trim is None:
+            return False
+        self.malloc_trim(0)
+        return True
+
+    async def evict(self) -> bool:
+        cutoff = datetime.now() - timedelta(seconds=self.evict_idle)
+        evicted = await self.sessions.remove_expired(cutoff, limit=self.evict_batch)
+        self.evicted_sessions += len(evicted)
+        return bool(evicted)
+
+    async def throttle(self) -> bool:
+        if self.render_pool.concurrency <= 1:
+            return False
+        await self.render_pool.set_concurrency(self.render_pool.concurrency // 2)
+        return True
+
+    def collect(self) -> bool:
+        gc.collect()
+        return True
+
+    async def check(self):
+        """Sample RSS once and take the actions its level calls for"""
+        rss_mb = self.sample()
+
+        if self.render_pool.concurrency < self.render_pool.workers and not self._above('trim', rss_mb):
+            await self.render_pool.set_concurrency(self.render_pool.concurrency + 1)
+            logger.info(f"Memory at {rss_mb:.0f}MB, render concurrency raised to {self.render_pool.concurrency}")
+
+        for action in self.ACTIONS:
+            if not self._above(action, rss_mb):
+                continue
+            result = getattr(self, action)()
+            if asyncio.iscoroutine(result):
+                result = await result
+            if not result:
+                continue
+
+            self.counts[action] += 1
+            before, rss_mb = rss_mb, self.sample()
+            detail = f", render concurrency {self.render_pool.concurrency}" if action == 'throttle' else ''
+            # Trimming is routine while RSS sits above the first level
+            log = logger.info if action == 'trim' else logger.warning
+            log(
+                f"Memory pressure: {action} at {before:.0f}MB (level {self.levels[action]:.0f}MB), "
+                f"now {rss_mb:.0f}MB{detail}"
+            )
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Memory governor check failed: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            'rss_mb': round(self.rss_mb, 1),
+            'levels': self.levels,
+            'actions': dict(self.counts),
+            'evicted_sessions': self.evicted_sessions,
+            'render_concurrency': self.render_pool.concurrency,
+            'malloc_trim': self.malloc_trim is not None,
+        }
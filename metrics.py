@@ -0,0 +1,91 @@
+"""
+Prometheus metrics
+
+Histograms are observed where the work happens; gauges describing the
+current state (sessions, queues, disk and memory use) are refreshed when
+/metrics is scraped. Process metrics such as process_resident_memory_bytes
+come from prometheus_client's default process collector. Each process
+exposes its own metrics: scrape every shard worker (or every uvicorn
+worker) separately.
+"""
+
+import os
+from typing import Iterable
+
+from prometheus_client import Counter, Gauge, Histogram
+from telegram.request import HTTPXRequest
+
+from pdf_render import PreparedPage
+
+# Request handling stages: 5 ms up to a minute
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Single page preparation steps: 1 ms up to 10 s
+PAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+STAGE_SECONDS = Histogram(
+    'img2pdf_stage_seconds',
+    'Time spent in a processing stage (webhook_parse, get_file, download, probe, finalize, upload)',
+    ['stage'],
+    buckets=STAGE_BUCKETS,
+)
+PAGE_STEP_SECONDS = Histogram(
+    'img2pdf_page_step_seconds',
+    'Time spent preparing one page, by step (passthrough, decode, convert, encode)',
+    ['step'],
+    buckets=PAGE_BUCKETS,
+)
+IMAGES_REJECTED = Counter(
+    'img2pdf_images_rejected_total',
+    'Images rejected after probing their header, by reason (too_large, unreadable)',
+    ['reason'],
+)
+TELEGRAM_API_SECONDS = Histogram(
+    'img2pdf_telegram_api_seconds',
+    'Latency of Telegram Bot API calls by method (file downloads as file_download)',
+    ['method'],
+    buckets=STAGE_BUCKETS,
+)
+
+ACTIVE_SESSIONS = Gauge('img2pdf_active_sessions', 'User sessions currently stored')
+QUEUED_UPDATES = Gauge('img2pdf_queued_updates', 'Updates waiting in the dispatcher queue')
+UPDATES_IN_FLIGHT = Gauge('img2pdf_updates_in_flight', 'Updates being processed')
+RENDERS_QUEUED = Gauge('img2pdf_renders_queued', 'Render jobs waiting for a worker')
+RENDERS_IN_FLIGHT = Gauge('img2pdf_renders_in_flight', 'Render jobs running in a worker')
+RENDER_PIXELS_IN_FLIGHT = Gauge('img2pdf_render_pixels_in_flight', 'Decoded pixels of the running render jobs')
+SESSION_DISK_BYTES = Gauge('img2pdf_session_disk_bytes', 'Bytes in session temporary directories')
+SESSION_MEMORY_BYTES = Gauge('img2pdf_session_memory_bytes', 'Bytes of session images kept in memory')
+STARTUP_SECONDS = Gauge(
+    'img2pdf_startup_seconds',
+    'Time from loading the bot module to readiness, by phase (imports, setup, total)',
+    ['phase'],
+)
+
+
+def observe_page(page: PreparedPage):
+    for step, seconds in page.timings.items():
+        PAGE_STEP_SECONDS.labels(step).observe(seconds)
+
+
+def directory_bytes(paths: Iterable[str]) -> int:
+    """Total size of the files below the given directories (missing ones count as empty)"""
+    total = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    # Removed while walking
+                    pass
+    return total
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the latency of every Bot API call and file download"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        # API URLs end in the method name; file URLs would put the file path (and token) in the label
+        endpoint = 'file_download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        with TELEGRAM_API_SECONDS.labels(endpoint).time():
+            return await super().do_request(url, method, request_data, *args, **kwargs)
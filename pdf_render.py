@@ -0,0 +1,670 @@
+"""
+Image to PDF rendering
+
+Turns the images of a session into PDF pages one at a time: open, convert,
+encode, write, release. Only the page currently being written is held in
+memory, so peak usage does not grow with the number of images.
+
+JPEG files are not decoded at all when the PDF can carry them as they are:
+only the header is parsed and the original bytes are copied into the page as
+a DCTDecode stream.
+
+Page profiles fit every image onto a fixed paper size at a target resolution.
+Images with more pixels than the page needs are decoded at reduced scale
+(JPEG draft mode) and downscaled before encoding.
+
+Compression profiles pick the JPEG quality and can classify pages from their
+histograms: colorless pages are stored as grayscale and text-like pages as
+1-bit images (CCITT G4, or Flate when libtiff is missing).
+"""
+
+import importlib.util
+import io
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import BinaryIO, Dict, List, Optional, Union
+
+from PIL import Image, features
+
+from pdf_writer import PDF_HEADER, StreamingPDFWriter
+
+logger = logging.getLogger(__name__)
+
+# pillow-heif (which loads libheif) is imported when the first image is
+# opened rather than with this module, see register_heif()
+HEIF_AVAILABLE = importlib.util.find_spec('pillow_heif') is not None
+_heif_registered = False
+
+# An image file path, or the image file's bytes when it is kept in memory
+ImageSource = Union[str, bytes]
+
+# Pages are laid out at this many pixels per inch (PDF user space is 72/inch)
+DEFAULT_RESOLUTION = 100.0
+DEFAULT_JPEG_QUALITY = 75
+
+# Paper sizes in PDF points (portrait)
+A4_SIZE = (595.28, 841.89)
+LETTER_SIZE = (612.0, 792.0)
+
+# Page classification thresholds (on a thumbnail of the page)
+CLASSIFY_SIZE = (1024, 1024)
+GRAYSCALE_CHROMA_TOLERANCE = 12  # Max |Cb - 128| / |Cr - 128| for a gray pixel
+GRAYSCALE_MAX_COLOR_FRACTION = 0.01
+BILEVEL_MIN_CONTRAST = 80  # Min distance between ink and paper mean levels
+BILEVEL_MIN_SEPARATED_FRACTION = 0.92  # Pixels clearly on one side of the threshold
+BILEVEL_MAX_INK_FRACTION = 0.5
+
+# Start-of-frame markers that PDF DCTDecode can carry unchanged: baseline,
+# extended sequential and progressive Huffman coded frames
+JPEG_PASSTHROUGH_SOF = {0xC0, 0xC1, 0xC2}
+JPEG_COLORSPACES = {1: "DeviceGray", 3: "DeviceRGB", 4: "DeviceCMYK"}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+
+class JpegInfo:
+    """Header fields of a JPEG file, read without decoding any pixels"""
+
+    def __init__(self, sof: int, precision: int, width: int, height: int, components: int, adobe: bool):
+        self.sof = sof
+        self.precision = precision
+        self.width = width
+        self.height = height
+        self.components = components
+        self.adobe = adobe  # APP14 "Adobe" marker present (CMYK data is stored inverted)
+
+    @property
+    def passthrough(self) -> bool:
+        """Whether the file can be embedded in a PDF without re-encoding"""
+        return (
+            self.sof in JPEG_PASSTHROUGH_SOF
+            and self.precision == 8
+            and self.components in JPEG_COLORSPACES
+            and self.width > 0
+            and self.height > 0
+        )
+
+
+def probe_jpeg(fp: BinaryIO) -> Optional[JpegInfo]:
+    """
+    Walk the JPEG marker segments up to the frame header. Returns None when
+    the data is not a JPEG or no frame header precedes the scan data.
+    """
+    if fp.read(2) != b'\xff\xd8':
+        return None
+
+    adobe = False
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            return None
+        marker = fp.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = fp.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code in JPEG_STANDALONE_MARKERS:
+            continue
+        if code in (0xD9, 0xDA):  # EOI or SOS before any frame header
+            return None
+
+        length_bytes = fp.read(2)
+        if len(length_bytes) != 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0] - 2
+        if length < 0:
+            return None
+
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            frame = fp.read(6)
+            if len(frame) != 6:
+                return None
+            precision, height, width, components = struct.unpack('>BHHB', frame)
+            return JpegInfo(code, precision, width, height, components, adobe)
+
+        segment = fp.read(length)
+        if len(segment) != length:
+            return None
+        if code == 0xEE and segment.startswith(b'Adobe'):
+            adobe = True
+
+
+def _has_end_marker(fp: BinaryIO, size: int) -> bool:
+    """Cheap truncation check: the EOI marker must be near the end of the file"""
+    fp.seek(max(0, size - 32))
+    return b'\xff\xd9' in fp.read()
+
+
+class PageProfile:
+    """
+    Output page geometry. Without a paper size every page takes the size of
+    its image at `dpi`; with one, images are fitted (centered, aspect ratio
+    kept) onto the paper in the matching orientation and never carry more
+    pixels than `dpi` requires.
+    """
+
+    def __init__(self, name: str, label: str, dpi: float, paper_size: tuple = None):
+        self.name = name
+        self.label = label
+        self.dpi = dpi
+        self.paper_size = paper_size
+
+    def _paper_for(self, width: int, height: int) -> tuple:
+        paper_width, paper_height = self.paper_size
+        if width > height:
+            return paper_height, paper_width
+        return paper_width, paper_height
+
+    def target_pixels(self, width: int, height: int) -> tuple:
+        """Pixel size an image should be reduced to (never enlarged)"""
+        if self.paper_size is None:
+            return width, height
+        paper_width, paper_height = self._paper_for(width, height)
+        scale = min(paper_width * self.dpi / 72.0 / width, paper_height * self.dpi / 72.0 / height, 1.0)
+        if scale >= 1.0:
+            return width, height
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def layout(self, width: int, height: int) -> tuple:
+        """Return (page_width, page_height, image_box) in points for an image"""
+        if self.paper_size is None:
+            page_width = width * 72.0 / self.dpi
+            page_height = height * 72.0 / self.dpi
+            return page_width, page_height, (0, 0, page_width, page_height)
+        page_width, page_height = self._paper_for(width, height)
+        scale = min(page_width / width, page_height / height)
+        image_width = width * scale
+        image_height = height * scale
+        x = (page_width - image_width) / 2
+        y = (page_height - image_height) / 2
+        return page_width, page_height, (x, y, image_width, image_height)
+
+
+PAGE_PROFILES = {
+    profile.name: profile
+    for profile in (
+        PageProfile('original', 'Original size', DEFAULT_RESOLUTION),
+        PageProfile('a4-150', 'A4 @ 150 dpi', 150, A4_SIZE),
+        PageProfile('letter-200', 'Letter @ 200 dpi', 200, LETTER_SIZE),
+    )
+}
+DEFAULT_PAGE_PROFILE = 'original'
+
+
+class CompressionProfile:
+    """
+    How page images are encoded. `passthrough` allows JPEGs to be embedded
+    unchanged; `detect_grayscale` stores colorless pages as 8-bit gray and
+    `bilevel` stores text-like pages as 1-bit images.
+    """
+
+    def __init__(self, name: str, label: str, jpeg_quality: int, passthrough: bool = True,
+                 detect_grayscale: bool = False, bilevel: bool = False):
+        self.name = name
+        self.label = label
+        self.jpeg_quality = jpeg_quality
+        self.passthrough = passthrough
+        self.detect_grayscale = detect_grayscale
+        self.bilevel = bilevel
+
+
+COMPRESSION_PROFILES = {
+    profile.name: profile
+    for profile in (
+        CompressionProfile('standard', 'Standard', DEFAULT_JPEG_QUALITY),
+        CompressionProfile('high', 'High quality', 90),
+        CompressionProfile('small', 'Small file', 50, passthrough=False, detect_grayscale=True),
+        CompressionProfile('document', 'Document scan', 60, passthrough=False, detect_grayscale=True, bilevel=True),
+    )
+}
+DEFAULT_COMPRESSION_PROFILE = 'standard'
+
+
+class RenderOptions:
+    """Per-job render settings; plain attributes so it can be sent to worker processes"""
+
+    def __init__(self, page_profile: str = DEFAULT_PAGE_PROFILE, compression_profile: str = DEFAULT_COMPRESSION_PROFILE,
+                 page_workers: int = 0):
+        if page_profile not in PAGE_PROFILES:
+            raise ValueError(f"Unknown page profile: {page_profile}")
+        if compression_profile not in COMPRESSION_PROFILES:
+            raise ValueError(f"Unknown compression profile: {compression_profile}")
+        self.page_profile = page_profile
+        self.compression_profile = compression_profile
+        # Pages of the job prepared at the same time (0: as many as the render pool runs);
+        # not part of the signature, the pages come out the same
+        self.page_workers = page_workers
+
+    @property
+    def page(self) -> PageProfile:
+        return PAGE_PROFILES[self.page_profile]
+
+    @property
+    def compression(self) -> CompressionProfile:
+        return COMPRESSION_PROFILES[self.compression_profile]
+
+    @property
+    def signature(self) -> str:
+        """Identifies the settings; pages prepared with another signature cannot be reused"""
+        return f"{self.page_profile}/{self.compression_profile}"
+
+
+class PreparedPage:
+    """
+    An encoded image ready to be written as a PDF page. The stream is either
+    held in `data` or copied from `source_path` (the original file for
+    passthrough JPEGs, or a file the page was stored to).
+    """
+
+    def __init__(self, data: Optional[bytes], width: int, height: int, colorspace: str = "DeviceRGB",
+                 bits: int = 8, filter_name: str = "DCTDecode", decode: List[int] = None,
+                 layout: tuple = None, source_path: str = None, length: int = 0, decode_parms: str = None):
+        self.data = data
+        self.source_path = source_path
+        self.length = len(data) if data is not None else length
+        self.width = width
+        self.height = height
+        self.colorspace = colorspace
+        self.bits = bits
+        self.filter_name = filter_name
+        self.decode = decode
+        self.decode_parms = decode_parms
+        if layout is None:
+            layout = PAGE_PROFILES[DEFAULT_PAGE_PROFILE].layout(width, height)
+        self.page_width, self.page_height, self.image_box = layout
+        self.timings: Dict[str, float] = {}  # Preparation step -> seconds, reported as metrics
+
+    def store(self, path: str):
+        """Move the encoded stream to a file so the page can be passed around cheaply"""
+        if self.data is None:
+            return
+        with open(path, 'wb') as fp:
+            fp.write(self.data)
+        self.data = None
+        self.source_path = path
+
+    def write_to(self, writer: StreamingPDFWriter) -> int:
+        if self.data is not None:
+            return self._write(writer, data=self.data)
+        with open(self.source_path, 'rb') as source:
+            return self._write(writer, source=source, length=self.length)
+
+    def _write(self, writer: StreamingPDFWriter, **stream) -> int:
+        return writer.add_image_page(
+            self.width,
+            self.height,
+            self.page_width,
+            self.page_height,
+            colorspace=self.colorspace,
+            bits=self.bits,
+            filter_name=self.filter_name,
+            decode=self.decode,
+            decode_parms=self.decode_parms,
+            image_box=self.image_box,
+            **stream,
+        )
+
+
+def register_heif() -> bool:
+    """Register the HEIC/HEIF plugin with Pillow once; False without pillow-heif"""
+    global HEIF_AVAILABLE, _heif_registered
+    if HEIF_AVAILABLE and not _heif_registered:
+        try:
+            from pillow_heif import register_heif_opener
+        except ImportError as e:
+            # Installed but broken (e.g. libheif missing): other formats still work
+            logger.error(f"HEIC support disabled, cannot import pillow-heif: {e}")
+            HEIF_AVAILABLE = False
+            return False
+        register_heif_opener()
+        _heif_registered = True
+    return HEIF_AVAILABLE
+
+
+def _open_source(image: ImageSource) -> BinaryIO:
+    # BytesIO shares the bytes object's buffer until written to
+    return io.BytesIO(image) if isinstance(image, bytes) else open(image, 'rb')
+
+
+def describe_source(image: ImageSource) -> str:
+    return f"<{len(image)} bytes in memory>" if isinstance(image, bytes) else image
+
+
+def prepare_jpeg_passthrough(image: ImageSource, profile: PageProfile) -> Optional[PreparedPage]:
+    """
+    Build a page that embeds the original JPEG bytes, reading only the file
+    header. Returns None when the file has to go through the decode path,
+    including when it has more pixels than the page profile needs. For an
+    image held in memory the page references the same bytes object.
+    """
+    started = time.perf_counter()
+    with _open_source(image) as fp:
+        info = probe_jpeg(fp)
+        if info is None or not info.passthrough:
+            return None
+        if profile.target_pixels(info.width, info.height) != (info.width, info.height):
+            return None
+        size = len(image) if isinstance(image, bytes) else os.fstat(fp.fileno()).st_size
+        if not _has_end_marker(fp, size):
+            return None
+
+    decode = None
+    if info.components == 4 and info.adobe:
+        # Adobe applications write CMYK JPEGs with inverted components
+        decode = [1, 0, 1, 0, 1, 0, 1, 0]
+
+    in_memory = isinstance(image, bytes)
+    page = PreparedPage(
+        image if in_memory else None,
+        info.width,
+        info.height,
+        colorspace=JPEG_COLORSPACES[info.components],
+        decode=decode,
+        layout=profile.layout(info.width, info.height),
+        source_path=None if in_memory else image,
+        length=size,
+    )
+    page.timings['passthrough'] = time.perf_counter() - started
+    return page
+
+
+def _decode_for_profile(img: Image.Image, profile: PageProfile) -> Image.Image:
+    """
+    Decode an opened image at no more than the resolution the page needs.
+    JPEGs are decoded at reduced DCT scale (draft mode); other formats are
+    decoded fully and shrunk with a cheap integer reduce() before resampling.
+    """
+    target = profile.target_pixels(*img.size)
+    if target == img.size:
+        img.load()
+        return img
+
+    if img.mode in ('P', '1'):
+        # Palette and bilevel images can only be resized with NEAREST
+        img = img.convert('RGB')
+    # thumbnail() applies draft() for JPEGs and reduce() for everything else
+    img.thumbnail(target, Image.LANCZOS, reducing_gap=2.0)
+    return img
+
+
+class ImageInfo:
+    """Format, dimensions and mode of an image, read from its header"""
+
+    def __init__(self, format: str, width: int, height: int, mode: str):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.mode = mode
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+class ImageTooLarge(Exception):
+    """Raised by probe_image for images with more pixels than allowed"""
+
+
+def probe_image(image: ImageSource, max_pixels: int = 0) -> ImageInfo:
+    """
+    Read an image's header without decoding any pixels. Raises ImageTooLarge
+    above max_pixels (0: no limit) and for images Pillow refuses to open as
+    decompression bombs, and PIL.UnidentifiedImageError for files that are
+    not images.
+    """
+    register_heif()
+    try:
+        with _open_source(image) as fp, Image.open(fp) as img:
+            info = ImageInfo(img.format, img.width, img.height, img.mode)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    if max_pixels and info.pixels > max_pixels:
+        raise ImageTooLarge(f"{info.width}x{info.height} exceeds the limit of {max_pixels} pixels")
+    return info
+
+
+def decoded_pixels(info: ImageInfo, options: RenderOptions = None) -> int:
+    """
+    Pixels a worker decodes to prepare the image as a page: none for a JPEG
+    that is passed through, the reduced DCT scale for an oversized JPEG
+    (mirroring draft() as applied by _decode_for_profile), the full image
+    for everything else
+    """
+    options = options or RenderOptions()
+    target = options.page.target_pixels(info.width, info.height)
+    if info.format != 'JPEG':
+        return info.pixels
+    if target == (info.width, info.height):
+        return 0 if options.compression.passthrough and info.mode in ('L', 'RGB', 'CMYK') else info.pixels
+
+    scale = min(info.width // (target[0] * 2), info.height // (target[1] * 2))
+    reduction = next((factor for factor in (8, 4, 2) if scale >= factor), 1)
+    return -(-info.width // reduction) * -(-info.height // reduction)
+
+
+def classify_page(img: Image.Image, compression: CompressionProfile) -> tuple:
+    """
+    Decide how to store an RGB page: returns ('color', None), ('gray', None)
+    or ('bilevel', threshold). Works on the histograms of a small thumbnail,
+    which Pillow computes in C, so classifying a page stays cheap.
+    """
+    if not compression.detect_grayscale:
+        return 'color', None
+
+    sample = img.copy()
+    sample.thumbnail(CLASSIFY_SIZE, Image.BILINEAR)
+    try:
+        _, cb, cr = sample.convert('YCbCr').split()
+        total = sample.width * sample.height
+        low = 128 - GRAYSCALE_CHROMA_TOLERANCE
+        high = 128 + GRAYSCALE_CHROMA_TOLERANCE
+        colored = 0
+        for channel in (cb, cr):
+            histogram = channel.histogram()
+            colored += sum(histogram[:low]) + sum(histogram[high + 1:])
+        if colored > total * GRAYSCALE_MAX_COLOR_FRACTION:
+            return 'color', None
+
+        if compression.bilevel:
+            threshold = _bilevel_threshold(sample.convert('L').histogram(), total)
+            if threshold is not None:
+                return 'bilevel', threshold
+        return 'gray', None
+    finally:
+        sample.close()
+
+
+def _bilevel_threshold(histogram: List[int], total: int) -> Optional[int]:
+    """
+    Otsu threshold of a grayscale histogram, or None when the page does not
+    look like dark ink on light paper (low contrast, many mid tones, or
+    mostly dark)
+    """
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    best_threshold, plateau_end, best_variance = None, None, 0.0
+    dark_count = dark_weighted = 0
+    for level in range(255):
+        dark_count += histogram[level]
+        dark_weighted += level * histogram[level]
+        light_count = total - dark_count
+        if dark_count == 0 or light_count == 0:
+            continue
+        dark_mean = dark_weighted / dark_count
+        light_mean = (weighted_total - dark_weighted) / light_count
+        variance = dark_count * light_count * (dark_mean - light_mean) ** 2
+        if variance > best_variance:
+            best_threshold, plateau_end, best_variance = level, level, variance
+        elif variance == best_variance and plateau_end == level - 1:
+            # Empty levels between the classes give the same split
+            plateau_end = level
+    if best_threshold is None:
+        return None
+
+    dark_count = sum(histogram[:best_threshold + 1])
+    dark_mean = sum(level * histogram[level] for level in range(best_threshold + 1)) / dark_count
+    light_mean = (weighted_total - dark_mean * dark_count) / (total - dark_count)
+    if light_mean - dark_mean < BILEVEL_MIN_CONTRAST or dark_count > total * BILEVEL_MAX_INK_FRACTION:
+        return None
+
+    # Pixels within a quarter of the contrast around the middle of the two
+    # class means are mid tones
+    center = int((dark_mean + light_mean) / 2)
+    margin = int((light_mean - dark_mean) / 4)
+    mid_tones = sum(histogram[max(0, center - margin):center + margin + 1])
+    if total - mid_tones < total * BILEVEL_MIN_SEPARATED_FRACTION:
+        return None
+    # Split in the middle of the levels that separate the classes equally well
+    return (best_threshold + plateau_end) // 2
+
+
+def _encode_bilevel(img: Image.Image, threshold: int) -> tuple:
+    """Binarize a grayscale page; returns (stream, filter, decode_parms)"""
+    bilevel = img.point([0 if level <= threshold else 255 for level in range(256)], '1')
+    try:
+        if features.check('libtiff'):
+            # Same approach as Pillow's PDF plugin: a single-strip Group 4
+            # TIFF whose image data directly follows the 8-byte header
+            buffer = io.BytesIO()
+            bilevel.save(buffer, format='TIFF', compression='group4', strip_size=-(-bilevel.width // 8) * bilevel.height)
+            parms = f"<< /K -1 /BlackIs1 true /Columns {bilevel.width} /Rows {bilevel.height} >>"
+            return buffer.getvalue()[8:], "CCITTFaxDecode", parms
+        return zlib.compress(bilevel.tobytes(), 9), "FlateDecode", None
+    finally:
+        bilevel.close()
+
+
+def encode_page(img: Image.Image, compression: CompressionProfile, profile: PageProfile) -> PreparedPage:
+    """Encode a decoded RGB page according to the compression profile"""
+    width, height = img.size
+    layout = profile.layout(width, height)
+    kind, threshold = classify_page(img, compression)
+    if kind == 'color':
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=compression.jpeg_quality, optimize=True)
+        return PreparedPage(buffer.getvalue(), width, height, layout=layout)
+
+    gray = img.convert('L')
+    try:
+        if kind == 'bilevel':
+            stream, filter_name, parms = _encode_bilevel(gray, threshold)
+            return PreparedPage(stream, width, height, colorspace="DeviceGray", bits=1,
+                                filter_name=filter_name, decode_parms=parms, layout=layout)
+        buffer = io.BytesIO()
+        gray.save(buffer, format='JPEG', quality=compression.jpeg_quality, optimize=True)
+        return PreparedPage(buffer.getvalue(), width, height, colorspace="DeviceGray", layout=layout)
+    finally:
+        gray.close()
+
+
+def prepare_page(image: ImageSource, options: RenderOptions = None) -> PreparedPage:
+    """
+    Prepare one image (a path or the file's bytes) as a PDF page. JPEGs
+    that already fit the page profile are passed through untouched when the
+    compression profile allows it; everything else (PNG, HEIC, alpha,
+    palette, oversized JPEGs) is decoded, converted to RGB and encoded per
+    the compression profile.
+    """
+    options = options or RenderOptions()
+    profile = options.page
+    if options.compression.passthrough:
+        page = prepare_jpeg_passthrough(image, profile)
+        if page is not None:
+            return page
+
+    started = time.perf_counter()
+    register_heif()
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+        decoded = _decode_for_profile(img, profile)
+        decoded_at = time.perf_counter()
+        rgb_img = decoded.convert('RGB') if decoded.mode != 'RGB' else decoded
+        converted_at = time.perf_counter()
+        try:
+            page = encode_page(rgb_img, options.compression, profile)
+            page.timings.update(
+                decode=decoded_at - started,
+                convert=converted_at - decoded_at,
+                encode=time.perf_counter() - converted_at,
+            )
+            return page
+        finally:
+            if rgb_img is not decoded:
+                rgb_img.close()
+            if decoded is not img:
+                decoded.close()
+
+
+class IncrementalPDF:
+    """
+    A PDF body that grows while images arrive. Each prepared page is appended
+    as soon as it is ready, in any order; finalize() then only writes the page
+    tree in the requested order, the cross-reference table and the trailer.
+    Finalizing again (e.g. after more pages were appended) first truncates
+    the previous trailer. write_part() copies a subset of the pages into a
+    separate PDF, for documents too large to send as one file.
+    """
+
+    def __init__(self, path: str, signature: str):
+        self.path = path
+        self.signature = signature
+        self.page_refs: dict = {}  # page key (update_id) -> page object number
+        self.page_spans: dict = {}  # page key -> (start, end, object numbers) of its objects in the body
+        with open(path, 'wb') as fp:
+            self.writer = StreamingPDFWriter(fp)
+        self.body_length = self.writer.position
+
+    def append(self, key, page: PreparedPage):
+        with open(self.path, 'r+b') as fp:
+            self.writer.rewind(fp, self.body_length)
+            first_number = self.writer.next_object_number
+            self.page_refs[key] = page.write_to(self.writer)
+            numbers = range(first_number, self.writer.next_object_number)
+            self.page_spans[key] = (self.body_length, self.writer.position, numbers)
+            self.body_length = self.writer.position
+
+    def finalize(self, keys: List) -> int:
+        """
+        Complete the PDF with the pages of `keys` in that order (keys without
+        a page are skipped) and return the number of pages
+        """
+        refs = [self.page_refs[key] for key in keys if key in self.page_refs]
+        with open(self.path, 'r+b') as fp:
+            self.writer.rewind(fp, self.body_length)
+            self.writer.write_trailer(refs)
+        return len(refs)
+
+    def part_size(self, keys: List) -> int:
+        """Size of the file write_part() would produce for these keys"""
+        keys = [key for key in keys if key in self.page_spans]
+        size = len(PDF_HEADER) + 256  # Page tree, catalog and trailer without the kids
+        highest = 0
+        for key in keys:
+            start, end, numbers = self.page_spans[key]
+            size += end - start + 12  # Objects and the page's entry in /Kids
+            highest = max(highest, numbers[-1])
+        # Cross-reference entries (20 bytes) for every number up to the highest one
+        return size + (highest + 1) * 20
+
+    def write_part(self, keys: List, path: str) -> int:
+        """
+        Write the pages of `keys` in that order (keys without a page are
+        skipped) as a complete PDF at `path` and return the number of pages.
+        Only bytes before body_length are read, so pages may be appended
+        meanwhile.
+        """
+        refs = []
+        with open(self.path, 'rb') as source, open(path, 'wb') as fp:
+            writer = StreamingPDFWriter(fp)
+            for key in keys:
+                if key not in self.page_spans:
+                    continue
+                start, end, numbers = self.page_spans[key]
+                writer.copy_objects(source, start, end, {number: self.writer.offsets[number] for number in numbers})
+                refs.append(self.page_refs[key])
+            writer.write_trailer(refs)
+        return len(refs)
@@ -0,0 +1,177 @@
+"""
+Streaming PDF writer
+
+Writes image pages straight to the output file one object at a time, so the
+memory needed to build a PDF is bounded by a single page no matter how many
+pages the document has. Only byte offsets are kept until the cross-reference
+table is written by write_trailer().
+"""
+
+from typing import BinaryIO, Dict, List, Optional
+
+PDF_HEADER = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+
+# Object numbers 1 and 2 are reserved for the catalog and the page tree so
+# that every page can reference its parent before the tree itself is written
+CATALOG_REF = 1
+PAGES_REF = 2
+
+COPY_CHUNK_SIZE = 256 * 1024
+
+
+def _format_number(value: float) -> str:
+    """Format a number the way PDF expects (no exponent, trimmed zeros)"""
+    if isinstance(value, int):
+        return str(value)
+    text = f"{value:.4f}".rstrip('0').rstrip('.')
+    return text or "0"
+
+
+class StreamingPDFWriter:
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.position = 0
+        self.offsets: dict[int, int] = {}  # object number -> byte offset
+        self.next_object_number = PAGES_REF + 1
+        self._write(PDF_HEADER)
+
+    def _write(self, data: bytes):
+        self.fp.write(data)
+        self.position += len(data)
+
+    def _allocate(self) -> int:
+        number = self.next_object_number
+        self.next_object_number += 1
+        return number
+
+    def _begin_object(self, number: int):
+        self.offsets[number] = self.position
+        self._write(f"{number} 0 obj\n".encode('ascii'))
+
+    def _write_object(self, number: int, body: str):
+        self._begin_object(number)
+        self._write(body.encode('ascii'))
+        self._write(b"\nendobj\n")
+
+    def _write_stream_object(self, number: int, entries: str, data=None, source: Optional[BinaryIO] = None, length: int = 0):
+        """Write a stream object from in-memory bytes or by copying from a file object"""
+        if data is not None:
+            length = len(data)
+        self._begin_object(number)
+        self._write(f"<< {entries} /Length {length} >>\nstream\n".encode('ascii'))
+        if data is not None:
+            self._write(data)
+        else:
+            copied = 0
+            while True:
+                chunk = source.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._write(chunk)
+                copied += len(chunk)
+            if copied != length:
+                raise ValueError("Stream source length does not match declared length")
+        self._write(b"\nendstream\nendobj\n")
+
+    def add_image_page(
+        self,
+        width: int,
+        height: int,
+        page_width: float,
+        page_height: float,
+        data: bytes = None,
+        source: BinaryIO = None,
+        length: int = 0,
+        colorspace: str = "DeviceRGB",
+        bits: int = 8,
+        filter_name: str = "DCTDecode",
+        decode: Optional[List[int]] = None,
+        decode_parms: Optional[str] = None,
+        image_box: Optional[tuple] = None,
+    ) -> int:
+        """
+        Write one page consisting of a single image XObject drawn into
+        `image_box` (x, y, width, height in points; the whole page when
+        omitted). The encoded image comes either from `data` or is copied
+        from the `source` file object (`length` bytes). Returns the object
+        number of the page.
+        """
+        image_ref = self._allocate()
+        contents_ref = self._allocate()
+        page_ref = self._allocate()
+
+        entries = (
+            f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /{colorspace} /BitsPerComponent {bits} /Filter /{filter_name}"
+        )
+        if decode:
+            entries += f" /Decode [{' '.join(str(v) for v in decode)}]"
+        if decode_parms:
+            entries += f" /DecodeParms {decode_parms}"
+        self._write_stream_object(image_ref, entries, data=data, source=source, length=length)
+
+        w = _format_number(page_width)
+        h = _format_number(page_height)
+        if image_box is None:
+            image_box = (0, 0, page_width, page_height)
+        x, y, box_width, box_height = (_format_number(v) for v in image_box)
+        contents = f"q {box_width} 0 0 {box_height} {x} {y} cm /image Do Q\n".encode('ascii')
+        self._write_stream_object(contents_ref, "", data=contents)
+
+        self._write_object(
+            page_ref,
+            f"<< /Type /Page /Parent {PAGES_REF} 0 R /MediaBox [0 0 {w} {h}] "
+            f"/Resources << /ProcSet [/PDF /ImageC /ImageB] /XObject << /image {image_ref} 0 R >> >> "
+            f"/Contents {contents_ref} 0 R >>"
+        )
+        return page_ref
+
+    def copy_objects(self, source: BinaryIO, start: int, end: int, offsets: Dict[int, int]):
+        """
+        Copy objects written by another writer: the bytes from `start` to
+        `end` of `source`, which hold the objects in `offsets` (object
+        number -> offset in source). Object numbers are kept, so references
+        between the copied objects stay valid.
+        """
+        source.seek(start)
+        base = self.position
+        remaining = end - start
+        while remaining:
+            chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("Source ended before the objects were copied")
+            self._write(chunk)
+            remaining -= len(chunk)
+        for number, offset in offsets.items():
+            self.offsets[number] = base + offset - start
+        self.next_object_number = max(self.next_object_number, max(offsets, default=0) + 1)
+
+    def write_trailer(self, page_refs: List[int]):
+        """
+        Write the page tree (pages in the given order), catalog,
+        cross-reference table and trailer at the current position. The
+        writer stays usable: after truncating the file back to an earlier
+        position with rewind() more pages can be added and the trailer
+        written again.
+        """
+        kids = ' '.join(f"{ref} 0 R" for ref in page_refs)
+        self._write_object(PAGES_REF, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_refs)} >>")
+        self._write_object(CATALOG_REF, f"<< /Type /Catalog /Pages {PAGES_REF} 0 R >>")
+
+        xref_offset = self.position
+        size = self.next_object_number
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for number in range(1, size):
+            offset = self.offsets.get(number)
+            # Numbers of objects that were not copied into this file are free
+            lines.append(f"{offset:010d} 00000 n \n" if offset is not None else "0000000000 65535 f \n")
+        lines.append(f"trailer\n<< /Size {size} /Root {CATALOG_REF} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self._write(''.join(lines).encode('ascii'))
+        self.fp.flush()
+
+    def rewind(self, fp: BinaryIO, position: int):
+        """Continue writing on `fp` at `position`, discarding anything after it"""
+        fp.seek(position)
+        fp.truncate()
+        self.fp = fp
+        self.position = position
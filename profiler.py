@@ -0,0 +1,201 @@
+"""
+On-demand profiling of the running process
+
+A Profile runs for a number of seconds (or until a number of PDFs have been
+generated) and collects:
+
+- stack samples of every thread, taken by a sampling thread and returned
+  as collapsed stacks ("thread;module:function;... count", the input
+  format of flamegraph.pl and speedscope)
+- event loop lag: how late a periodic sleep on the loop wakes up
+- the slowest update handler runs, with their update_id
+- the top allocation sites according to tracemalloc
+
+Nothing is installed while no profile runs: the sampling thread, the lag
+probe, the handler timing wrapper and tracemalloc only exist for the
+duration of a profile. Pages are prepared in render worker processes,
+which are not sampled; their per-step timings are in /metrics.
+"""
+
+import asyncio
+import heapq
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import List, Tuple
+
+from update_dispatcher import UpdateDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for a profile's duration
+MAX_PROFILE_SECONDS = 300
+
+# Lower bound for the stack sampling interval; shorter ones keep the
+# sampler thread spinning and starve the event loop
+MIN_SAMPLE_INTERVAL = 0.001
+
+# Interval of the event loop lag probe
+LAG_PROBE_INTERVAL = 0.01
+
+# Frames kept per tracemalloc trace
+TRACEMALLOC_FRAMES = 10
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{code.co_name}"
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of all other threads every `interval` seconds"""
+
+    def __init__(self, interval: float):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class Profile:
+    def __init__(self, seconds: float = 10, jobs: int = 0, interval: float = 0.005, top: int = 20,
+                 allocations: bool = True):
+        self.seconds = min(seconds, MAX_PROFILE_SECONDS)
+        self.jobs = jobs  # Stop after this many generated PDFs (0: run for `seconds`)
+        self.interval = max(interval, MIN_SAMPLE_INTERVAL)
+        self.top = top
+        self.allocations = allocations
+        self.jobs_done = 0
+        self.jobs_finished = asyncio.Event()
+        self.lags: List[float] = []
+        self.slowest: List[Tuple[float, int, str]] = []  # Min-heap of (seconds, update_id, kind)
+        self.sampler = StackSampler(self.interval)
+
+    def job_done(self):
+        """Called after a PDF has been generated"""
+        self.jobs_done += 1
+        if self.jobs and self.jobs_done >= self.jobs:
+            self.jobs_finished.set()
+
+    def _record_update(self, update, seconds: float):
+        kind = 'callback_query' if getattr(update, 'callback_query', None) else 'message'
+        entry = (seconds, getattr(update, 'update_id', None), kind)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    async def _probe_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self.lags.append(max(0.0, loop.time() - started - LAG_PROBE_INTERVAL))
+
+    def _lag_stats(self) -> dict:
+        if not self.lags:
+            return {'samples': 0}
+        ordered = sorted(self.lags)
+        return {
+            'samples': len(ordered),
+            'p50_ms': round(ordered[len(ordered) // 2] * 1000, 2),
+            'p99_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+        }
+
+    def _top_allocations(self, snapshot: tracemalloc.Snapshot) -> List[dict]:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        return [
+            {
+                'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                'size_kb': round(stat.size / 1024, 1),
+                'count': stat.count,
+            }
+            for stat in snapshot.statistics('lineno')[:self.top]
+        ]
+
+    async def run(self, dispatcher: UpdateDispatcher = None) -> dict:
+        """Profile until `seconds` have passed or `jobs` PDFs were generated"""
+        started_tracing = self.allocations and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        original_process = dispatcher.process if dispatcher else None
+
+        async def timed_process(update):
+            started = time.perf_counter()
+            try:
+                return await original_process(update)
+            finally:
+                self._record_update(update, time.perf_counter() - started)
+
+        if dispatcher:
+            dispatcher.process = timed_process
+        lag_probe = asyncio.create_task(self._probe_lag())
+        self.sampler.start()
+        started = time.monotonic()
+        logger.info(f"Profiling for up to {self.seconds}s" + (f" or {self.jobs} PDFs" if self.jobs else ""))
+        try:
+            if self.jobs:
+                try:
+                    await asyncio.wait_for(self.jobs_finished.wait(), self.seconds)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(self.seconds)
+        finally:
+            self.sampler.stop()
+            lag_probe.cancel()
+            if dispatcher:
+                dispatcher.process = original_process
+            snapshot = tracemalloc.take_snapshot() if self.allocations and tracemalloc.is_tracing() else None
+            if started_tracing:
+                tracemalloc.stop()
+
+        duration = time.monotonic() - started
+        logger.info(f"Profile finished after {duration:.1f}s with {self.sampler.samples} samples")
+        return {
+            'duration': round(duration, 3),
+            'samples': self.sampler.samples,
+            'interval_ms': self.interval * 1000,
+            'jobs': self.jobs_done,
+            'loop_lag': self._lag_stats(),
+            'slowest_updates': [
+                {'update_id': update_id, 'kind': kind, 'seconds': round(seconds, 4)}
+                for seconds, update_id, kind in sorted(self.slowest, reverse=True)
+            ],
+            'allocations': self._top_allocations(snapshot) if snapshot else None,
+            'collapsed': self.sampler.collapsed(),
+        }
@@ -0,0 +1,205 @@
+"""
+Process pool for PDF rendering
+
+Rendering is CPU heavy and must not run on the event loop. Jobs (single
+pages prepared for incremental assembly) are handed to a pool of worker
+processes; every job runs under a timeout, and workers are replaced after a
+fixed number of jobs so memory fragmented by image decoding is returned to
+the OS.
+
+Jobs are admitted in arrival order against two limits: the number of jobs
+running at once and, when a pixel budget is set, the total number of
+pixels the running jobs decode (see pdf_render.decoded_pixels). A heavy job
+waits until enough lighter ones have finished instead of running next to
+them; a job larger than the whole budget runs alone.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from contextlib import contextmanager
+
+from pdf_render import ImageSource, PreparedPage, RenderOptions, prepare_page
+
+logger = logging.getLogger(__name__)
+
+# Extra time the event loop waits beyond the in-worker timeout before giving up
+TIMEOUT_GRACE_SECONDS = 5
+
+
+class RenderTimeout(Exception):
+    """Raised when a render job exceeds its time limit"""
+
+
+class _JobDeadline(BaseException):
+    """
+    Raised inside a worker by the alarm handler. Derives from BaseException
+    so the renderer's error handling cannot swallow it.
+    """
+
+
+def _raise_deadline(signum, frame):
+    raise _JobDeadline()
+
+
+@contextmanager
+def _deadline(timeout: float):
+    """Interrupt the worker's main thread with _JobDeadline after `timeout` seconds"""
+    signal.signal(signal.SIGALRM, _raise_deadline)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _prepare_in_worker(image: ImageSource, page_path: str, timeout: float, options: RenderOptions) -> PreparedPage:
+    """
+    Worker process entry point: prepare a single page. Encoded streams are
+    stored at page_path so only the page description travels back.
+    """
+    try:
+        with _deadline(timeout):
+            page = prepare_page(image, options)
+            page.store(page_path)
+            return page
+    except _JobDeadline:
+        raise RenderTimeout()
+
+
+class RenderPool:
+    def __init__(self, workers: int = 2, timeout: float = 120.0, max_jobs_per_worker: int = 50,
+                 pixel_budget: int = 0):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.executor: ProcessPoolExecutor = None
+        self.concurrency = self.workers  # Jobs allowed to run at once, lowered under memory pressure
+        self.capacity = asyncio.Condition()
+        self.queued = 0  # Jobs waiting for a free worker
+        self.in_flight = 0  # Jobs currently running in a worker
+        self.pixel_budget = pixel_budget  # Decoded pixels allowed across running jobs (0: unlimited)
+        self.pixels_in_flight = 0
+        self.pixels_queued = 0  # Decoded pixels of the jobs waiting for admission
+        self.waiting = deque()  # Tickets of queued jobs, admitted first come first served
+
+    @classmethod
+    def from_env(cls) -> 'RenderPool':
+        return cls(
+            workers=int(os.getenv('RENDER_WORKERS', 2)),
+            timeout=float(os.getenv('RENDER_TIMEOUT', 120)),
+            max_jobs_per_worker=int(os.getenv('RENDER_MAX_JOBS_PER_WORKER', 50)),
+            pixel_budget=int(float(os.getenv('RENDER_PIXEL_BUDGET_MP', 48)) * 1_000_000),
+        )
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # max_tasks_per_child cannot be combined with fork; spawn also keeps
+        # the workers free of the parent's sessions and event loop state
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            max_tasks_per_child=self.max_jobs_per_worker,
+        )
+
+    def start(self):
+        if self.executor is None:
+            self.executor = self._create_executor()
+            logger.info(
+                f"Render pool started: {self.workers} workers, "
+                f"timeout {self.timeout}s, recycle after {self.max_jobs_per_worker} jobs, "
+                f"pixel budget {self.pixel_budget / 1_000_000:g} MP"
+            )
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def set_concurrency(self, concurrency: int):
+        """Change how many jobs may run at once (1 up to the number of workers)"""
+        async with self.capacity:
+            self.concurrency = max(1, min(concurrency, self.workers))
+            self.capacity.notify_all()
+
+    def _admits(self, ticket: object, pixels: int) -> bool:
+        if self.waiting[0] is not ticket or self.in_flight >= self.concurrency:
+            return False
+        if not self.pixel_budget or not self.pixels_in_flight:
+            return True
+        return self.pixels_in_flight + pixels <= self.pixel_budget
+
+    async def _run(self, pixels: int, function, *args):
+        """
+        Run a job that decodes about `pixels` pixels in a worker once it is
+        admitted, with the pool's timeout
+        """
+        ticket = object()
+        self.queued += 1
+        self.pixels_queued += pixels
+        try:
+            async with self.capacity:
+                self.waiting.append(ticket)
+                try:
+                    await self.capacity.wait_for(lambda: self._admits(ticket, pixels))
+                finally:
+                    self.waiting.remove(ticket)
+                    # The next job in line may fit as well (or be first now after a cancellation)
+                    self.capacity.notify_all()
+                self.in_flight += 1
+                self.pixels_in_flight += pixels
+        finally:
+            self.queued -= 1
+            self.pixels_queued -= pixels
+
+        try:
+            self.start()
+            executor = self.executor
+            loop = asyncio.get_running_loop()
+            try:
+                future = loop.run_in_executor(executor, function, *args)
+                return await asyncio.wait_for(future, self.timeout + TIMEOUT_GRACE_SECONDS)
+            except asyncio.TimeoutError:
+                raise RenderTimeout()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OOM killer); start a fresh pool,
+                # unless another job already replaced the broken one
+                if self.executor is executor:
+                    logger.error("Render worker died, restarting render pool")
+                    self.shutdown()
+                raise
+        finally:
+            async with self.capacity:
+                self.in_flight -= 1
+                self.pixels_in_flight -= pixels
+                self.capacity.notify_all()
+
+    async def prepare(self, image: ImageSource, page_path: str, options: RenderOptions = None,
+                      pixels: int = 0) -> PreparedPage:
+        """
+        Prepare one page (from a path or in-memory image bytes) in a worker
+        process for incremental assembly. pixels is the page's cost against
+        the pixel budget (0 when unknown). Raises RenderTimeout when the job
+        exceeds the configured time limit.
+        """
+        return await self._run(pixels, _prepare_in_worker, image, page_path, self.timeout, options)
+
+    @property
+    def backlog_pixels(self) -> int:
+        """Decoded pixels of the jobs waiting and running"""
+        return self.pixels_queued + self.pixels_in_flight
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'concurrency': self.concurrency,
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'pixel_budget': self.pixel_budget,
+            'pixels_in_flight': self.pixels_in_flight,
+            'pixels_queued': self.pixels_queued,
+        }
@@ -0,0 +1,92 @@
+"""
+Cache of PDFs already sent to Telegram
+
+A document sent once can be sent again by its Telegram file_id without
+rendering or uploading anything. Results are keyed by a hash of the
+ordered file_unique_ids of the session's images and the render settings,
+and the index lives in a small SQLite database so it survives restarts.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+from sqlite_setup import open_database
+
+logger = logging.getLogger(__name__)
+
+
+def result_key(file_unique_ids: List[str], signature: str) -> str:
+    """Key for a PDF of these images (in this order) rendered with these settings"""
+    digest = hashlib.sha256(signature.encode('utf-8'))
+    for unique_id in file_unique_ids:
+        digest.update(b'\0' + unique_id.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            page_count INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.db = open_database(path, lambda db: db.executescript(self.SCHEMA))
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> Optional['ResultCache']:
+        """Build the cache from RESULT_CACHE_* settings; None when disabled"""
+        max_entries = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 10000))
+        if max_entries <= 0:
+            return None
+        path = os.getenv('RESULT_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'img2pdf_results.db'))
+        try:
+            return cls(path, max_entries)
+        except (sqlite3.Error, OSError) as e:
+            # The bot works without it, PDFs are just rendered again
+            logger.error(f"Result cache disabled, cannot open {path}: {e}")
+            return None
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        """Return (file_id, page_count) of a previously sent PDF"""
+        row = self.db.execute("SELECT file_id, page_count FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0], row[1]
+
+    def put(self, key: str, file_id: str, page_count: int):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (key, file_id, page_count, last_used) VALUES (?, ?, ?, ?)",
+                (key, file_id, page_count, time.time())
+            )
+            # Keep the index bounded, least recently used entries go first
+            self.db.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def discard(self, key: str):
+        """Forget a result Telegram no longer accepts"""
+        self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        entries = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {'entries': entries, 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,775 @@
+"""
+User session storage
+
+A session store owns the per-user state: uploaded image paths, the status
+message being edited, settings and the temporary directory. Two stores are
+available:
+
+- InMemorySessionStore: sessions live in this process (single worker).
+- SQLiteSessionStore: sessions live in a SQLite database (WAL mode) under a
+  shared local directory, images are stored below the same directory and a
+  per-user file lock serializes updates across processes. This lets several
+  uvicorn workers serve the same bot, with any worker handling any update.
+  Album collection and status message coalescing stay per process, though:
+  "Generate PDF" only waits for albums still being collected by its own
+  worker, so put sharding.py in front to keep each user on one worker.
+
+Handlers change persistent session state only through the store methods
+(coroutines, so the SQLite store can run its queries off the event loop)
+and hold store.lock(user_id) around their critical sections.
+
+Session directories are created on first use, so users who only send
+commands never touch the disk. With the in-memory store, images up to
+SESSION_MEMORY_MAX_IMAGE_KB are kept as bytes under a process-wide budget
+(SESSION_MEMORY_BUDGET_MB) and everything else spills to the session
+directory (point TMPDIR at a tmpfs such as /dev/shm to keep spills off
+disk as well).
+
+Idle sessions are found through an ExpiryQueue ordered by last activity,
+so a cleanup run only touches the sessions it removes, and session
+directories are deleted in a background thread.
+"""
+
+import asyncio
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pdf_render import DEFAULT_COMPRESSION_PROFILE, DEFAULT_PAGE_PROFILE, ImageInfo, IncrementalPDF
+from sqlite_setup import open_database
+
+logger = logging.getLogger(__name__)
+
+# (update_id, image_path, file_unique_id, info) as passed to SessionStore.add_images
+ImageEntry = Tuple[int, str, Optional[str], Optional[ImageInfo]]
+
+# Page and compression profiles used for new sessions (see pdf_render)
+PDF_PAGE_PROFILE = os.getenv('PDF_PAGE_PROFILE', DEFAULT_PAGE_PROFILE)
+PDF_COMPRESSION_PROFILE = os.getenv('PDF_COMPRESSION_PROFILE', DEFAULT_COMPRESSION_PROFILE)
+
+SESSION_SETTINGS = ('page_profile', 'compression_profile')
+
+# Upper bound on sessions; the least recently active ones are removed first (0: unlimited)
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', 0))
+
+# Image references with this prefix name a buffer in UserSession.buffers instead of a file
+MEMORY_PREFIX = 'memory:'
+
+
+def new_temp_dir_path(root: str = None) -> str:
+    """A fresh session directory path below root (system temp dir when None), not created yet"""
+    return os.path.join(root or tempfile.gettempdir(), f"img2pdf_{uuid.uuid4().hex}")
+
+
+# A single thread deletes session directories so the event loop never waits on rmtree
+_directory_remover = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-cleanup')
+
+
+def _remove_directory(path: str):
+    if not os.path.exists(path):
+        return
+    try:
+        shutil.rmtree(path)
+    except Exception as e:
+        logger.error(f"Error cleaning temporary directory: {e}")
+
+
+def discard_directory(path: str):
+    """Delete a session directory in the background"""
+    _directory_remover.submit(_remove_directory, path)
+
+
+class MemoryBudget:
+    """Process-wide limit on image bytes sessions keep in memory"""
+
+    def __init__(self, max_bytes: int, max_image_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.used = 0
+        self.admitted = 0  # Images kept in memory
+        self.spilled = 0  # Images sent to disk because they were too large or the budget was full
+
+    @classmethod
+    def from_env(cls) -> Optional['MemoryBudget']:
+        """Build the budget from SESSION_MEMORY_* settings; None when disabled"""
+        max_mb = float(os.getenv('SESSION_MEMORY_BUDGET_MB', 64))
+        if max_mb <= 0:
+            return None
+        max_image_kb = float(os.getenv('SESSION_MEMORY_MAX_IMAGE_KB', 2048))
+        return cls(int(max_mb * 1024 * 1024), int(max_image_kb * 1024))
+
+    def reserve(self, size: Optional[int]) -> bool:
+        """Reserve room for an image of `size` bytes; False means it goes to disk"""
+        if size is None or size > self.max_image_bytes or self.used + size > self.max_bytes:
+            self.spilled += 1
+            return False
+        self.used += size
+        self.admitted += 1
+        return True
+
+    def release(self, size: int):
+        self.used = max(0, self.used - size)
+
+    def settle(self, reserved: int, actual: int):
+        """Correct a reservation to the number of bytes actually downloaded"""
+        self.used = max(0, self.used + actual - reserved)
+
+    def stats(self) -> dict:
+        return {
+            'bytes': self.used,
+            'max_bytes': self.max_bytes,
+            'max_image_bytes': self.max_image_bytes,
+            'admitted': self.admitted,
+            'spilled': self.spilled,
+        }
+
+
+class UserSession:
+    def __init__(self, user_id: int = None, temp_root: str = None, temp_dir: str = None,
+                 memory_budget: MemoryBudget = None):
+        self.user_id = user_id
+        self.images: List[tuple[int, str]] = []  # List of (update_id, image_path) tuples
+        self.file_unique_ids: Dict[int, str] = {}  # update_id -> Telegram file_unique_id, when known
+        self.image_info: Dict[int, ImageInfo] = {}  # update_id -> header probed at download, when known
+        self.buffers: Dict[str, bytes] = {}  # MEMORY_PREFIX reference -> image file bytes
+        self.memory_budget = memory_budget  # Accounts for buffers; None keeps every image on disk
+        self.temp_root = temp_root  # Parent of temp_dir (system temp dir when None)
+        self.temp_dir = temp_dir or new_temp_dir_path(temp_root)
+        self.last_activity = datetime.now()
+        self.status_message_id: int = None  # Track the status message for updates
+        self.update_lock = asyncio.Lock()  # Single lock for add_image + status update (critical section)
+        self.busy = 0  # Long operations (PDF generation) running outside the lock; expiry skips the session
+        self.page_profile = PDF_PAGE_PROFILE  # Output page size, kept across clears
+        self.compression_profile = PDF_COMPRESSION_PROFILE  # Image encoding, kept across clears
+        self.assembly: IncrementalPDF = None  # PDF body built while images arrive
+        self.page_tasks: Dict[int, asyncio.Task] = {}  # update_id -> background page preparation
+        self.page_slots: Optional[asyncio.Semaphore] = None  # Caps the assembly's pages in the render pool
+        self.assembly_lock = asyncio.Lock()  # Serializes appends to the PDF body
+
+    @property
+    def temp_dir(self) -> str:
+        """The session's temporary directory, created on first use"""
+        if not self._temp_dir_created:
+            os.makedirs(self.temp_dir_path, mode=0o700, exist_ok=True)
+            self._temp_dir_created = True
+        return self.temp_dir_path
+
+    @temp_dir.setter
+    def temp_dir(self, path: str):
+        self.temp_dir_path = path
+        self._temp_dir_created = False
+
+    def add_buffer(self, data: bytes, extension: str) -> str:
+        """Keep an image's bytes (already reserved in the memory budget) and return its reference"""
+        reference = f"{MEMORY_PREFIX}image_{uuid.uuid4().hex}{extension}"
+        self.buffers[reference] = data
+        return reference
+
+    def image_source(self, image_path: str):
+        """The image's bytes for a buffered image, otherwise its path"""
+        return self.buffers.get(image_path, image_path)
+
+    def discard_image(self, image_path: str):
+        """Delete a downloaded image that is not going to be added to the session"""
+        data = self.buffers.pop(image_path, None)
+        if data is not None:
+            if self.memory_budget:
+                self.memory_budget.release(len(data))
+            return
+        try:
+            os.remove(image_path)
+        except OSError:
+            pass
+
+    def release_buffers(self):
+        if self.memory_budget:
+            for data in self.buffers.values():
+                self.memory_budget.release(len(data))
+        self.buffers.clear()
+
+    def add_image(self, image_path: str, update_id: int, file_unique_id: str = None, info: ImageInfo = None):
+        """Add image with update_id for later sorting"""
+        self.images.append((update_id, image_path))
+        if file_unique_id:
+            self.file_unique_ids[update_id] = file_unique_id
+        if info:
+            self.image_info[update_id] = info
+        self.last_activity = datetime.now()
+
+    def get_sorted_images(self) -> List[str]:
+        """Get images sorted by update_id (correct order)"""
+        sorted_images = sorted(self.images, key=lambda x: x[0])  # Sort by update_id
+        return [path for _, path in sorted_images]  # Return only paths
+
+    def reset_assembly(self):
+        """Drop the incremental PDF and cancel pages still being prepared"""
+        for task in self.page_tasks.values():
+            task.cancel()
+        self.page_tasks.clear()
+        self.assembly = None
+        self.page_slots = None
+
+    def clear(self):
+        self.reset_assembly()
+        discard_directory(self.temp_dir_path)
+        self.images.clear()
+        self.file_unique_ids.clear()
+        self.image_info.clear()
+        self.release_buffers()
+        self.temp_dir = new_temp_dir_path(self.temp_root)
+        self.last_activity = datetime.now()
+        self.status_message_id = None  # Reset status message tracking
+
+    def cleanup(self):
+        """
+        Thoroughly clean up session data and free all memory
+        """
+        # Clear image path list and pending page preparation
+        self.images.clear()
+        self.file_unique_ids.clear()
+        self.image_info.clear()
+        self.reset_assembly()
+        self.release_buffers()
+
+        # Delete temporary directory and all files
+        discard_directory(self.temp_dir_path)
+
+        # Reset status message tracking
+        self.status_message_id = None
+
+        # Update last activity time to cleanup time
+        self.last_activity = datetime.now()
+
+
+class ExpiryQueue:
+    """
+    Sessions ordered by last activity. A session is queued once, keyed by
+    its last_activity at that time; later activity is only looked at when
+    the entry reaches the front, where the session is queued again with its
+    current last_activity. Finding idle sessions therefore costs O(expired)
+    instead of a scan over every session.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, UserSession]] = []
+        self.counter = itertools.count()  # Tie breaker, sessions are not comparable
+
+    def push(self, session: UserSession):
+        heapq.heappush(self.heap, (session.last_activity.timestamp(), next(self.counter), session))
+
+    def pop_oldest(self, is_live: Callable[[UserSession], bool], before: float = None) -> Optional[UserSession]:
+        """
+        Remove and return the least recently active live session, provided
+        it was last active before the `before` timestamp (when given).
+        Entries of sessions that are no longer live are dropped on the way.
+        """
+        while self.heap:
+            queued_at, _, session = self.heap[0]
+            if before is not None and queued_at >= before:
+                return None
+            heapq.heappop(self.heap)
+            if not is_live(session):
+                continue
+            if session.last_activity.timestamp() > queued_at:
+                # Active since it was queued
+                self.push(session)
+                continue
+            return session
+        return None
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+class SessionStore(ABC):
+    """Interface shared by the session stores"""
+
+    memory_budget: Optional[MemoryBudget] = None  # Set when sessions may keep images in memory
+
+    @abstractmethod
+    async def get(self, user_id: int) -> UserSession:
+        """Return the user's session, creating it if needed"""
+
+    async def add_image(self, session: UserSession, image_path: str, update_id: int, file_unique_id: str = None,
+                        info: ImageInfo = None) -> int:
+        """Atomically append an image and return the session's image count"""
+        return await self.add_images(session, [(update_id, image_path, file_unique_id, info)])
+
+    @abstractmethod
+    async def add_images(self, session: UserSession, images: List[ImageEntry]) -> int:
+        """
+        Atomically append (update_id, image_path, file_unique_id, info)
+        entries and return the session's image count
+        """
+
+    @abstractmethod
+    async def set_status_message(self, session: UserSession, message_id: int):
+        """Remember the status message edited as images arrive"""
+
+    @abstractmethod
+    async def update_settings(self, session: UserSession, **settings):
+        """Change session settings (page_profile, compression_profile)"""
+
+    @abstractmethod
+    async def clear(self, session: UserSession):
+        """Remove all images and start a fresh temporary directory"""
+
+    @abstractmethod
+    async def touch(self, session: UserSession):
+        """Record activity on the session"""
+
+    @asynccontextmanager
+    async def busy(self, session: UserSession):
+        """
+        Keep the session from expiring or being evicted during a long
+        operation that does not hold the lock
+        """
+        session.busy += 1
+        try:
+            await self.touch(session)
+            yield
+        finally:
+            session.busy -= 1
+
+    @abstractmethod
+    async def remove_expired(self, cutoff: datetime, limit: int = None) -> List[int]:
+        """
+        Delete sessions (and their files) idle since before cutoff, least
+        recently active first and at most `limit` of them; returns their
+        user ids
+        """
+
+    @abstractmethod
+    def lock(self, user_id: int):
+        """Async context manager serializing a user's critical sections"""
+
+    @abstractmethod
+    def temp_dirs(self) -> List[str]:
+        """Directories holding session files (some may not exist yet), for disk usage reporting"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of sessions"""
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self, memory_budget: MemoryBudget = None, max_sessions: int = 0):
+        self.sessions: Dict[int, UserSession] = {}
+        self.memory_budget = memory_budget
+        self.max_sessions = max_sessions
+        self.expiry = ExpiryQueue()
+
+    def _is_live(self, session: UserSession) -> bool:
+        return self.sessions.get(session.user_id) is session
+
+    def _remove(self, session: UserSession):
+        # Clean up session data and temporary files
+        del self.sessions[session.user_id]
+        session.cleanup()
+
+    async def get(self, user_id: int) -> UserSession:
+        return self._session(user_id)
+
+    def _session(self, user_id: int) -> UserSession:
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self.sessions[user_id] = UserSession(user_id, memory_budget=self.memory_budget)
+            self.expiry.push(session)
+            # Busy sessions skipped earlier may have left the store over the limit
+            while self.max_sessions and len(self.sessions) > self.max_sessions:
+                if not self._evict_oldest(keep=session):
+                    break
+        return session
+
+    @staticmethod
+    def _in_use(session: UserSession) -> bool:
+        """A handler holds the session's lock or a long operation marked it busy"""
+        return session.update_lock.locked() or session.busy > 0
+
+    def _evict_oldest(self, keep: UserSession) -> bool:
+        """
+        Remove the least recently active session that is not in the middle
+        of an operation (its lock is held) and is not `keep`; returns False
+        when every session is busy
+        """
+        busy = []
+        oldest = self.expiry.pop_oldest(self._is_live)
+        while oldest is not None and (oldest is keep or self._in_use(oldest)):
+            busy.append(oldest)
+            oldest = self.expiry.pop_oldest(self._is_live)
+        for session in busy:
+            self.expiry.push(session)
+
+        if oldest is None:
+            logger.warning(f"Session limit {self.max_sessions} reached, but every session is busy")
+            return False
+        logger.warning(f"Session limit {self.max_sessions} reached, removing session of user {oldest.user_id}")
+        self._remove(oldest)
+        return True
+
+    async def add_images(self, session: UserSession, images: List[ImageEntry]) -> int:
+        for update_id, image_path, file_unique_id, info in images:
+            session.add_image(image_path, update_id, file_unique_id, info)
+        return len(session.images)
+
+    async def set_status_message(self, session: UserSession, message_id: int):
+        session.status_message_id = message_id
+
+    async def update_settings(self, session: UserSession, **settings):
+        for name, value in settings.items():
+            if name not in SESSION_SETTINGS:
+                raise ValueError(f"Unknown session setting: {name}")
+            setattr(session, name, value)
+
+    async def clear(self, session: UserSession):
+        session.clear()
+
+    async def touch(self, session: UserSession):
+        session.last_activity = datetime.now()
+
+    async def remove_expired(self, cutoff: datetime, limit: int = None) -> List[int]:
+        expired = []
+        busy = []
+        while limit is None or len(expired) < limit:
+            session = self.expiry.pop_oldest(self._is_live, before=cutoff.timestamp())
+            if session is None:
+                break
+            if self._in_use(session):
+                busy.append(session)
+                continue
+            self._remove(session)
+            expired.append(session.user_id)
+        # Requeued after the loop, they would be popped again right away
+        for session in busy:
+            self.expiry.push(session)
+        return expired
+
+    def lock(self, user_id: int):
+        return self._session(user_id).update_lock
+
+    def temp_dirs(self) -> List[str]:
+        return [session.temp_dir_path for session in self.sessions.values()]
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions shared by every process that opens the same directory. Each
+    process keeps UserSession objects as a cache for in-process state (locks,
+    incremental PDF); persistent fields are reloaded from the database by
+    get() and written through by the mutating methods. Images always live on
+    disk here, since other processes have to be able to read them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            temp_dir TEXT NOT NULL,
+            last_activity REAL NOT NULL,
+            status_message_id INTEGER,
+            page_profile TEXT NOT NULL,
+            compression_profile TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            user_id INTEGER NOT NULL,
+            update_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            file_unique_id TEXT,
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            mode TEXT,
+            PRIMARY KEY (user_id, update_id)
+        );
+        CREATE INDEX IF NOT EXISTS sessions_last_activity ON sessions (last_activity);
+    """
+    IMAGE_COLUMNS = (
+        ('file_unique_id', 'TEXT'), ('format', 'TEXT'), ('width', 'INTEGER'), ('height', 'INTEGER'), ('mode', 'TEXT')
+    )
+
+    def __init__(self, directory: str, max_sessions: int = 0):
+        self.directory = directory
+        self.max_sessions = max_sessions  # Enforced by remove_expired()
+        self.sessions_dir = os.path.join(directory, 'sessions')
+        self.locks_dir = os.path.join(directory, 'locks')
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+        # Queries wait up to the busy timeout for other workers' transactions,
+        # so they run in a dedicated thread instead of on the event loop
+        path = os.path.join(directory, 'sessions.db')
+        self.db = open_database(path, self._create_schema, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-db')
+        # Read-only connection for __len__: WAL readers never wait for writers
+        self.reader = sqlite3.connect(path, isolation_level=None)
+
+        self.sessions: Dict[int, UserSession] = {}  # Per-process cache
+        self.expiry = ExpiryQueue()  # Cached sessions by last activity
+        self.local_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def _create_schema(self, db: sqlite3.Connection):
+        db.executescript(self.SCHEMA)
+        columns = [row[1] for row in db.execute("PRAGMA table_info(images)")]
+        # Databases created before file_unique_id and the image header were tracked
+        for column, column_type in self.IMAGE_COLUMNS:
+            if column not in columns:
+                db.execute(f"ALTER TABLE images ADD COLUMN {column} {column_type}")
+
+    async def _run(self, function: Callable, *args):
+        """Run a database function in the database thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.db_thread, function, *args)
+
+    def _user_root(self, user_id: int) -> str:
+        return os.path.join(self.sessions_dir, str(user_id))
+
+    def _lock_path(self, user_id: int) -> str:
+        return os.path.join(self.locks_dir, f"{user_id}.lock")
+
+    def _busy_path(self, user_id: int) -> str:
+        return os.path.join(self.locks_dir, f"{user_id}.busy")
+
+    def _in_use(self, user_id: int) -> bool:
+        """A handler of this process holds or waits for the session lock, or marked the session busy"""
+        lock = self.local_locks.get(user_id)
+        session = self.sessions.get(user_id)
+        return (lock is not None and lock.locked()) or (session is not None and session.busy > 0)
+
+    # The following run in the database thread and only return rows;
+    # UserSession objects are changed on the event loop
+
+    def _load_row(self, user_id: int):
+        return self.db.execute(
+            "SELECT temp_dir, last_activity, status_message_id, page_profile, compression_profile "
+            "FROM sessions WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+
+    def _load_images(self, user_id: int):
+        return self.db.execute(
+            "SELECT update_id, path, file_unique_id, format, width, height, mode FROM images WHERE user_id = ?",
+            (user_id,)
+        ).fetchall()
+
+    def _fetch(self, user_id: int):
+        row = self._load_row(user_id)
+        if row is None:
+            # INSERT OR IGNORE: another process may create the session first
+            self.db.execute(
+                "INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, NULL, ?, ?)",
+                (user_id, new_temp_dir_path(self._user_root(user_id)), time.time(),
+                 PDF_PAGE_PROFILE, PDF_COMPRESSION_PROFILE)
+            )
+            row = self._load_row(user_id)
+        return row, self._load_images(user_id)
+
+    def _insert_images(self, user_id: int, rows: list, now: float):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO images (user_id, update_id, path, file_unique_id, format, width, height, mode) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.db.execute("UPDATE sessions SET last_activity = ? WHERE user_id = ?", (now, user_id))
+            return self._load_images(user_id)
+
+    def _reset(self, user_id: int, temp_dir: str, now: float):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM images WHERE user_id = ?", (user_id,))
+            self.db.execute(
+                "UPDATE sessions SET temp_dir = ?, last_activity = ?, status_message_id = NULL WHERE user_id = ?",
+                (temp_dir, now, user_id)
+            )
+
+    def _update(self, user_id: int, column: str, value):
+        self.db.execute(f"UPDATE sessions SET {column} = ? WHERE user_id = ?", (value, user_id))
+
+    def _expired(self, cutoff: float, limit: Optional[int]):
+        # Both queries walk the last_activity index, so only removed sessions are read
+        candidates = self.db.execute(
+            "SELECT user_id, temp_dir, last_activity FROM sessions WHERE last_activity < ? "
+            "ORDER BY last_activity LIMIT ?",
+            (cutoff, -1 if limit is None else limit)
+        ).fetchall()
+        if self.max_sessions and limit is None:
+            count = self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            excess = count - len(candidates) - self.max_sessions
+            if excess > 0:
+                logger.warning(f"Session limit {self.max_sessions} exceeded, removing {excess} more sessions")
+                candidates += self.db.execute(
+                    "SELECT user_id, temp_dir, last_activity FROM sessions WHERE last_activity >= ? "
+                    "ORDER BY last_activity LIMIT ?",
+                    (cutoff, excess)
+                ).fetchall()
+        return candidates
+
+    def _delete_idle(self, user_id: int, temp_dir: str, last_activity: float) -> bool:
+        fd = os.open(self._lock_path(user_id), os.O_RDWR | os.O_CREAT, 0o600)
+        busy_fd = os.open(self._busy_path(user_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(busy_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # A handler in this or another worker holds the session lock or marked the session busy
+                return False
+            with self.db:
+                self.db.execute("BEGIN IMMEDIATE")
+                # Re-check inside the transaction: another worker may have just used the session
+                cursor = self.db.execute(
+                    "DELETE FROM sessions WHERE user_id = ? AND last_activity <= ?", (user_id, last_activity)
+                )
+                if cursor.rowcount:
+                    self.db.execute("DELETE FROM images WHERE user_id = ?", (user_id,))
+        finally:
+            # Closing the descriptors releases the locks
+            os.close(busy_fd)
+            os.close(fd)
+        if cursor.rowcount:
+            discard_directory(temp_dir)
+        return bool(cursor.rowcount)
+
+    @staticmethod
+    def _apply_images(session: UserSession, rows: list):
+        session.images = [(update_id, path) for update_id, path, *_ in rows]
+        session.file_unique_ids = {update_id: unique_id for update_id, _, unique_id, *_ in rows if unique_id}
+        session.image_info = {
+            update_id: ImageInfo(*header) for update_id, _, _, *header in rows if header[1] is not None
+        }
+
+    async def get(self, user_id: int) -> UserSession:
+        row, images = await self._run(self._fetch, user_id)
+
+        temp_dir, last_activity, status_message_id, page_profile, compression_profile = row
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = UserSession(user_id, temp_root=self._user_root(user_id), temp_dir=temp_dir)
+            session.last_activity = datetime.fromtimestamp(last_activity)
+            self.sessions[user_id] = session
+            self.expiry.push(session)
+        elif session.temp_dir_path != temp_dir:
+            # Cleared by another process: the local PDF body is stale
+            session.reset_assembly()
+            session.temp_dir = temp_dir
+
+        session.last_activity = datetime.fromtimestamp(last_activity)
+        session.status_message_id = status_message_id
+        session.page_profile = page_profile
+        session.compression_profile = compression_profile
+        self._apply_images(session, images)
+        return session
+
+    async def add_images(self, session: UserSession, images: List[ImageEntry]) -> int:
+        now = time.time()
+        rows = [
+            (session.user_id, update_id, image_path, unique_id,
+             *((info.format, info.width, info.height, info.mode) if info else (None,) * 4))
+            for update_id, image_path, unique_id, info in images
+        ]
+        self._apply_images(session, await self._run(self._insert_images, session.user_id, rows, now))
+        session.last_activity = datetime.fromtimestamp(now)
+        return len(session.images)
+
+    async def set_status_message(self, session: UserSession, message_id: int):
+        await self._run(self._update, session.user_id, 'status_message_id', message_id)
+        session.status_message_id = message_id
+
+    async def update_settings(self, session: UserSession, **settings):
+        for name, value in settings.items():
+            if name not in SESSION_SETTINGS:
+                raise ValueError(f"Unknown session setting: {name}")
+            await self._run(self._update, session.user_id, name, value)
+            setattr(session, name, value)
+
+    async def clear(self, session: UserSession):
+        session.clear()
+        await self._run(self._reset, session.user_id, session.temp_dir_path, time.time())
+
+    async def touch(self, session: UserSession):
+        now = time.time()
+        await self._run(self._update, session.user_id, 'last_activity', now)
+        session.last_activity = datetime.fromtimestamp(now)
+
+    @asynccontextmanager
+    async def busy(self, session: UserSession):
+        """Also holds a shared flock that expiry in other workers checks"""
+        fd = os.open(self._busy_path(session.user_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_SH)
+            async with super().busy(session):
+                yield
+        finally:
+            os.close(fd)
+
+    async def remove_expired(self, cutoff: datetime, limit: int = None) -> List[int]:
+        # Busy sessions are skipped; they stay in the table and come up again next time
+        removed = []
+        for user_id, temp_dir, last_activity in await self._run(self._expired, cutoff.timestamp(), limit):
+            if not self._in_use(user_id) and await self._run(self._delete_idle, user_id, temp_dir, last_activity):
+                removed.append(user_id)
+
+        # Drop cached sessions this process no longer needs
+        busy = []
+        while True:
+            session = self.expiry.pop_oldest(lambda s: self.sessions.get(s.user_id) is s, before=cutoff.timestamp())
+            if session is None:
+                break
+            if self._in_use(session.user_id):
+                busy.append(session)
+                continue
+            del self.sessions[session.user_id]
+            session.reset_assembly()
+            self.local_locks.pop(session.user_id, None)
+        for session in busy:
+            self.expiry.push(session)
+        return removed
+
+    @asynccontextmanager
+    async def lock(self, user_id: int):
+        """In-process lock first, then an exclusive flock shared with other workers"""
+        async with self.local_locks[user_id]:
+            fd = os.open(self._lock_path(user_id), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    def temp_dirs(self) -> List[str]:
+        return [self.sessions_dir]
+
+    def __len__(self) -> int:
+        return self.reader.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_session_store() -> SessionStore:
+    """Build the store selected by SESSION_STORE (memory or sqlite)"""
+    kind = os.getenv('SESSION_STORE', 'memory').lower()
+    if kind == 'memory':
+        return InMemorySessionStore(MemoryBudget.from_env(), MAX_SESSIONS)
+    if kind == 'sqlite':
+        directory = os.getenv('SESSION_DIR', os.path.join(tempfile.gettempdir(), 'img2pdf_sessions'))
+        os.makedirs(directory, exist_ok=True)
+        logger.info(f"Using SQLite session store in {directory}")
+        return SQLiteSessionStore(directory, MAX_SESSIONS)
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
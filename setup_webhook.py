@@ -7,28 +7,53 @@ Used to set up and manage Telegram bot webhooks
 import os
 import asyncio
 import argparse
-from telegram import Bot
+import hashlib
+from typing import Optional
+from telegram import Bot, Update
+
+# Update types Telegram sends to the webhook (the ones the bot's handlers use)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def webhook_target(webhook_url: str = None, secret_token: str = None) -> Optional[str]:
+    """
+    The /webhook URL to register for a deployment at webhook_url
+    (WEBHOOK_URL by default), or None when unset. getWebhookInfo does not
+    return the secret token, so the URL carries a fingerprint of it
+    (ignored by /webhook) to tell whether the registered webhook is current.
+    """
+    webhook_url = webhook_url or os.getenv('WEBHOOK_URL')
+    if not webhook_url:
+        return None
+    url = webhook_url.rstrip('/')
+    if not url.endswith('/webhook'):
+        url += '/webhook'
+    if secret_token is None:
+        secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+    if secret_token:
+        url += f"?secret_id={hashlib.sha256(secret_token.encode()).hexdigest()[:12]}"
+    return url
+
+def without_query(url: str) -> str:
+    """The URL without its query string (the secret fingerprint), for logs and output"""
+    return url.split('?', 1)[0]
 
 async def set_webhook(token: str, webhook_url: str, secret_token: str = None):
     """Set webhook"""
     bot = Bot(token=token)
+    url = webhook_target(webhook_url, secret_token)
 
     try:
         # Set webhook
-        if secret_token:
-            result = await bot.set_webhook(url=webhook_url, secret_token=secret_token)
-            print(f"✅ Webhook set successfully: {webhook_url} (with secret token)")
-        else:
-            result = await bot.set_webhook(url=webhook_url)
-            print(f"✅ Webhook set successfully: {webhook_url} (no secret token)")
+        result = await bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=ALLOWED_UPDATES)
+        print(f"✅ Webhook set successfully: {without_query(url)} ({'with' if secret_token else 'no'} secret token)")
 
         if not result:
             print("❌ Failed to set webhook")
 
         # Get webhook information
         webhook_info = await bot.get_webhook_info()
-        print(f"\nCurrent Webhook Information:")
-        print(f"URL: {webhook_info.url}")
+        print("\nCurrent Webhook Information:")
+        print(f"URL: {without_query(webhook_info.url)}")
         print(f"Pending updates: {webhook_info.pending_update_count}")
         print(f"Last error date: {webhook_info.last_error_date}")
         print(f"Last error message: {webhook_info.last_error_message}")
@@ -56,7 +81,7 @@ async def get_webhook_info(token: str):
     try:
         webhook_info = await bot.get_webhook_info()
         print("Current Webhook Information:")
-        print(f"URL: {webhook_info.url or 'Not set'}")
+        print(f"URL: {without_query(webhook_info.url) or 'Not set'}")
         print(f"Pending updates: {webhook_info.pending_update_count}")
         print(f"Last error date: {webhook_info.last_error_date or 'None'}")
         print(f"Last error message: {webhook_info.last_error_message or 'None'}")
@@ -70,7 +95,7 @@ def main():
     parser.add_argument("action", choices=["set", "delete", "info"],
                        help="Action type: set (configure), delete (remove), info (view information)")
     parser.add_argument("--token", help="Bot token (or set BOT_TOKEN environment variable)")
-    parser.add_argument("--url", help="Webhook URL (only for set operation)")
+    parser.add_argument("--url", help="Public base URL of the bot, /webhook is appended (only for set operation)")
     parser.add_argument("--secret", help="Secret token for webhook verification (optional)")
 
     args = parser.parse_args()
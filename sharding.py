@@ -0,0 +1,346 @@
+"""
+User-affinity sharding for the webhook server
+
+Runs the bot as N local worker processes behind a small front process. The
+front process receives Telegram's webhook calls, reads the user id from the
+raw update and forwards the request to the worker that owns the user on a
+consistent hash ring. Each worker is a normal single-process bot with its
+own in-memory sessions, so per-user locking and ordering behave exactly as
+with one process while throughput scales with the number of workers.
+
+Workers are health checked and restarted when they exit or stop answering.
+While a worker is down its users fall through to the next worker on the
+ring and move back once it is healthy again; in-memory sessions do not
+follow them (use SESSION_STORE=sqlite with a shared SESSION_DIR to keep
+sessions across such moves).
+
+Usage: uvicorn sharding:app --host 0.0.0.0 --port 8001 (or python sharding.py)
+"""
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+
+# Load environment variables
+load_dotenv()
+
+from telegram import Bot
+
+from telegram_img2pdf_bot import TELEGRAM_API_BASE_URL, check_admin_token, check_webhook_request, register_webhook
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+# Health checks would otherwise log a line per worker every few seconds
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Points per worker on the hash ring; more points spread users more evenly
+RING_REPLICAS = 128
+
+# Consecutive failed health checks before a running worker is restarted
+MAX_HEALTH_FAILURES = 3
+
+# Time allowed for a freshly started worker to answer its first health check
+WORKER_STARTUP_TIMEOUT = 60
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def extract_user_id(data: dict) -> Optional[int]:
+    """Find the id of the user an update belongs to without building an Update object"""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            entity = value.get(field)
+            if isinstance(entity, dict) and 'id' in entity:
+                return entity['id']
+    return None
+
+
+class HashRing:
+    """Consistent hash ring mapping user ids to worker indexes"""
+
+    def __init__(self, nodes: List[int], replicas: int = RING_REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"worker-{node}:{i}"), node) for node in self.nodes for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def _walk(self, start: int, available) -> Optional[int]:
+        for offset in range(len(self.owners)):
+            node = self.owners[(start + offset) % len(self.owners)]
+            if available is None or node in available:
+                return node
+        return None
+
+    def lookup(self, key, available=None) -> Optional[int]:
+        """
+        Return the worker owning `key`. When the owner is not in
+        `available`, walk the ring to the next worker that is.
+        """
+        if not self.owners:
+            return None
+        return self._walk(bisect.bisect_left(self.hashes, _hash(str(key))), available)
+
+    def shares(self, available=None) -> Dict[int, float]:
+        """Fraction of the key space each worker currently serves"""
+        shares = {node: 0.0 for node in self.nodes}
+        total = 2 ** 64
+        for i, point in enumerate(self.hashes):
+            node = self._walk(i, available)
+            if node is None:
+                continue
+            previous = self.hashes[i - 1] if i else self.hashes[-1] - total
+            shares[node] += (point - previous) / total
+        return {node: round(share, 4) for node, share in shares.items()}
+
+
+class ShardWorker:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.healthy = False
+        self.health_failures = 0
+        self.restarts = 0
+        self.started_at: Optional[float] = None
+        self.forwarded = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        env = dict(os.environ)
+        env['SHARD_INDEX'] = str(self.index)
+        env['PORT'] = str(self.port)
+        # The front process already checked the caller's IP; workers only see 127.0.0.1
+        env['WEBHOOK_VERIFY_IP'] = 'false'
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'uvicorn', 'telegram_img2pdf_bot:app',
+            '--host', '127.0.0.1', '--port', str(self.port),
+            env=env,
+        )
+        self.healthy = False
+        self.health_failures = 0
+        self.started_at = time.time()
+        logger.info(f"Started shard worker {self.index} on port {self.port} (pid {self.process.pid})")
+
+    async def stop(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), 10)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    def describe(self) -> dict:
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'healthy': self.healthy,
+            'restarts': self.restarts,
+            'uptime': round(time.time() - self.started_at, 1) if self.started_at else None,
+            'forwarded': self.forwarded,
+        }
+
+
+class ShardManager:
+    def __init__(self, workers: int = 2, base_port: int = 9100, health_interval: float = 5.0):
+        self.workers = [ShardWorker(i, base_port + i) for i in range(max(1, workers))]
+        self.ring = HashRing([worker.index for worker in self.workers])
+        self.health_interval = health_interval
+        self.client: Optional[httpx.AsyncClient] = None
+        self.health_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls) -> 'ShardManager':
+        return cls(
+            workers=int(os.getenv('SHARD_WORKERS', os.cpu_count() or 2)),
+            base_port=int(os.getenv('SHARD_BASE_PORT', 9100)),
+            health_interval=float(os.getenv('SHARD_HEALTH_INTERVAL', 5)),
+        )
+
+    def available(self) -> set:
+        return {worker.index for worker in self.workers if worker.healthy}
+
+    def route(self, user_id) -> Optional[ShardWorker]:
+        index = self.ring.lookup(user_id, self.available())
+        return self.workers[index] if index is not None else None
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=30)
+        for worker in self.workers:
+            await worker.start()
+
+        # Wait for the workers to come up before accepting traffic
+        deadline = time.monotonic() + WORKER_STARTUP_TIMEOUT
+        while time.monotonic() < deadline and len(self.available()) < len(self.workers):
+            await asyncio.sleep(0.5)
+            for worker in self.workers:
+                if not worker.healthy:
+                    await self.check_worker(worker)
+        logger.info(f"Shard workers ready: {len(self.available())}/{len(self.workers)}")
+        self.health_task = asyncio.create_task(self.health_loop())
+
+    async def stop(self):
+        if self.health_task:
+            self.health_task.cancel()
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        if self.client:
+            await self.client.aclose()
+
+    async def check_worker(self, worker: ShardWorker) -> bool:
+        try:
+            # Liveness only: a busy worker sheds load itself and keeps its users
+            response = await self.client.get(f"{worker.url}/health/live", timeout=2)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+
+        was_healthy = worker.healthy
+        worker.healthy = ok
+        worker.health_failures = 0 if ok else worker.health_failures + 1
+        if ok != was_healthy:
+            self.log_rebalance(worker)
+        return ok
+
+    def log_rebalance(self, worker: ShardWorker):
+        state = 'joined' if worker.healthy else 'left'
+        logger.info(f"Shard worker {worker.index} {state} the ring, key space: {self.ring.shares(self.available())}")
+
+    async def restart_worker(self, worker: ShardWorker):
+        if worker.healthy:
+            worker.healthy = False
+            self.log_rebalance(worker)
+        await worker.stop()
+        worker.restarts += 1
+        await worker.start()
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in self.workers:
+                try:
+                    if worker.process.returncode is not None:
+                        logger.error(f"Shard worker {worker.index} exited with code {worker.process.returncode}, restarting")
+                        await self.restart_worker(worker)
+                    elif not await self.check_worker(worker):
+                        in_startup = time.time() - worker.started_at < WORKER_STARTUP_TIMEOUT
+                        if worker.health_failures >= MAX_HEALTH_FAILURES and not in_startup:
+                            logger.error(f"Shard worker {worker.index} failed {worker.health_failures} health checks, restarting")
+                            await self.restart_worker(worker)
+                except Exception as e:
+                    logger.error(f"Error checking shard worker {worker.index}: {e}")
+
+    async def forward(self, body: bytes, headers: dict, user_id) -> Response:
+        """Forward a webhook body to the worker owning user_id"""
+        for _ in range(len(self.workers)):
+            worker = self.route(user_id)
+            if worker is None:
+                break
+            try:
+                response = await self.client.post(f"{worker.url}/webhook", content=body, headers=headers)
+            except httpx.ConnectError:
+                # Nothing reached the worker, so it is safe to try the next one
+                worker.healthy = False
+                self.log_rebalance(worker)
+                continue
+            except httpx.HTTPError as e:
+                logger.error(f"Error forwarding update to shard worker {worker.index}: {e}")
+                raise HTTPException(status_code=502, detail="Shard worker unavailable")
+            worker.forwarded += 1
+            # Keep Retry-After so Telegram backs off when a worker sheds load
+            headers = {'Retry-After': response.headers['retry-after']} if 'retry-after' in response.headers else None
+            return Response(content=response.content, status_code=response.status_code,
+                            media_type=response.headers.get('content-type'), headers=headers)
+        raise HTTPException(status_code=503, detail="No shard workers available")
+
+    def describe(self) -> dict:
+        available = self.available()
+        shares = self.ring.shares(available)
+        return {
+            'workers': [dict(worker.describe(), share=shares[worker.index]) for worker in self.workers],
+            'available': len(available),
+            'replicas': RING_REPLICAS,
+        }
+
+
+# Global variables
+app = FastAPI(title="Telegram Image to PDF Bot (sharded)")
+shards: Optional[ShardManager] = None
+
+@app.on_event("startup")
+async def startup_event():
+    global shards
+    shards = ShardManager.from_env()
+    await shards.start()
+
+    token = os.getenv('BOT_TOKEN')
+    if token:
+        bot = Bot(token=token, base_url=f"{TELEGRAM_API_BASE_URL}/bot",
+                  base_file_url=f"{TELEGRAM_API_BASE_URL}/file/bot")
+        async with bot:
+            await register_webhook(bot)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if shards:
+        await shards.stop()
+
+@app.post("/webhook")
+async def webhook(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    check_webhook_request(request, x_telegram_bot_api_secret_token)
+
+    body = await request.body()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request data")
+    # Valid JSON but not an update object, e.g. a list or a string
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid request data")
+    user_id = extract_user_id(data)
+
+    headers = {'Content-Type': 'application/json'}
+    if x_telegram_bot_api_secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = x_telegram_bot_api_secret_token
+    return await shards.forward(body, headers, user_id)
+
+@app.get("/health")
+async def health():
+    available = len(shards.available()) if shards else 0
+    if not available:
+        raise HTTPException(status_code=503, detail="No shard workers available")
+    return {"status": "healthy", "workers": available}
+
+@app.get("/admin/shards")
+async def shard_map(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    return shards.describe()
+
+def main():
+    import uvicorn
+    port = int(os.getenv('PORT', 8000))
+    uvicorn.run(app, host="0.0.0.0", port=port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+SQLite databases shared by worker processes
+
+Every worker opens the same database files at startup. Switching a new
+database to WAL journaling and creating or migrating its tables take an
+exclusive lock, and SQLite does not wait for it while changing the journal
+mode: workers starting at the same time failed with "database is locked".
+The setup therefore runs under an exclusive flock on a file next to the
+database, one worker at a time.
+"""
+
+import fcntl
+import os
+import sqlite3
+from typing import Callable
+
+
+def open_database(path: str, setup: Callable[[sqlite3.Connection], None], timeout: float = 10,
+                  check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Connect to the database at `path` in autocommit mode, switch it to WAL
+    and run setup(db) (schema creation and migrations) while holding the
+    setup lock. Pass check_same_thread=False for a connection that is used
+    from a worker thread.
+    """
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=check_same_thread)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            setup(db)
+        except Exception:
+            db.close()
+            raise
+        return db
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
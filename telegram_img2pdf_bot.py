@@ -1,29 +1,23 @@
+import io
 import os
 import logging
-import tempfile
-import shutil
 import uuid
 import time
-import gc
-import psutil
+
+# Startup is timed from here (see the img2pdf_startup_seconds metric)
+MODULE_LOADED_AT = time.monotonic()
+
 from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import Dict, List
-from PIL import Image
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
-try:
-    from pillow_heif import register_heif_opener
-    register_heif_opener()
-    HEIF_AVAILABLE = True
-except ImportError:
-    HEIF_AVAILABLE = False
-
-from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, Header
+
+from fastapi import FastAPI, Request, HTTPException, Header, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import ipaddress
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, InputFile, Message
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -34,64 +28,366 @@ from telegram.ext import (
 )
 import asyncio
 
+from pdf_render import (
+    COMPRESSION_PROFILES, PAGE_PROFILES, ImageInfo, ImageTooLarge, IncrementalPDF, RenderOptions,
+    decoded_pixels, describe_source, prepare_jpeg_passthrough, probe_image, register_heif
+)
+from render_pool import RenderPool, RenderTimeout
+from session_store import UserSession, create_session_store
+from update_dispatcher import UpdateDispatcher, release_slot
+from admission import AdmissionController
+from memory_governor import MemoryGovernor
+from metrics import (
+    ACTIVE_SESSIONS, IMAGES_REJECTED, QUEUED_UPDATES, RENDER_PIXELS_IN_FLIGHT, RENDERS_IN_FLIGHT, RENDERS_QUEUED,
+    SESSION_DISK_BYTES, SESSION_MEMORY_BYTES, STAGE_SECONDS, STARTUP_SECONDS, UPDATES_IN_FLIGHT, InstrumentedRequest,
+    directory_bytes, observe_page
+)
+from profiler import Profile
+from media_groups import MediaGroupCollector, MediaGroupItem
+from download_cache import DownloadCache
+from result_cache import ResultCache, result_key
+from setup_webhook import ALLOWED_UPDATES, webhook_target, without_query
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+IMPORTED_AT = time.monotonic()
+
+# Minimum time between two edits of a user's status message (Telegram
+# flood-limits frequent edits in the same chat)
+STATUS_UPDATE_INTERVAL = int(os.getenv('STATUS_UPDATE_INTERVAL_MS', 1000)) / 1000
+
+# Sessions idle for this many seconds are removed, checked every
+# SESSION_CLEANUP_INTERVAL seconds (see session_store for MAX_SESSIONS)
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', 1800))
+SESSION_CLEANUP_INTERVAL = int(os.getenv('SESSION_CLEANUP_INTERVAL', 60))
+
+# Concurrent downloads per album
+MEDIA_GROUP_DOWNLOADS = int(os.getenv('MEDIA_GROUP_DOWNLOADS', 4))
+
+# Bot API server: a local telegram-bot-api server, or fake_bot_api.py for load tests
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org').rstrip('/')
+
+# PDFs larger than this are sent as several part PDFs (the Bot API accepts
+# uploads up to 50 MB; a local Bot API server up to 2000 MB)
+PDF_PART_MAX_BYTES = int(float(os.getenv('PDF_PART_MAX_MB', 49)) * 1024 * 1024)
+
+# Images with more pixels are rejected when their header is probed after download
+MAX_IMAGE_MEGAPIXELS = float(os.getenv('MAX_IMAGE_MEGAPIXELS', 100))
+
+# Pages of one session's PDF prepared in the render pool at the same time, so
+# a large album does not queue ahead of every other user's pages (0: no cap)
+RENDER_PAGE_WORKERS = int(os.getenv('RENDER_PAGE_WORKERS', 4))
+
+
+class PendingStatus:
+    """Coalesced status message update for one user"""
 
-class UserSession:
     def __init__(self):
-        self.images: List[tuple[int, str]] = []  # List of (update_id, image_path) tuples
-        self.temp_dir = tempfile.mkdtemp()
-        self.last_activity = datetime.now()
-        self.status_message_id: int = None  # Track the status message for updates
-        self.update_lock = asyncio.Lock()  # Single lock for add_image + status update (critical section)
-
-    def add_image(self, image_path: str, update_id: int):
-        """Add image with update_id for later sorting"""
-        self.images.append((update_id, image_path))
-        self.last_activity = datetime.now()
-
-    def get_sorted_images(self) -> List[str]:
-        """Get images sorted by update_id (correct order)"""
-        sorted_images = sorted(self.images, key=lambda x: x[0])  # Sort by update_id
-        return [path for _, path in sorted_images]  # Return only paths
-
-    def clear(self):
-        if os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
-        self.images.clear()
-        self.temp_dir = tempfile.mkdtemp()
-        self.last_activity = datetime.now()
-        self.status_message_id = None  # Reset status message tracking
-
-    def cleanup(self):
-        """
-        Thoroughly clean up session data and free all memory
-        """
-        # Clear image path list
-        self.images.clear()
+        self.dirty = False
+        self.bot = None
+        self.chat_id = None
+        self.message = None  # Latest message, used to reply when a new status message is needed
+        self.task = None
+        self.last_flush = 0.0
+        self.last_text = None
 
-        # Delete temporary directory and all files
-        if os.path.exists(self.temp_dir):
-            try:
-                shutil.rmtree(self.temp_dir)
-            except Exception as e:
-                logger.error(f"Error cleaning temporary directory: {e}")
 
-        # Reset status message tracking
-        self.status_message_id = None
+class StreamingInputFile(InputFile):
+    """
+    InputFile that passes the open file to httpx, which streams it in
+    chunks, instead of reading the whole PDF into memory first
+    """
+
+    def __init__(self, fp: BinaryIO, filename: str):
+        super().__init__(b'', filename=filename)
+        self.input_file_content = fp
 
-        # Update last activity time to cleanup time
-        self.last_activity = datetime.now()
 
 class Img2PDFBot:
     def __init__(self):
-        self.user_sessions: Dict[int, UserSession] = defaultdict(UserSession)
-        self.supported_extensions = ['.png', '.jpeg', '.jpg']
-        if HEIF_AVAILABLE:
-            self.supported_extensions.extend(['.heic', '.heif'])
+        self.sessions = create_session_store()
+        self.render_pool = RenderPool.from_env()
+        self.pending_status: Dict[int, PendingStatus] = {}
+        self.media_groups = MediaGroupCollector(self.process_media_group)
+        self.download_cache = DownloadCache.from_env()
+        self.result_cache = ResultCache.from_env()
+        self.profile: Optional[Profile] = None  # Running admin profile, told about generated PDFs
+
+    @property
+    def supported_extensions(self) -> List[str]:
+        # register_heif() turns HEIC support off when pillow-heif fails to load
+        extensions = ['.png', '.jpeg', '.jpg']
+        if register_heif():
+            extensions.extend(['.heic', '.heif'])
+        return extensions
+
+    def build_status_keyboard(self, session: UserSession) -> InlineKeyboardMarkup:
+        page_label = PAGE_PROFILES[session.page_profile].label
+        compression_label = COMPRESSION_PROFILES[session.compression_profile].label
+        keyboard = [
+            [
+                InlineKeyboardButton("📄 Generate PDF", callback_data="generate_pdf"),
+                InlineKeyboardButton(f"🗜️ {compression_label}", callback_data="compression_menu")
+            ],
+            [InlineKeyboardButton(f"📐 Page: {page_label}", callback_data="page_profile_menu")],
+            [InlineKeyboardButton("🗑️ Clear Images", callback_data="clear_images")]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+    def build_choice_keyboard(self, profiles: dict, current: str, prefix: str) -> InlineKeyboardMarkup:
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{'✔️ ' if name == current else ''}{profile.label}",
+                callback_data=f"{prefix}:{name}"
+            )]
+            for name, profile in profiles.items()
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+    def build_status_text(self, session: UserSession) -> str:
+        return f"✅ Image received! Currently have {len(session.images)} image{'s' if len(session.images) > 1 else ''}."
+
+    def render_options(self, session: UserSession) -> RenderOptions:
+        return RenderOptions(
+            page_profile=session.page_profile,
+            compression_profile=session.compression_profile,
+            page_workers=RENDER_PAGE_WORKERS
+        )
+
+    def result_key(self, session: UserSession) -> Optional[str]:
+        """Result cache key for the session's images, None if an image has no file_unique_id"""
+        unique_ids = [session.file_unique_ids.get(update_id) for update_id, _ in sorted(session.images)]
+        if not unique_ids or None in unique_ids:
+            return None
+        return result_key(unique_ids, self.render_options(session).signature)
+
+    async def send_cached_result(self, session: UserSession, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 key: str) -> bool:
+        """Resend a PDF already uploaded for the same images and settings; False on a miss"""
+        cached = self.result_cache.get(key)
+        if cached is None:
+            return False
+
+        file_id, page_count = cached
+        try:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=file_id,
+                caption=f"✅ PDF generated successfully! Contains {page_count} images."
+            )
+        except Exception as e:
+            # The file_id is no longer valid; render and upload again
+            logger.warning(f"Could not resend cached PDF: {e}")
+            self.result_cache.discard(key)
+            return False
+
+        logger.info(f"[User {update.effective_user.id}] Sent cached PDF with {page_count} pages")
+        return True
+
+    def schedule_page(self, session: UserSession, update_id: int, image_path: str):
+        """
+        Prepare the page for a newly added image in the background and append
+        it to the session's PDF body, so generating the PDF later only has to
+        write the page order and trailer
+        """
+        options = self.render_options(session)
+        if session.assembly is None or session.assembly.signature != options.signature:
+            self.restart_assembly(session)
+            return
+        session.page_tasks[update_id] = asyncio.create_task(
+            self.prepare_page_in_background(session, session.assembly, update_id, image_path, options)
+        )
+
+    def restart_assembly(self, session: UserSession):
+        """Start a new PDF body with the current settings and prepare every image for it"""
+        session.reset_assembly()
+        options = self.render_options(session)
+        assembly_path = os.path.join(session.temp_dir, f"assembly_{uuid.uuid4().hex[:8]}.pdf")
+        session.assembly = IncrementalPDF(assembly_path, options.signature)
+        if options.page_workers > 0:
+            session.page_slots = asyncio.Semaphore(options.page_workers)
+        for update_id, image_path in session.images:
+            session.page_tasks[update_id] = asyncio.create_task(
+                self.prepare_page_in_background(session, session.assembly, update_id, image_path, options)
+            )
+
+    async def prepare_page_in_background(self, session: UserSession, assembly: IncrementalPDF,
+                                         update_id: int, image_path: str, options: RenderOptions):
+        page_path = os.path.join(os.path.dirname(assembly.path), f"page_{update_id}.bin")
+        source = session.image_source(image_path)
+        try:
+            page = None
+            if isinstance(source, bytes) and options.compression.passthrough:
+                # Only the JPEG header is parsed; the page embeds the buffer itself
+                page = prepare_jpeg_passthrough(source, options.page)
+            if page is None:
+                info = session.image_info.get(update_id)
+                pixels = decoded_pixels(info, options) if info else 0
+                if session.page_slots is None:
+                    page = await self.render_pool.prepare(source, page_path, options, pixels)
+                else:
+                    async with session.page_slots:
+                        page = await self.render_pool.prepare(source, page_path, options, pixels)
+        except RenderTimeout:
+            logger.error(f"Preparing the page for image file {describe_source(source)} timed out")
+            return
+        except Exception as e:
+            logger.error(f"Cannot prepare page for image file {describe_source(source)}: {e}")
+            return
+        observe_page(page)
+
+        try:
+            async with session.assembly_lock:
+                # The body may have been dropped by /clear or a settings change meanwhile
+                if session.assembly is assembly:
+                    await asyncio.to_thread(assembly.append, update_id, page)
+        except Exception as e:
+            # E.g. the session directory was removed by expiry or /clear
+            logger.error(f"Cannot add the page for image file {describe_source(source)} to the PDF: {e}")
+        finally:
+            if page.source_path == page_path:
+                try:
+                    os.remove(page_path)
+                except OSError:
+                    pass
+
+    async def finalize_pdf_parts(self, session: UserSession) -> AsyncIterator[tuple]:
+        """
+        Wait for the session's pages in update_id order and yield
+        (pdf_path, page_count, is_part) for each PDF to send. A PDF over
+        PDF_PART_MAX_BYTES is split at page boundaries into part files, each
+        yielded as soon as its last page is ready so it can be uploaded while
+        later pages are still being prepared. Otherwise the assembly itself
+        is finalized and yielded as the only file.
+        """
+        options = self.render_options(session)
+        if session.assembly is None or session.assembly.signature != options.signature:
+            self.restart_assembly(session)
+        assembly = session.assembly
+
+        images = sorted(session.images)
+        for update_id, image_path in images:
+            # Images added through another worker have not been prepared here yet
+            if update_id not in session.page_tasks:
+                session.page_tasks[update_id] = asyncio.create_task(
+                    self.prepare_page_in_background(session, assembly, update_id, image_path, options)
+                )
+        keys = [update_id for update_id, _ in images]
+
+        part: List[int] = []
+        part_number = 0
+        for key in keys:
+            await asyncio.gather(session.page_tasks[key], return_exceptions=True)
+            if key not in assembly.page_refs:
+                # The image could not be prepared
+                continue
+            if part and assembly.part_size(part + [key]) > PDF_PART_MAX_BYTES:
+                part_number += 1
+                part_path = f"{os.path.splitext(assembly.path)[0]}_part{part_number}.pdf"
+                yield part_path, await asyncio.to_thread(assembly.write_part, part, part_path), True
+                part = []
+            part.append(key)
+
+        if part and part_number:
+            part_path = f"{os.path.splitext(assembly.path)[0]}_part{part_number + 1}.pdf"
+            yield part_path, await asyncio.to_thread(assembly.write_part, part, part_path), True
+        elif part:
+            async with session.assembly_lock:
+                page_count = await asyncio.to_thread(assembly.finalize, keys)
+            yield assembly.path, page_count, False
+
+    async def upload_pdf(self, bot: Bot, chat_id: int, pdf_path: str, filename: str, caption: str,
+                         previous: Optional[asyncio.Task] = None, remove: bool = False) -> Message:
+        """
+        Send a PDF streamed from disk, after the `previous` upload (so parts
+        arrive in order). With `remove` the file is deleted afterwards.
+        """
+        try:
+            if previous is not None:
+                await previous
+            with open(pdf_path, 'rb') as pdf_file, STAGE_SECONDS.labels('upload').time():
+                return await bot.send_document(
+                    chat_id=chat_id,
+                    document=StreamingInputFile(pdf_file, filename),
+                    caption=caption
+                )
+        finally:
+            if remove:
+                try:
+                    os.remove(pdf_path)
+                except OSError:
+                    pass
+
+    def request_status_update(self, user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Mark the user's status message as out of date. Edits are flushed at
+        most every STATUS_UPDATE_INTERVAL seconds and always show the
+        latest image count, so a burst of images ends with a single edit.
+        """
+        pending = self.pending_status.get(user_id)
+        if pending is None:
+            pending = self.pending_status[user_id] = PendingStatus()
+        pending.dirty = True
+        pending.bot = context.bot
+        pending.chat_id = update.effective_chat.id
+        pending.message = update.message
+        if pending.task is None:
+            pending.task = asyncio.create_task(self.flush_status_updates(user_id, pending))
+
+    async def flush_status_updates(self, user_id: int, pending: PendingStatus):
+        try:
+            # Keep running for one interval after the last edit so that
+            # images arriving meanwhile are folded into the next edit
+            while True:
+                delay = pending.last_flush + STATUS_UPDATE_INTERVAL - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not pending.dirty:
+                    break
+                pending.dirty = False
+                pending.last_flush = time.monotonic()
+                try:
+                    await self.send_status(user_id, pending)
+                except Exception as e:
+                    logger.error(f"[User {user_id}] Could not update status message: {e}")
+        finally:
+            pending.task = None
+            if self.pending_status.get(user_id) is pending:
+                del self.pending_status[user_id]
+
+    async def send_status(self, user_id: int, pending: PendingStatus):
+        """Show the current image count in the status message, creating it if needed"""
+        session = await self.sessions.get(user_id)
+        if not session.images:
+            # Cleared or converted while the update was pending
+            return
+
+        status_text = self.build_status_text(session)
+        if session.status_message_id and status_text == pending.last_text:
+            return
+        reply_markup = self.build_status_keyboard(session)
+
+        # Update existing status message or create new one
+        if session.status_message_id:
+            try:
+                await pending.bot.edit_message_text(
+                    chat_id=pending.chat_id,
+                    message_id=session.status_message_id,
+                    text=status_text,
+                    reply_markup=reply_markup
+                )
+                pending.last_text = status_text
+                return
+            except Exception as e:
+                # If editing fails (message too old or deleted), send new message
+                logger.warning(f"Could not edit status message: {e}")
+
+        sent_message = await pending.message.reply_text(status_text, reply_markup=reply_markup)
+        await self.sessions.set_status_message(session, sent_message.message_id)
+        pending.last_text = status_text
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome_message = (
@@ -118,83 +414,187 @@ class Img2PDFBot:
             "Important notes:\n"
             "• Images will be arranged in PDF in sending order\n"
             "• Supports transparent background images (auto-converted to white background)\n"
-            "• Sessions will be automatically cleaned after 30 minutes of inactivity"
+            f"• Sessions will be automatically cleaned after {SESSION_IDLE_TTL // 60} minutes of inactivity"
         )
         await update.message.reply_text(help_text)
 
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        session = self.user_sessions[user_id]
-        session.clear()
-        session.status_message_id = None  # Reset status message tracking
+        async with self.sessions.lock(user_id):
+            session = await self.sessions.get(user_id)
+            await self.sessions.clear(session)  # Also resets status message tracking
         await update.message.reply_text("✅ All images cleared. You can start sending images again.")
 
+    async def download_image(self, session: UserSession, bot: Bot, file_id: str, extension: str = None,
+                             file_unique_id: str = None, file_size: int = None) -> str:
+        """
+        Download a file and return its path in the session directory, or a
+        memory reference (see UserSession.add_buffer) for a small file the
+        session's memory budget has room for. Without an extension the one
+        from Telegram's file path is used (default .jpg). Files seen before
+        (same file_unique_id) are linked from the download cache instead of
+        being fetched again; files kept in memory are not added to it, which
+        would write them to disk after all.
+        """
+        async def get_file() -> tuple:
+            with STAGE_SECONDS.labels('get_file').time():
+                file = await bot.get_file(file_id)
+
+            file_extension = extension
+            if file_extension is None:
+                file_extension = '.jpg'
+                if file.file_path:
+                    _, ext = os.path.splitext(file.file_path)
+                    if ext.lower() in self.supported_extensions:
+                        file_extension = ext
+            return file, file_extension
+
+        async def download(path_base: str) -> str:
+            file, file_extension = await get_file()
+            with STAGE_SECONDS.labels('download').time():
+                await file.download_to_drive(path_base + file_extension)
+            return path_base + file_extension
+
+        cache_key = file_unique_id if self.download_cache else None
+        budget = session.memory_budget
+        if budget and not (cache_key and self.download_cache.cached(cache_key)) and budget.reserve(file_size):
+            try:
+                file, file_extension = await get_file()
+                buffer = io.BytesIO()
+                with STAGE_SECONDS.labels('download').time():
+                    await file.download_to_memory(buffer)
+                # getvalue() hands over the buffer's bytes without copying them
+                data = buffer.getvalue()
+            except BaseException:
+                budget.release(file_size)
+                raise
+            budget.settle(file_size, len(data))
+            return session.add_buffer(data, file_extension)
+
+        # Use timestamp and UUID to ensure unique filename
+        unique_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+        image_base = os.path.join(session.temp_dir, f"image_{unique_id}")
+
+        if cache_key:
+            return await self.download_cache.fetch(cache_key, image_base, download)
+        return await download(image_base)
+
+    async def probe_download(self, session: UserSession, image_path: str) -> ImageInfo:
+        """
+        Read a downloaded image's header (format, dimensions, mode) without
+        decoding it. Oversized and unreadable images are deleted again and
+        the error is raised: ImageTooLarge, or Pillow's error for non-images.
+        """
+        try:
+            with STAGE_SECONDS.labels('probe').time():
+                return await asyncio.to_thread(
+                    probe_image, session.image_source(image_path), int(MAX_IMAGE_MEGAPIXELS * 1_000_000)
+                )
+        except Exception:
+            session.discard_image(image_path)
+            raise
+
+    async def reject_image(self, update: Update, error: Exception):
+        if isinstance(error, ImageTooLarge):
+            IMAGES_REJECTED.labels('too_large').inc()
+            logger.warning(f"[User {update.effective_user.id}] Rejected image update_id={update.update_id}: {error}")
+            await update.message.reply_text(
+                f"❌ Image is too large, at most {MAX_IMAGE_MEGAPIXELS:g} megapixels are supported."
+            )
+        else:
+            IMAGES_REJECTED.labels('unreadable').inc()
+            logger.warning(f"[User {update.effective_user.id}] Unreadable image update_id={update.update_id}: {error}")
+            formats = "JPEG, PNG or HEIC" if register_heif() else "JPEG or PNG"
+            await update.message.reply_text(f"❌ Unable to read this image, please send a {formats} file.")
+
+    async def process_media_group(self, user_id: int, items: List[MediaGroupItem]):
+        """
+        Download an album concurrently and register it in one step. Album
+        items are ordered by message_id; they take the album's update_ids in
+        sorted order so the album keeps its place among other messages.
+        """
+        session = await self.sessions.get(user_id)
+        items = sorted(items, key=lambda item: item.message_id)
+        update_ids = sorted(item.update_id for item in items)
+
+        downloads = asyncio.Semaphore(MEDIA_GROUP_DOWNLOADS)
+
+        async def download(item: MediaGroupItem) -> tuple:
+            async with downloads:
+                image_path = await self.download_image(session, item.context.bot, item.file_id, item.extension,
+                                                       item.file_unique_id, item.file_size)
+            return image_path, await self.probe_download(session, image_path)
+
+        results = await asyncio.gather(*(download(item) for item in items), return_exceptions=True)
+
+        images = []
+        too_large = 0
+        for update_id, item, result in zip(update_ids, items, results):
+            if isinstance(result, ImageTooLarge):
+                IMAGES_REJECTED.labels('too_large').inc()
+                logger.warning(f"[User {user_id}] Rejected album item update_id={update_id}: {result}")
+                too_large += 1
+            elif isinstance(result, Exception):
+                logger.error(f"[User {user_id}] Error downloading album item update_id={update_id}: {result}")
+            else:
+                image_path, info = result
+                images.append((update_id, image_path, item.file_unique_id, info))
+
+        if images:
+            async with self.sessions.lock(user_id):
+                total = await self.sessions.add_images(session, images)
+                logger.info(f"[User {user_id}] Added album of {len(images)} images, total={total}")
+                for update_id, image_path, *_ in images:
+                    self.schedule_page(session, update_id, image_path)
+            self.request_status_update(user_id, items[-1].update, items[-1].context)
+
+        if too_large:
+            await items[-1].update.message.reply_text(
+                f"❌ {too_large} image{'s' if too_large > 1 else ''} of the album "
+                f"{'are' if too_large > 1 else 'is'} too large, at most {MAX_IMAGE_MEGAPIXELS:g} megapixels "
+                f"are supported."
+            )
+        failed = len(items) - len(images) - too_large
+        if failed:
+            await items[-1].update.message.reply_text(
+                f"❌ Error processing {failed} image{'s' if failed > 1 else ''} of the album, please try again."
+            )
+
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        session = self.user_sessions[user_id]
+        session = await self.sessions.get(user_id)
         update_id = update.update_id
 
         logger.info(f"[User {user_id}] Received photo with update_id={update_id}")
 
-        try:
-            photo = update.message.photo[-1]
-            file = await context.bot.get_file(photo.file_id)
-
-            file_extension = '.jpg'
-            if file.file_path:
-                _, ext = os.path.splitext(file.file_path)
-                if ext.lower() in self.supported_extensions:
-                    file_extension = ext
-
-            # Use timestamp and UUID to ensure unique filename
-            unique_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
-            image_path = os.path.join(
-                session.temp_dir,
-                f"image_{unique_id}{file_extension}"
-            )
+        photo = update.message.photo[-1]
+        if update.message.media_group_id:
+            # Albums are downloaded and registered as one batch
+            item = MediaGroupItem(update, context, photo.file_id, file_unique_id=photo.file_unique_id,
+                                  file_size=photo.file_size)
+            self.media_groups.add(user_id, update.message.media_group_id, item)
+            return
 
+        try:
             # Download can happen concurrently (no lock needed)
-            await file.download_to_drive(image_path)
+            image_path = await self.download_image(session, context.bot, photo.file_id,
+                                                   file_unique_id=photo.file_unique_id, file_size=photo.file_size)
 
             logger.info(f"[User {user_id}] Downloaded photo update_id={update_id} to {image_path}")
+            try:
+                info = await self.probe_download(session, image_path)
+            except Exception as e:
+                await self.reject_image(update, e)
+                return
 
-            # Critical section: add image + update status (must be atomic)
-            async with session.update_lock:
-                session.add_image(image_path, update_id)
+            # Critical section: only the in-memory append
+            async with self.sessions.lock(user_id):
+                await self.sessions.add_image(session, image_path, update_id, photo.file_unique_id, info)
                 logger.info(f"[User {user_id}] Added photo update_id={update_id}, total={len(session.images)}")
+                self.schedule_page(session, update_id, image_path)
 
-                keyboard = [
-                    [InlineKeyboardButton("📄 Generate PDF", callback_data="generate_pdf")],
-                    [InlineKeyboardButton("🗑️ Clear Images", callback_data="clear_images")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                status_text = f"✅ Image received! Currently have {len(session.images)} image{'s' if len(session.images) > 1 else ''}."
-
-                # Update existing status message or create new one
-                if session.status_message_id:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=update.effective_chat.id,
-                            message_id=session.status_message_id,
-                            text=status_text,
-                            reply_markup=reply_markup
-                        )
-                    except Exception as e:
-                        # If editing fails (message too old or deleted), send new message
-                        logger.warning(f"Could not edit status message: {e}")
-                        sent_message = await update.message.reply_text(
-                            status_text,
-                            reply_markup=reply_markup
-                        )
-                        session.status_message_id = sent_message.message_id
-                else:
-                    # First image, create status message
-                    sent_message = await update.message.reply_text(
-                        status_text,
-                        reply_markup=reply_markup
-                    )
-                    session.status_message_id = sent_message.message_id
+            # Status message edits happen outside the lock, coalesced per user
+            self.request_status_update(user_id, update, context)
 
         except Exception as e:
             logger.error(f"Error processing image: {e}")
@@ -202,7 +602,7 @@ class Img2PDFBot:
 
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        session = self.user_sessions[user_id]
+        session = await self.sessions.get(user_id)
         update_id = update.update_id
 
         document = update.message.document
@@ -217,222 +617,243 @@ class Img2PDFBot:
             )
             return
 
-        try:
-            file = await context.bot.get_file(document.file_id)
-            # Use timestamp and UUID to ensure unique filename
-            unique_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
-            image_path = os.path.join(
-                session.temp_dir,
-                f"image_{unique_id}{ext}"
-            )
+        if update.message.media_group_id:
+            # Albums are downloaded and registered as one batch
+            self.media_groups.add(user_id, update.message.media_group_id,
+                                  MediaGroupItem(update, context, document.file_id, ext, document.file_unique_id,
+                                                 document.file_size))
+            return
 
+        try:
             # Download can happen concurrently (no lock needed)
-            await file.download_to_drive(image_path)
-
-            # Critical section: add image + update status (must be atomic)
-            async with session.update_lock:
-                session.add_image(image_path, update_id)
-
-                keyboard = [
-                    [InlineKeyboardButton("📄 Generate PDF", callback_data="generate_pdf")],
-                    [InlineKeyboardButton("🗑️ Clear Images", callback_data="clear_images")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                status_text = f"✅ Image received! Currently have {len(session.images)} image{'s' if len(session.images) > 1 else ''}."
-
-                # Update existing status message or create new one
-                if session.status_message_id:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=update.effective_chat.id,
-                            message_id=session.status_message_id,
-                            text=status_text,
-                            reply_markup=reply_markup
-                        )
-                    except Exception as e:
-                        # If editing fails (message too old or deleted), send new message
-                        logger.warning(f"Could not edit status message: {e}")
-                        sent_message = await update.message.reply_text(
-                            status_text,
-                            reply_markup=reply_markup
-                        )
-                        session.status_message_id = sent_message.message_id
-                else:
-                    # First image, create status message
-                    sent_message = await update.message.reply_text(
-                        status_text,
-                        reply_markup=reply_markup
-                    )
-                    session.status_message_id = sent_message.message_id
+            image_path = await self.download_image(session, context.bot, document.file_id, ext,
+                                                   document.file_unique_id, document.file_size)
+            try:
+                info = await self.probe_download(session, image_path)
+            except Exception as e:
+                await self.reject_image(update, e)
+                return
+
+            # Critical section: only the in-memory append
+            async with self.sessions.lock(user_id):
+                await self.sessions.add_image(session, image_path, update_id, document.file_unique_id, info)
+                self.schedule_page(session, update_id, image_path)
+
+            # Status message edits happen outside the lock, coalesced per user
+            self.request_status_update(user_id, update, context)
 
         except Exception as e:
             logger.error(f"Error processing document: {e}")
             await update.message.reply_text("❌ Error processing image, please try again.")
 
-    def images_to_pdf(self, image_paths: List[str], pdf_path: str) -> bool:
-        """
-        Optimized PDF generation method to avoid memory leaks
-        """
-        images = []
-        try:
-            # Process images one by one with explicit memory management
-            for image_path in image_paths:
-                try:
-                    with Image.open(image_path) as img:
-                        # Convert color mode
-                        if img.mode in ('RGBA', 'P', 'L') or img.mode != 'RGB':
-                            # Create RGB copy
-                            rgb_img = img.convert('RGB')
-                            images.append(rgb_img)
-                        else:
-                            # Create copy to avoid file handle issues
-                            rgb_img = img.copy()
-                            images.append(rgb_img)
-                except Exception as e:
-                    logger.error(f"Cannot open image file {image_path}: {e}")
-                    continue
+    async def generate_pdf(self, update: Update, context: ContextTypes.DEFAULT_TYPE, session: UserSession):
+        """Assemble the session's PDF, send it and clear the session"""
+        query = update.callback_query
+        user_id = session.user_id
 
-            if not images:
-                return False
+        # Albums still being collected belong before this PDF
+        await self.media_groups.wait_for_user(user_id)
+        session = await self.sessions.get(user_id)
+        if not session.images:
+            await query.edit_message_text("❌ No images to convert. Please send images first.")
+            return
 
-            try:
-                # Generate PDF
-                if len(images) == 1:
-                    images[0].save(pdf_path, resolution=100.0, optimize=True)
-                else:
-                    images[0].save(
-                        pdf_path,
-                        save_all=True,
-                        append_images=images[1:],
-                        resolution=100.0,
-                        optimize=True
-                    )
+        # Same images with the same settings were converted before
+        key = self.result_key(session) if self.result_cache else None
+        if key and await self.send_cached_result(session, update, context, key):
+            async with self.sessions.lock(user_id):
+                await self.sessions.clear(session)
+            await query.edit_message_text("✅ PDF sent! Session cleared, you can send new images.")
+            return
 
-                return True
+        await query.edit_message_text("🔄 Generating PDF, please wait...")
 
-            except Exception as e:
-                logger.error(f"Error saving PDF: {e}")
-                return False
+        uploads: List[asyncio.Task] = []
+        try:
+            pdf_name = f"images_to_pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            chat_id = update.effective_chat.id
+
+            # Pages were prepared as images arrived; only the page order
+            # (sorted by update_id) and trailer remain to be written.
+            # Parts of a split PDF are uploaded while later ones are written.
+            logger.info(f"[User {user_id}] Finalizing PDF with {len(session.images)} images in correct order")
+            page_count = 0
+            finalize_started = time.perf_counter()
+            async for pdf_path, part_pages, is_part in self.finalize_pdf_parts(session):
+                if not uploads:
+                    STAGE_SECONDS.labels('finalize').observe(time.perf_counter() - finalize_started)
+                    # Update status message to show completion
+                    await query.edit_message_text("✅ PDF generation complete! Sending file...")
+                if is_part:
+                    filename = f"{pdf_name}_part{len(uploads) + 1}.pdf"
+                    caption = (f"✅ PDF part {len(uploads) + 1}: images {page_count + 1}-"
+                               f"{page_count + part_pages}.")
+                else:
+                    filename = f"{pdf_name}.pdf"
+                    caption = f"✅ PDF generated successfully! Contains {part_pages} images."
+                uploads.append(asyncio.create_task(self.upload_pdf(
+                    context.bot, chat_id, pdf_path, filename, caption, uploads[-1] if uploads else None, is_part
+                )))
+                page_count += part_pages
+            if self.profile:
+                self.profile.job_done()
+
+            if uploads:
+                # Parts are uploaded one after another, in order
+                messages = await asyncio.gather(*uploads)
+                # Pages that failed or timed out in the render pool were left out
+                skipped = len(session.images) - page_count
+                # A PDF missing pages must not be sent again for the same images
+                if key and skipped == 0 and len(messages) == 1 and messages[0].document:
+                    self.result_cache.put(key, messages[0].document.file_id, page_count)
+
+                # Clear session and reset status message ID
+                async with self.sessions.lock(user_id):
+                    await self.sessions.clear(session)
+
+                # Update final status
+                if len(uploads) > 1:
+                    status = f"✅ PDF sent in {len(uploads)} parts! Session cleared, you can send new images."
+                else:
+                    status = "✅ PDF sent! Session cleared, you can send new images."
+                if skipped > 0:
+                    status += f"\n⚠️ {skipped} image(s) could not be converted and were left out."
+                await query.edit_message_text(status)
+            else:
+                await query.edit_message_text("❌ Failed to generate PDF, please try again.")
 
         except Exception as e:
-            logger.error(f"Error generating PDF: {e}")
-            return False
-
-        finally:
-            # Explicitly clean up PIL objects
-            for img in images:
-                try:
-                    img.close()
-                except:
-                    pass
-            images.clear()
-
-            # Force garbage collection
-            gc.collect()
+            logger.error(f"Error sending PDF: {e}")
+            for upload in uploads:
+                upload.cancel()
+            await query.edit_message_text("❌ Error sending PDF, please try again.")
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
         user_id = update.effective_user.id
-        session = self.user_sessions[user_id]
+        session = await self.sessions.get(user_id)
 
         if query.data == "generate_pdf":
-            if not session.images:
-                await query.edit_message_text("❌ No images to convert. Please send images first.")
-                return
-
-            await query.edit_message_text("🔄 Generating PDF, please wait...")
-
-            try:
-                pdf_filename = f"images_to_pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-                pdf_path = os.path.join(session.temp_dir, pdf_filename)
-
-                # Sort images by update_id to ensure correct order
-                sorted_image_paths = session.get_sorted_images()
-                logger.info(f"[User {user_id}] Generating PDF with {len(sorted_image_paths)} images in correct order")
-
-                if self.images_to_pdf(sorted_image_paths, pdf_path):
-                    # Update status message to show completion
-                    await query.edit_message_text("✅ PDF generation complete! Sending file...")
-
-                    with open(pdf_path, 'rb') as pdf_file:
-                        await context.bot.send_document(
-                            chat_id=update.effective_chat.id,
-                            document=pdf_file,
-                            filename=pdf_filename,
-                            caption=f"✅ PDF generated successfully! Contains {len(session.images)} images."
-                        )
-
-                    # Clear session and reset status message ID
-                    session.clear()
-                    session.status_message_id = None
-
-                    # Force garbage collection to free memory
-                    gc.collect()
+            # Mostly waiting on page jobs and uploads: let other users' updates
+            # have the dispatcher slot (this user's next update still waits)
+            release_slot()
+            # Touched and marked busy so expiry and eviction leave the session
+            # alone while pages, the trailer and the uploads are awaited
+            async with self.sessions.busy(session):
+                await self.generate_pdf(update, context, session)
+
+        elif query.data == "page_profile_menu":
+            await query.edit_message_text(
+                "📐 Choose the PDF page size:",
+                reply_markup=self.build_choice_keyboard(PAGE_PROFILES, session.page_profile, "page_profile")
+            )
 
-                    # Update final status
-                    await query.edit_message_text("✅ PDF sent! Session cleared, you can send new images.")
-                else:
-                    await query.edit_message_text("❌ Failed to generate PDF, please try again.")
+        elif query.data == "compression_menu":
+            await query.edit_message_text(
+                "🗜️ Choose the compression profile:\n\n"
+                "• Standard: JPEG photos kept as sent\n"
+                "• High quality: less compression for converted images\n"
+                "• Small file: stronger compression, gray pages stored as grayscale\n"
+                "• Document scan: text pages stored as black and white",
+                reply_markup=self.build_choice_keyboard(COMPRESSION_PROFILES, session.compression_profile, "compression")
+            )
 
-            except Exception as e:
-                logger.error(f"Error sending PDF: {e}")
-                await query.edit_message_text("❌ Error sending PDF, please try again.")
+        elif query.data.startswith("page_profile:") or query.data.startswith("compression:"):
+            setting, name = query.data.split(":", 1)
+            if setting == "page_profile" and name in PAGE_PROFILES:
+                await self.sessions.update_settings(session, page_profile=name)
+                confirmation = f"📐 Page size set to {PAGE_PROFILES[name].label}."
+            elif setting == "compression" and name in COMPRESSION_PROFILES:
+                await self.sessions.update_settings(session, compression_profile=name)
+                confirmation = f"🗜️ Compression set to {COMPRESSION_PROFILES[name].label}."
+            else:
+                confirmation = "❌ Unknown setting."
+
+            if session.images:
+                # Pages prepared with the old settings cannot be reused
+                self.restart_assembly(session)
+                await query.edit_message_text(
+                    self.build_status_text(session),
+                    reply_markup=self.build_status_keyboard(session)
+                )
+            else:
+                await query.edit_message_text(confirmation)
 
         elif query.data == "clear_images":
-            session.clear()
-            session.status_message_id = None  # Reset status message tracking
-            # Force garbage collection to free memory
-            gc.collect()
+            async with self.sessions.lock(user_id):
+                await self.sessions.clear(session)  # Also resets status message tracking
             await query.edit_message_text("✅ All images cleared.")
 
     async def cleanup_old_sessions(self, context: ContextTypes.DEFAULT_TYPE):
         """
-        Improved session cleanup mechanism with more aggressive memory release
+        Remove sessions idle for SESSION_IDLE_TTL. Only expired sessions are
+        visited and their directories are deleted in a background thread.
         """
-        cutoff_time = datetime.now() - timedelta(minutes=30)
-        users_to_remove = []
-
-        for user_id, session in self.user_sessions.items():
-            if session.last_activity < cutoff_time:
-                # Clean up session data and temporary files
-                session.cleanup()
-                users_to_remove.append(user_id)
+        cutoff_time = datetime.now() - timedelta(seconds=SESSION_IDLE_TTL)
 
-        # Completely remove expired sessions from dictionary
-        for user_id in users_to_remove:
-            del self.user_sessions[user_id]
+        # Clean up expired session data and temporary files
+        users_to_remove = await self.sessions.remove_expired(cutoff_time)
 
-        # Execute garbage collection if sessions were cleaned
         if users_to_remove:
-            gc.collect()
             # Get memory usage information
-            process = psutil.Process()
-            memory_mb = process.memory_info().rss / 1024 / 1024
-            logger.info(f"Cleaned {len(users_to_remove)} expired sessions and freed memory, current memory usage: {memory_mb:.1f}MB")
+            memory_mb = admission.rss_mb()
+            logger.info(f"Cleaned {len(users_to_remove)} expired sessions, current memory usage: {memory_mb:.1f}MB")
+            # Log current active session count (for monitoring)
+            logger.info(f"Current active sessions: {len(self.sessions)}")
         else:
-            logger.info("No expired sessions to clean")
-
-        # Log current active session count (for monitoring)
-        logger.info(f"Current active sessions: {len(self.user_sessions)}")
+            logger.debug("No expired sessions to clean")
 
 # Global variables
 app = FastAPI(title="Telegram Image to PDF Bot")
 bot_instance = None
 application = None
+dispatcher = None
+governor = None
+admission = AdmissionController.from_env()
+
+async def register_webhook(bot: Bot):
+    """
+    Point Telegram at our /webhook endpoint when WEBHOOK_URL is set. The
+    webhook is only set again when its URL, secret token or allowed updates
+    changed, so a restart costs one getWebhookInfo call.
+    """
+    url = webhook_target()
+    if not url:
+        return
+
+    try:
+        info = await bot.get_webhook_info()
+        if info.url == url and sorted(info.allowed_updates or ()) == sorted(ALLOWED_UPDATES):
+            logger.info(f"Webhook already set to: {without_query(url)}")
+            return
+    except Exception as e:
+        logger.warning(f"Could not read the current webhook, setting it: {e}")
+
+    webhook_secret = os.getenv('WEBHOOK_SECRET_TOKEN')
+    await bot.set_webhook(url=url, secret_token=webhook_secret, allowed_updates=ALLOWED_UPDATES)
+    logger.info(f"Webhook set to: {without_query(url)} ({'with' if webhook_secret else 'no'} secret token)")
 
 async def setup_bot():
-    global bot_instance, application
+    global bot_instance, application, dispatcher, governor
 
     token = os.getenv('BOT_TOKEN')
     if not token:
         logger.error("Please set the BOT_TOKEN environment variable")
         raise ValueError("BOT_TOKEN environment variable is required")
+    setup_started = time.monotonic()
 
     bot_instance = Img2PDFBot()
-    application = Application.builder().token(token).build()
+    # Same connection pool size as the builder's default request object
+    application = (
+        Application.builder()
+        .token(token)
+        .base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", bot_instance.start))
     application.add_handler(CommandHandler("help", bot_instance.help_command))
@@ -442,25 +863,24 @@ async def setup_bot():
     application.add_handler(CallbackQueryHandler(bot_instance.button_callback))
 
     job_queue = application.job_queue
-    job_queue.run_repeating(bot_instance.cleanup_old_sessions, interval=300, first=300)
+    job_queue.run_repeating(bot_instance.cleanup_old_sessions, interval=SESSION_CLEANUP_INTERVAL,
+                            first=SESSION_CLEANUP_INTERVAL)
 
     await application.initialize()
     await application.start()
+    dispatcher = UpdateDispatcher.from_env(application.process_update)
+    governor = MemoryGovernor.from_env(bot_instance.sessions, bot_instance.render_pool)
+    governor.start()
 
-    webhook_url = os.getenv('WEBHOOK_URL')
-    if webhook_url:
-        webhook_secret = os.getenv('WEBHOOK_SECRET_TOKEN')
-        if webhook_secret:
-            await application.bot.set_webhook(
-                url=f"{webhook_url}/webhook",
-                secret_token=webhook_secret
-            )
-            logger.info(f"Webhook set to: {webhook_url}/webhook (with secret token)")
-        else:
-            await application.bot.set_webhook(url=f"{webhook_url}/webhook")
-            logger.info(f"Webhook set to: {webhook_url}/webhook (no secret token)")
+    # In sharded mode the front process owns the webhook (see sharding.py)
+    if os.getenv('SHARD_INDEX') is None:
+        await register_webhook(application.bot)
 
-    logger.info("Bot initialization completed")
+    ready = time.monotonic()
+    STARTUP_SECONDS.labels('imports').set(IMPORTED_AT - MODULE_LOADED_AT)
+    STARTUP_SECONDS.labels('setup').set(ready - setup_started)
+    STARTUP_SECONDS.labels('total').set(ready - MODULE_LOADED_AT)
+    logger.info(f"Bot initialization completed, ready {ready - MODULE_LOADED_AT:.2f}s after start")
 
 @app.on_event("startup")
 async def startup_event():
@@ -469,9 +889,15 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     global application
+    if governor:
+        await governor.stop()
+    if dispatcher:
+        await dispatcher.shutdown()
     if application:
         await application.stop()
         await application.shutdown()
+    if bot_instance:
+        bot_instance.render_pool.shutdown()
 
 # Telegram official IP ranges
 TELEGRAM_IP_RANGES = [
@@ -487,17 +913,8 @@ def verify_telegram_ip(client_ip: str) -> bool:
     except ValueError:
         return False
 
-@app.post("/webhook")
-async def webhook(
-    request: Request,
-    background_tasks: BackgroundTasks,
-    x_telegram_bot_api_secret_token: str = Header(None)
-):
-    global application
-
-    if not application:
-        raise HTTPException(status_code=503, detail="Bot not initialized")
-
+def check_webhook_request(request: Request, secret_token: str):
+    """Reject webhook calls from unexpected IPs or with a wrong secret token"""
     # Verify IP address (check X-Forwarded-For if there's a proxy)
     client_ip = request.headers.get("X-Forwarded-For", request.client.host).split(",")[0].strip()
 
@@ -509,34 +926,176 @@ async def webhook(
 
     # Verify Secret Token (if set)
     webhook_secret = os.getenv('WEBHOOK_SECRET_TOKEN')
-    if webhook_secret and x_telegram_bot_api_secret_token != webhook_secret:
+    if webhook_secret and secret_token != webhook_secret:
         logger.warning(f"Webhook request with invalid secret token from IP: {client_ip}")
         raise HTTPException(status_code=403, detail="Invalid secret token")
 
-    try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
+def check_admin_token(token: str):
+    """Admin endpoints are disabled unless ADMIN_TOKEN is set"""
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not found")
+    if token != admin_token:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+def update_owner(update: Update):
+    """Key used to keep one user's updates in order"""
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+@app.post("/webhook")
+async def webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: str = Header(None)
+):
+    global application
+
+    if not application:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
 
-        if update:
-            background_tasks.add_task(process_update, update)
+    check_webhook_request(request, x_telegram_bot_api_secret_token)
 
-        return {"status": "ok"}
+    # Shed load before reading the body; Telegram retries non-2xx answers
+    render_pool = bot_instance.render_pool
+    if not admission.admit(dispatcher.queued, render_pool.backlog_pixels):
+        raise HTTPException(status_code=503, detail="Server busy",
+                            headers={"Retry-After": str(admission.retry_after)})
 
+    try:
+        with STAGE_SECONDS.labels('webhook_parse').time():
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
     except Exception as e:
         logger.error(f"Error processing webhook: {e}")
         raise HTTPException(status_code=400, detail="Invalid request data")
 
-async def process_update(update: Update):
-    global application
-    await application.process_update(update)
+    # A non-2xx answer makes Telegram deliver the update again later
+    if update and not dispatcher.submit(update_owner(update), update):
+        logger.warning(f"Update queue full, asking Telegram to retry update {update.update_id}")
+        raise HTTPException(status_code=429, detail="Too many queued updates", headers={"Retry-After": "5"})
+
+    return {"status": "ok"}
 
 @app.get("/")
 async def root():
     return {"message": "Telegram Image to PDF Bot is running"}
 
 @app.get("/health")
-async def health():
-    return {"status": "healthy"}
+async def health(response: Response):
+    """
+    Readiness: 503 while the bot is starting or cannot take more updates
+    (shedding load or update queue full)
+    """
+    if not (bot_instance and dispatcher):
+        response.status_code = 503
+        return {"status": "starting"}
+
+    render_pool = bot_instance.render_pool
+    checks = {
+        "accepting": not admission.update(dispatcher.queued, render_pool.backlog_pixels),
+        "update_queue": dispatcher.queued < dispatcher.queue_size,
+    }
+    healthy = all(checks.values())
+    if not healthy:
+        response.status_code = 503
+    return {
+        "status": "healthy" if healthy else "unhealthy",
+        "checks": checks,
+        "reason": admission.reason,
+        "sessions": len(bot_instance.sessions),
+        "queued_updates": dispatcher.queued,
+        "renders": render_pool.queued + render_pool.in_flight,
+        "rss_mb": round(admission.rss_mb(), 1),
+    }
+
+@app.get("/health/live")
+async def liveness():
+    """Liveness: the process answers, whatever its load"""
+    return {"status": "alive"}
+
+@app.get("/metrics")
+async def metrics():
+    if os.getenv('METRICS_ENABLED', 'true').lower() != 'true':
+        raise HTTPException(status_code=404, detail="Not found")
+    if bot_instance:
+        sessions = bot_instance.sessions
+        ACTIVE_SESSIONS.set(len(sessions))
+        RENDERS_QUEUED.set(bot_instance.render_pool.queued)
+        RENDERS_IN_FLIGHT.set(bot_instance.render_pool.in_flight)
+        RENDER_PIXELS_IN_FLIGHT.set(bot_instance.render_pool.pixels_in_flight)
+        SESSION_MEMORY_BYTES.set(sessions.memory_budget.used if sessions.memory_budget else 0)
+        # Walking the session directories is file system work; keep it off the event loop
+        SESSION_DISK_BYTES.set(await asyncio.to_thread(directory_bytes, sessions.temp_dirs()))
+    if dispatcher:
+        QUEUED_UPDATES.set(dispatcher.queued)
+        UPDATES_IN_FLIGHT.set(dispatcher.in_flight)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/admin/dispatcher")
+async def dispatcher_stats(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    if not dispatcher:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+    return dispatcher.stats()
+
+@app.get("/admin/cache")
+async def cache_stats(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    if not bot_instance:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+    download_cache = bot_instance.download_cache
+    result_cache = bot_instance.result_cache
+    memory_budget = bot_instance.sessions.memory_budget
+    return {
+        "downloads": download_cache.stats() if download_cache else None,
+        "results": result_cache.stats() if result_cache else None,
+        "memory": memory_budget.stats() if memory_budget else None,
+    }
+
+@app.get("/admin/render")
+async def render_stats(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    if not bot_instance:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+    return bot_instance.render_pool.stats()
+
+@app.get("/admin/admission")
+async def admission_stats(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    return admission.stats()
+
+@app.post("/admin/profile")
+async def profile(seconds: float = 10, jobs: int = 0, interval_ms: float = 5, allocations: bool = True,
+                  format: str = "json", x_admin_token: str = Header(None)):
+    """
+    Profile this process for `seconds` (or until `jobs` PDFs were generated)
+    and return the result; format=collapsed returns only the collapsed stacks
+    """
+    check_admin_token(x_admin_token)
+    if not bot_instance:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+    if bot_instance.profile:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    bot_instance.profile = Profile(seconds, jobs, interval_ms / 1000, allocations=allocations)
+    try:
+        result = await bot_instance.profile.run(dispatcher)
+    finally:
+        bot_instance.profile = None
+
+    if format == "collapsed":
+        return Response(result["collapsed"], media_type="text/plain")
+    return result
+
+@app.get("/admin/memory")
+async def memory_stats(x_admin_token: str = Header(None)):
+    check_admin_token(x_admin_token)
+    if not governor:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
+    return governor.stats()
 
 def main():
     import uvicorn
@@ -0,0 +1,38 @@
+"""Page classification tests for pdf_render"""
+
+import pytest
+from PIL import Image, ImageDraw
+
+from pdf_render import COMPRESSION_PROFILES, _bilevel_threshold, classify_page
+
+
+def two_level_page(ink: int, paper: int) -> Image.Image:
+    """A text-like RGB page with exactly two gray levels"""
+    img = Image.new('RGB', (600, 800), (paper, paper, paper))
+    draw = ImageDraw.Draw(img)
+    for top in range(40, 760, 30):
+        draw.rectangle((40, top, 560, top + 8), fill=(ink, ink, ink))
+    return img
+
+
+@pytest.mark.parametrize('ink, paper', [(0, 255), (20, 230)])
+def test_two_level_histogram_is_bilevel(ink, paper):
+    histogram = [0] * 256
+    histogram[ink] = 1000
+    histogram[paper] = 9000
+    threshold = _bilevel_threshold(histogram, 10000)
+    assert threshold is not None
+    # The split sits in the middle of the empty gap, not next to the ink
+    assert abs(threshold - (ink + paper) // 2) <= 1
+
+
+@pytest.mark.parametrize('ink, paper', [(0, 255), (20, 230)])
+def test_two_level_page_is_bilevel(ink, paper):
+    kind, threshold = classify_page(two_level_page(ink, paper), COMPRESSION_PROFILES['document'])
+    assert kind == 'bilevel'
+    assert ink < threshold < paper
+
+
+def test_photo_like_gradient_is_not_bilevel():
+    img = Image.linear_gradient('L').convert('RGB')
+    assert classify_page(img, COMPRESSION_PROFILES['document']) == ('gray', None)
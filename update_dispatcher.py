@@ -0,0 +1,170 @@
+"""
+Bounded dispatcher for incoming updates
+
+Webhook requests only enqueue their update; a fixed number of updates are
+processed at a time and each user's updates run strictly in arrival order.
+When the queue (overall or for one user) is full the update is rejected so
+the webhook can ask Telegram to deliver it again later, instead of piling
+up unbounded background tasks during bursts.
+
+A handler that spends most of its time waiting (generating and uploading a
+PDF) calls release_slot() so other users' updates can run meanwhile; the
+user's next update still waits until the handler returns.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Number of recent queue wait times kept for percentiles
+WAIT_SAMPLES = 1000
+
+
+class Slot:
+    """A processing slot held by the update being processed"""
+
+    def __init__(self, dispatcher: 'UpdateDispatcher'):
+        self.dispatcher = dispatcher
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.dispatcher.slots.release()
+
+
+# Slot of the update processed by the current task
+_current_slot: ContextVar[Optional[Slot]] = ContextVar('update_slot', default=None)
+
+
+def release_slot() -> bool:
+    """
+    Give up the processing slot of the update being handled, for the rest
+    of the handler. Returns False outside the dispatcher.
+    """
+    slot = _current_slot.get()
+    if slot is None or not slot.held:
+        return False
+    slot.release()
+    slot.dispatcher.released += 1
+    return True
+
+
+class UpdateDispatcher:
+    def __init__(self, process: Callable[[object], Awaitable], concurrency: int = 8, queue_size: int = 200,
+                 user_queue_size: int = 50):
+        self.process = process
+        self.concurrency = max(1, concurrency)
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.queues: Dict[Hashable, Deque[Tuple[object, float]]] = {}
+        self.runners: Dict[Hashable, asyncio.Task] = {}
+        self.queued = 0  # Updates waiting to be processed
+        self.in_flight = 0  # Updates being processed
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.released = 0  # Updates that gave up their slot before finishing
+        self.max_wait = 0.0
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    @classmethod
+    def from_env(cls, process: Callable[[object], Awaitable]) -> 'UpdateDispatcher':
+        return cls(
+            process,
+            concurrency=int(os.getenv('UPDATE_CONCURRENCY', 8)),
+            queue_size=int(os.getenv('UPDATE_QUEUE_SIZE', 200)),
+            user_queue_size=int(os.getenv('UPDATE_USER_QUEUE_SIZE', 50)),
+        )
+
+    def submit(self, user_id: Hashable, update) -> bool:
+        """
+        Queue an update behind the user's earlier updates. Returns False
+        (and counts a drop) when the overall or per-user queue is full.
+        """
+        queue = self.queues.get(user_id)
+        if self.queued >= self.queue_size or (queue is not None and len(queue) >= self.user_queue_size):
+            self.dropped += 1
+            return False
+
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append((update, time.monotonic()))
+        self.queued += 1
+        if user_id not in self.runners:
+            self.runners[user_id] = asyncio.create_task(self._run_user(user_id))
+        return True
+
+    async def _run_user(self, user_id: Hashable):
+        """Process one user's updates in order until their queue is empty"""
+        queue = self.queues[user_id]
+        try:
+            while queue:
+                await self.slots.acquire()
+                slot = Slot(self)
+                try:
+                    update, enqueued_at = queue.popleft()
+                    self.queued -= 1
+                    wait = time.monotonic() - enqueued_at
+                    self.waits.append(wait)
+                    self.max_wait = max(self.max_wait, wait)
+
+                    self.in_flight += 1
+                    _current_slot.set(slot)
+                    try:
+                        await self.process(update)
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error(f"Error processing update for user {user_id}: {e}")
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+                finally:
+                    slot.release()
+        finally:
+            # Anything left is discarded only on cancellation (shutdown)
+            self.queued -= len(queue)
+            del self.queues[user_id]
+            del self.runners[user_id]
+
+    def wait_percentile(self, percentile: float) -> float:
+        if not self.waits:
+            return 0.0
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'users': len(self.queues),
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'released': self.released,
+            'wait_p50': round(self.wait_percentile(0.5), 3),
+            'wait_p95': round(self.wait_percentile(0.95), 3),
+            'wait_max': round(self.max_wait, 3),
+            'concurrency': self.concurrency,
+            'queue_size': self.queue_size,
+            'user_queue_size': self.user_queue_size,
+        }
+
+    async def shutdown(self, timeout: float = 10.0):
+        """Give queued updates a chance to finish, then cancel the rest"""
+        runners = list(self.runners.values())
+        if not runners:
+            return
+        done, pending = await asyncio.wait(runners, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Discarded queued updates for {len(pending)} users at shutdown")
+            await asyncio.gather(*pending, return_exceptions=True)